@@ -1,14 +1,24 @@
 # encoding: utf-8
 from .job import JobsHandler
+from .job import BatchJobsHandler
+from .job import JobSearchHandler
 from .job import JobLogHandler
 from .job import JobLogWSHandler
+from .job import JobLogSearchHandler
 from .job import StopJobHandler
 from .job import RestartJobHandler
 from .job import TensorBoardHandler
 from .job import JobLogVersionHandler
+from .job_events import JobEventsHandler
+from .job_events import JobEventsWSHandler
+from .scheduler import SchedulerHandler
+from .metrics import MetricsHandler
+from .ready import ReadyHandler
+from .stats import StatsHandler
 from .repo import ReposHandler
 from .repo import RepoHandler
 from .node import NodesHandler
+from .node import NodesDeltaHandler
 from .tensorboard_proxy import TensorBoardProxyHandler
 from .oauth import OAuth2Handler
 from .user import CurrentUserHandler
@@ -2,10 +2,16 @@
 import json
 import os
 import re
-import logging
+import time
+import zlib
 import bson
+import itertools
+import logging
 from collections import defaultdict
 
+import pymongo.errors
+
+import tornado.iostream
 import tornado.web
 import tornado.websocket
 
@@ -13,24 +19,30 @@ from ktqueue.cloner import Cloner
 from .utils import convert_asyncio_task
 from .utils import BaseHandler
 from .utils import apiauthenticated
+from .utils import json_default
 from ktqueue.utils import k8s_delete_job
 from ktqueue.utils import KTQueueDefaultCredentialProvider
+from ktqueue.pod_cache import pod_cache
+from ktqueue.log_hub import log_hub
+from ktqueue.fs import fs
+from ktqueue import log_store
+from ktqueue import log_search
+from ktqueue import search
+from ktqueue.submission import get_submission_queue
+from ktqueue.change_feed import get_change_feed
+from ktqueue.kubernetes_client import PRIORITY_HIGH
 from ktqueue import settings
 
 
 def generate_job(name, command, node, gpu_num, image, repo, branch, commit_id,
-                 comments, mounts, load_nvidia_driver=None, cpu_limit=None, memory_limit=None, auto_restart=False):
+                 comments, mounts, load_nvidia_driver=None, cpu_limit=None, memory_limit=None, auto_restart=False,
+                 wall_time=None):
     """Generate a job description in JSON format."""
 
     command_kube = 'cd $WORK_DIR && ' + command
 
     job_dir = os.path.join('/cephfs/ktqueue/jobs/', name)
-    if not os.path.exists(job_dir):
-        os.makedirs(job_dir)
-
     output_dir = os.path.join('/cephfs/ktqueue/output', name)
-    if not os.path.exists(output_dir):
-        os.makedirs(output_dir)
 
     volumeMounts = []
     volumes = []
@@ -138,33 +150,151 @@ def generate_job(name, command, node, gpu_num, image, repo, branch, commit_id,
             }
         }
     }
+    if wall_time:  # kill the job when it runs longer than the wall time
+        job['spec']['activeDeadlineSeconds'] = int(wall_time)
     return job
 
 
+async def make_job_dirs(name):
+    """Create job directory and output directory used by generate_job()."""
+    await fs.makedirs(os.path.join('/cephfs/ktqueue/jobs/', name))
+    await fs.makedirs(os.path.join('/cephfs/ktqueue/output', name))
+
+
 async def clone_code(name, repo, branch, commit_id, jobs_collection, job_dir, crediential):
     # clone code
     if repo:
         try:
+            await crediential.prepare_credential()
             cloner = Cloner(repo=repo, dst_directory=os.path.join(job_dir, 'code'),
                             branch=branch, commit_id=commit_id, crediential=crediential)
             await cloner.clone_and_copy()
         except Exception as e:
-            jobs_collection.update_one({'name': name}, {'$set': {'status': 'FetchError'}})
+            await jobs_collection.update_one({'name': name}, {'$set': {'status': 'FetchError'}})
+            get_change_feed().publish_job(name, {'status': 'FetchError'})
             raise
         if not commit_id:
-            jobs_collection.update_one({'name': name}, {'$set': {'commit': cloner.commit_id}})
+            await jobs_collection.update_one({'name': name}, {'$set': {'commit': cloner.commit_id}})
+            get_change_feed().publish_job(name, {'commit': cloner.commit_id})
     else:
-        os.makedirs(os.path.join('/cephfs/ktqueue/jobs', name, 'code'))
+        await fs.makedirs(os.path.join('/cephfs/ktqueue/jobs', name, 'code'))
+
+
+job_name_pattern = re.compile(r'^[a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*$')
+
+
+def check_job_name(name):
+    """Return why `name` can't be used as a job name, None if it can."""
+    if not name:
+        return 'job name is required.'
+    if len(name) > 58:  # kubernetes doesn't accept name longer than 64. 64 - 6 (pod name suffix) = 58
+        return 'job name too long(>58).'
+    if not job_name_pattern.match(name):
+        return 'illegal task name, regex used for validation is [a-z0-9]([-a-z0-9]*[a-z0-9])?(\\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*'
+    return None
+
+
+def check_priority_class(priority_class):
+    """Return why `priority_class` can't be used, None if it can."""
+    if priority_class and priority_class not in settings.priority_classes:
+        return 'unknown priorityClass {}, should be one of {}.'.format(
+            priority_class, ', '.join(sorted(settings.priority_classes)))
+    return None
+
+
+def check_wall_time(wall_time):
+    """Return why `wall_time` (seconds) can't be used, None if it can or is not given."""
+    if wall_time is None or wall_time == '':
+        return None
+    try:
+        seconds = int(wall_time)
+    except (TypeError, ValueError):
+        return 'wallTime must be an integer number of seconds.'
+    if isinstance(wall_time, bool) or seconds <= 0:
+        return 'wallTime must be a positive number of seconds.'
+    return None
+
+
+def job_record(arguments, user):
+    """Job document of a POST /api/jobs body."""
+    priority_class = arguments.get('priorityClass', None) or settings.default_priority_class
+    return {
+        'name': arguments.get('name'),
+        'node': arguments.get('node', None),
+        'user': user,
+        'command': arguments.get('command'),
+        'gpuNum': int(arguments.get('gpuNum')),
+        'repo': arguments.get('repo', None),
+        'branch': arguments.get('branch', None),
+        'commit': arguments.get('commit', None),
+        'comments': arguments.get('comments', None),
+        'image': arguments.get('image'),
+        'status': 'fetching',
+        'tensorboard': False,
+        'hide': False,
+        'volumeMounts': arguments.get('volumeMounts', []),
+        'cpuLimit': arguments.get('cpuLimit', None),
+        'memoryLimit': arguments.get('memoryLimit', None),
+        'autoRestart': arguments.get('autoRestart', False),
+        'priorityClass': priority_class,
+        'priority': settings.priority_classes.get(priority_class, 0),  # a raw `priority` is ignored, it could preempt anyone
+        'wallTime': int(arguments['wallTime']) if arguments.get('wallTime', None) else None,  # seconds
+    }
+
+
+def jobs_query(handler):
+    """Filter of /api/jobs from the request arguments: hide, fav, status, tag, user[] & node[]."""
+    hide = handler.get_argument('hide', None)
+    fav = handler.get_argument('fav', None)
+    status = handler.get_argument('status', None)
+    tags = handler.get_arguments('tag')
+    user = handler.get_arguments('user[]')
+    node = handler.get_arguments('node[]')
+
+    query = {}
+
+    # hide
+    if hide is None:  # default is False
+        query['hide'] = False
+    elif hide != 'all':  # 'all' means no filter
+        query['hide'] = False if hide == '0' else True
+
+    # tags
+    if tags:
+        query['tags'] = {'$all': tags}
+
+    # fav
+    if fav:
+        query['fav'] = True if fav == '1' else False
+
+    # status; Running etc.
+    if status:
+        if status == '$RunningExtra':
+            query.pop('hide', None)
+            query['status'] = {'$nin': ['Completed', 'ManualStop', 'FetchError', 'CreateError']}
+        else:
+            query['status'] = status
+    # user
+    if user:
+        query['user'] = {'$in': user}
+
+    # node
+    if node:
+        query['node'] = {'$in': node}
+
+    if status == '$RunningExtra':
+        query = {'$or': [query, {'tensorboard': True}]}
+    return query
 
 
 class JobsHandler(BaseHandler):
 
-    __job_name_pattern = re.compile(r'^[a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*$')
+    __count_cache = {}  # query -> (time, count), shared by all requests
 
-    def initialize(self, k8s_client, mongo_client):
+    def initialize(self, k8s_client, db):
         self.k8s_client = k8s_client
-        self.mongo_client = mongo_client
-        self.jobs_collection = mongo_client.ktqueue.jobs
+        self.db = db
+        self.jobs_collection = db.jobs
 
     @convert_asyncio_task
     @apiauthenticated
@@ -187,131 +317,65 @@ class JobsHandler(BaseHandler):
 
         name = body_arguments.get('name')
 
-        if len(name) > 58:  # kubernetes doesn't accept name longer than 64. 64 - 6 (pod name suffix) = 58
+        message = check_job_name(name) or check_priority_class(body_arguments.get('priorityClass', None)) or \
+            check_wall_time(body_arguments.get('wallTime', None))
+        if message:
             self.set_status(400)
-            self.finish({"message": "job name too long(>58)."})
-            return
-
-        if not self.__job_name_pattern.match(name):
-            self.set_status(400)
-            self.finish(
-                {"message": "illegal task name, regex used for validation is [a-z0-9]([-a-z0-9]*[a-z0-9])?(\.[a-z0-9]([-a-z0-9]*[a-z0-9])?)*"})
+            self.finish({"message": message})
             return
 
         # job with same name is forbidden
-        if self.jobs_collection.find_one({'name': name}):
+        if await self.jobs_collection.find_one({'name': name}):
             self.set_status(400)
             self.finish(json.dumps({'message': 'Job {} already exists'.format(name)}))
             return
 
-        command = body_arguments.get('command')
-        node = body_arguments.get('node', None)
-        gpu_num = int(body_arguments.get('gpuNum'))
-        image = body_arguments.get('image')
-        repo = body_arguments.get('repo', None)
-        branch = body_arguments.get('branch', None)
-        commit_id = body_arguments.get('commit', None)
-        comments = body_arguments.get('comments', None)
-        mounts = body_arguments.get('volumeMounts', [])
-        cpu_limit = body_arguments.get('cpuLimit', None)
-        memory_limit = body_arguments.get('memoryLimit', None)
-        auto_restart = body_arguments.get('autoRestart', False)
-
-        job_dir = os.path.join('/cephfs/ktqueue/jobs/', name)
-
-        job = generate_job(
-            name=name, command=command, node=node, gpu_num=gpu_num, image=image,
-            repo=repo, branch=branch, commit_id=commit_id, comments=comments,
-            mounts=mounts, cpu_limit=cpu_limit, memory_limit=memory_limit,
-            auto_restart=auto_restart
-        )
+        record = job_record(body_arguments, user)
+        ret = await self.jobs_collection.update_one({'name': name}, {'$set': record}, upsert=True)
+        get_change_feed().publish_job(name, dict(record, _id=ret.upserted_id) if ret.upserted_id else record)
 
-        self.jobs_collection.update_one({'name': name}, {'$set': {
-            'name': name,
-            'node': node,
-            'user': user,
-            'command': command,
-            'gpuNum': gpu_num,
-            'repo': repo,
-            'branch': branch,
-            'commit': commit_id,
-            'comments': comments,
-            'image': image,
-            'status': 'fetching',
-            'tensorboard': False,
-            'hide': False,
-            'volumeMounts': mounts,
-            'cpuLimit': cpu_limit,
-            'memoryLimit': memory_limit,
-        }}, upsert=True)
+        # clone code & create job in background, see SubmissionQueue
+        await get_submission_queue().enqueue(job_name=name, user=user, stage='clone')
         self.finish(json.dumps({'message': 'job {} successful created.'.format(name)}))
 
-        # clone code
-        await clone_code(
-            name=name, repo=repo, branch=branch, commit_id=commit_id,
-            jobs_collection=self.jobs_collection, job_dir=job_dir,
-            crediential=KTQueueDefaultCredentialProvider(repo=repo, user=user, mongo_client=self.mongo_client))
-
-        ret = await self.k8s_client.call_api(
-            api='/apis/batch/v1/namespaces/{namespace}/jobs'.format(namespace=settings.job_namespace),
-            method='POST',
-            data=job
-        )
-        try:
-            self.jobs_collection.update_one({'name': name}, {'$set': {
-                'status': 'pending',
-                'creationTimestamp': ret['metadata']['creationTimestamp'],
-            }}, upsert=True)
-        except Exception as e:
-            logging.info(ret)
-            logging.exception(e)
-
     async def get(self):
+        """List jobs, newest first.
+            pagination: `page` & `pageSize`, or `cursor` (nextCursor of last response) & `pageSize`,
+                cursor is much faster for deep pages.
+            fields: comma separated fields to return, e.g. fields=name,status,user, default is all fields.
+            total: 'exact' (default with page), 'cached' (default with cursor) or 'none'.
+        """
         page = int(self.get_argument('page', 1))
         page_size = int(self.get_argument('pageSize', 20))
-        hide = self.get_argument('hide', None)
-        fav = self.get_argument('fav', None)
-        status = self.get_argument('status', None)
-        tags = self.get_arguments('tag')
-        user = self.get_arguments('user[]')
-        node = self.get_arguments('node[]')
-
-        query = {}
-
-        # hide
-        if hide is None:  # default is False
-            query['hide'] = False
-        elif hide != 'all':  # 'all' means no filter
-            query['hide'] = False if hide == '0' else True
-
-        # tags
-        if tags:
-            query['tags': {'$all': tags}]
-
-        # fav
-        if fav:
-            query['fav'] = True if fav == '1' else False
-
-        # status; Running etc.
-        if status:
-            if status == '$RunningExtra':
-                query.pop('hide', None)
-                query['status'] = {'$nin': ['Completed', 'ManualStop', 'FetchError']}
-            else:
-                query['status'] = status
-        # user
-        if user:
-            query['user'] = {'$in': user}
-
-        # node
-        if node:
-            query['node'] = {'$in': node}
+        cursor = self.get_argument('cursor', None)
+        fields = self.get_argument('fields', None)
+        total = self.get_argument('total', 'cached' if cursor else 'exact')
+        if cursor:
+            try:
+                cursor = bson.ObjectId(cursor)
+            except bson.errors.InvalidId:
+                self.set_status(400)
+                self.finish({'message': 'invalid cursor'})
+                return
+        query = jobs_query(self)
+
+        if total == 'exact':
+            count = await self.jobs_collection.count(query)
+        elif total == 'cached':
+            count = await self.cached_count(query)
+        else:
+            count = None
 
-        if status == '$RunningExtra':
-            query = {'$or': [query, {'tensorboard': True}]}
+        projection = None
+        if fields:
+            projection = [field.strip() for field in fields.split(',') if field.strip()]
 
-        count = self.jobs_collection.count(query)
-        jobs = list(self.jobs_collection.find(query).sort("_id", -1).skip(page_size * (page - 1)).limit(page_size))
+        if cursor:
+            query['_id'] = {'$lt': cursor}
+            jobs = await self.jobs_collection.find(query, projection, sort=[('_id', -1)], limit=page_size)
+        else:
+            jobs = await self.jobs_collection.find(
+                query, projection, sort=[('_id', -1)], skip=page_size * (page - 1), limit=page_size)
         for job in jobs:
             job['_id'] = str(job['_id'])
         self.finish(json.dumps({
@@ -319,7 +383,20 @@ class JobsHandler(BaseHandler):
             'total': count,
             'pageSize': page_size,
             'data': jobs,
-        }))
+            'nextCursor': jobs[-1]['_id'] if len(jobs) == page_size else None,
+        }, default=json_default))
+
+    async def cached_count(self, query):
+        """count(query), cached for settings.jobs_count_cache_ttl seconds."""
+        key = json.dumps(query, sort_keys=True, default=str)
+        now = time.time()
+        if key in self.__count_cache and now - self.__count_cache[key][0] < settings.jobs_count_cache_ttl:
+            return self.__count_cache[key][1]
+        count = await self.jobs_collection.count(query)
+        if len(self.__count_cache) > 1000:
+            self.__count_cache.clear()
+        self.__count_cache[key] = (now, count)
+        return count
 
     @apiauthenticated
     async def put(self):
@@ -329,14 +406,222 @@ class JobsHandler(BaseHandler):
         body_arguments = json.loads(self.request.body.decode('utf-8'))
 
         allowedFields = ['hide', 'comments', 'tags', 'fav']
-        job = self.jobs_collection.find_one({'_id': bson.ObjectId(body_arguments['_id'])})
+        job = await self.jobs_collection.find_one({'_id': bson.ObjectId(body_arguments['_id'])})
         if job['status'] in ('ManualStop', 'Completed'):
             allowedFields += ['node', 'gpuNum', 'image', 'command', 'volumeMounts', 'cpuLimit', 'memoryLimit']
         update_data = {k: v for k, v in body_arguments.items() if k in allowedFields}
-        self.jobs_collection.update_one({'_id': bson.ObjectId(body_arguments['_id'])}, {'$set': update_data})
-        ret = self.jobs_collection.find_one({'_id': bson.ObjectId(body_arguments['_id'])})
+        await self.jobs_collection.update_one({'_id': bson.ObjectId(body_arguments['_id'])}, {'$set': update_data})
+        get_change_feed().publish_job(job['name'], update_data)
+        ret = await self.jobs_collection.find_one({'_id': bson.ObjectId(body_arguments['_id'])})
         ret['_id'] = str(ret['_id'])
-        self.finish(ret)
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.finish(json.dumps(ret, default=json_default))
+
+
+class JobSearchHandler(BaseHandler):
+
+    def initialize(self, db):
+        self.jobs_collection = db.jobs
+
+    async def get(self):
+        """Search jobs, combined with the filters of /api/jobs.
+            q: full-text search over name, comments, command, image & repo, ranked by relevance.
+            prefix: jobs whose name starts with `prefix`, sorted by name.
+            pagination: `cursor` (nextCursor of last response) & `pageSize`.
+            fields: comma separated fields to return, default is all fields.
+        """
+        q = self.get_argument('q', '').strip()
+        prefix = self.get_argument('prefix', '')
+        page_size = min(int(self.get_argument('pageSize', 20)), 200)
+        cursor = self.get_argument('cursor', None)
+        fields = self.get_argument('fields', None)
+        if not q and not prefix:
+            self.set_status(400)
+            self.finish({'message': 'q or prefix is required'})
+            return
+
+        query = jobs_query(self)
+        projection = None
+        if fields:
+            projection = [field.strip() for field in fields.split(',') if field.strip()]
+
+        try:
+            if q:
+                if prefix:
+                    query['name'] = search.prefix_filter(prefix)
+                jobs = await self.jobs_collection.aggregate(
+                    search.text_pipeline(q, query, projection, cursor=cursor, limit=page_size))
+            else:
+                if projection:
+                    projection.append('name')
+                jobs = await self.jobs_collection.find(
+                    search.prefix_query(prefix, query, cursor=cursor), projection,
+                    sort=[('name', 1)], limit=page_size)
+        except (ValueError, bson.errors.InvalidId):
+            self.set_status(400)
+            self.finish({'message': 'invalid cursor'})
+            return
+        next_cursor = search.encode_cursor(jobs[-1], bool(q)) if len(jobs) == page_size else None
+        for job in jobs:
+            job['_id'] = str(job['_id'])
+        self.finish(json.dumps({
+            'pageSize': page_size,
+            'data': jobs,
+            'nextCursor': next_cursor,
+        }, default=json_default))
+
+
+class BatchJobsHandler(BaseHandler):
+    """Create a batch of jobs from a template, e.g. a parameter sweep."""
+
+    __placeholder_fields = ('name', 'command', 'comments')
+
+    def initialize(self, k8s_client, db):
+        self.k8s_client = k8s_client
+        self.db = db
+        self.jobs_collection = db.jobs
+
+    @classmethod
+    def expand(cls, template, matrix, params):
+        """Job arguments for every parameter set, `{key}` in name, command & comments is replaced by its value."""
+        param_sets = list(params or [])
+        if matrix:
+            keys = sorted(matrix)
+            param_sets.extend(dict(zip(keys, values)) for values in itertools.product(*[matrix[key] for key in keys]))
+
+        jobs = []
+        for index, param_set in enumerate(param_sets):
+            arguments = dict(template)
+            for field in cls.__placeholder_fields:
+                if isinstance(arguments.get(field, None), str):
+                    for key, value in param_set.items():
+                        arguments[field] = arguments[field].replace('{' + key + '}', str(value))
+            if arguments.get('name', None) == template.get('name', None):
+                arguments['name'] = '{}-{}'.format(template.get('name', None), index)
+            jobs.append(arguments)
+        return jobs
+
+    @convert_asyncio_task
+    @apiauthenticated
+    async def post(self):
+        """
+        Create jobs from a template and a parameter matrix, the code is fetched only once.
+        e.x. request:
+            {
+                "template": {
+                    "name": "sweep-lr{lr}-bs{bs}",
+                    "command": "python3 train.py --lr {lr} --batch-size {bs}",
+                    "gpuNum": 1,
+                    "image": "comzyh/tf_image",
+                    "repo": "https://github.com/comzyh/TF_Docker_Images.git",
+                    "branch": "master"
+                },
+                "matrix": {"lr": ["0.1", "0.01"], "bs": [32, 64]}
+            }
+        "params": [{"lr": "0.1", "bs": 32}, ...] can be used instead of (or with) "matrix".
+        `-<index>` is appended to the name if it has no placeholder.
+        response:
+            {
+                "batch": "<batch id>",
+                "results": [{"name": "sweep-lr0.1-bs32", "ok": true}, {"name": ..., "ok": false, "message": ...}]
+            }
+        """
+        user = self.get_current_user()
+        body_arguments = json.loads(self.request.body.decode('utf-8'))
+        template = body_arguments.get('template', {})
+        jobs = self.expand(template, body_arguments.get('matrix', None), body_arguments.get('params', None))
+
+        if not jobs:
+            self.set_status(400)
+            self.finish({'message': 'no job in batch.'})
+            return
+        if len(jobs) > settings.batch_max_jobs:
+            self.set_status(400)
+            self.finish({'message': 'too many jobs in batch(>{}).'.format(settings.batch_max_jobs)})
+            return
+
+        results = [{'name': arguments['name'], 'ok': True} for arguments in jobs]
+
+        def reject(index, message):
+            results[index]['ok'] = False
+            results[index]['message'] = message
+
+        seen = set()
+        for index, arguments in enumerate(jobs):
+            message = check_job_name(arguments['name']) or check_priority_class(arguments.get('priorityClass', None)) or \
+                check_wall_time(arguments.get('wallTime', None))
+            if message is None and arguments['name'] in seen:
+                message = 'duplicated job name {} in batch.'.format(arguments['name'])
+            if message is None:
+                try:
+                    int(arguments.get('gpuNum'))
+                except (TypeError, ValueError):
+                    message = 'gpuNum must be an integer.'
+            if message:
+                reject(index, message)
+            seen.add(arguments['name'])
+
+        # job with same name is forbidden
+        names = [arguments['name'] for arguments, result in zip(jobs, results) if result['ok']]
+        existing = await self.jobs_collection.find({'name': {'$in': names}}, projection={'name': True})
+        existing = {job['name'] for job in existing}
+        for index, arguments in enumerate(jobs):
+            if results[index]['ok'] and arguments['name'] in existing:
+                reject(index, 'Job {} already exists'.format(arguments['name']))
+
+        indices = [index for index, result in enumerate(results) if result['ok']]
+        if not indices:
+            self.set_status(400)
+            self.finish({'message': 'no job can be created.', 'results': results})
+            return
+
+        # fetch & archive the commit once for the whole batch
+        batch = str(bson.ObjectId())
+        archive = None
+        repo = template.get('repo', None)
+        if repo:
+            crediential = KTQueueDefaultCredentialProvider(repo=repo, user=user, db=self.db)
+            try:
+                await crediential.prepare_credential()
+                cloner = Cloner(repo=repo, dst_directory=None, branch=template.get('branch', None),
+                                commit_id=template.get('commit', None), crediential=crediential)
+                archive = await cloner.archive('/cephfs/ktqueue/repo_archive/batch-{}.tar.gz'.format(batch))
+            except Exception as e:
+                logging.exception(e)
+                self.set_status(400)
+                self.finish({'message': 'fetch {} failed: {}'.format(repo, e)})
+                return
+
+        docs = []
+        for index in indices:
+            doc = job_record(jobs[index], user)
+            doc['batch'] = batch
+            if archive:
+                doc['commit'] = cloner.commit_id
+            docs.append(doc)
+        write_failed = False
+        try:
+            await self.jobs_collection.insert_many(docs, ordered=False)
+        except pymongo.errors.BulkWriteError as e:
+            for error in e.details['writeErrors']:
+                if error['code'] == 11000:  # created by someone else meanwhile
+                    reject(indices[error['index']], 'Job {} already exists'.format(docs[error['index']]['name']))
+                else:
+                    logging.error('insert job {} failed: {}'.format(docs[error['index']]['name'], error['errmsg']))
+                    reject(indices[error['index']], error['errmsg'])
+                    write_failed = True
+
+        # clone code & create job in background, see SubmissionQueue
+        names = [result['name'] for result in results if result['ok']]
+        created = set(names)
+        get_change_feed().publish([{'type': 'job', 'name': doc['name'], 'update': doc}
+                                   for doc in docs if doc['name'] in created])
+        await get_submission_queue().enqueue_many(job_names=names, user=user, stage='clone', archive=archive)
+        if archive and not names:
+            await fs.remove(archive)
+        if write_failed:
+            self.set_status(500)
+        self.finish({'batch': batch, 'results': results})
 
 
 class JobLogVersionHandler(tornado.web.RequestHandler):
@@ -347,13 +632,9 @@ class JobLogVersionHandler(tornado.web.RequestHandler):
     @convert_asyncio_task
     async def get(self, job):
         from ktqueue.utils import get_log_versions
-        versions = get_log_versions(job)
-        pods = await self.k8s_client.call_api(
-            method='GET',
-            api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
-            params={'labelSelector': 'job-name={job}'.format(job=job)}
-        )
-        if pods.get('items', None):
+        versions = await get_log_versions(job)
+        pods = await pod_cache.get_job_pods(self.k8s_client, job)
+        if pods:
             versions = ['current'] + versions
         self.write({
             'job': job,
@@ -361,46 +642,151 @@ class JobLogVersionHandler(tornado.web.RequestHandler):
         })
 
 
+def parse_range(header, size):
+    """(start, end) of a single `bytes=` range, end exclusive, None if it is invalid or unsatisfiable."""
+    match = re.match(r'^bytes=(\d*)-(\d*)$', header.strip())
+    if not match or not (match.group(1) or match.group(2)):
+        return None
+    if not match.group(1):  # suffix: last N bytes
+        start, end = max(0, size - int(match.group(2))), size
+    else:
+        start = int(match.group(1))
+        end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+    if start >= size or start >= end:
+        return None
+    return start, end
+
+
 class JobLogHandler(BaseHandler):
 
-    def initialize(self, k8s_client, mongo_client):
+    def initialize(self, k8s_client, db):
         self.k8s_client = k8s_client
-        self.mongo_client = mongo_client
-        self.jobs_collection = mongo_client.ktqueue.jobs
+        self.db = db
+        self.jobs_collection = db.jobs
         self.closed = False
         self.follow = False
+        self.subscriber = None
 
     async def get_log_stream(self, job, version):
-        pods = await self.k8s_client.call_api(
-            method='GET',
-            api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
-            params={'labelSelector': 'job-name={job}'.format(job=job)}
-        )
-        if pods.get('items', None):
+        pods = await pod_cache.get_job_pods(self.k8s_client, job)
+        if pods:
             params = {}
             timeout = 60
+            session = self.k8s_client.session
             if self.follow:
                 params['follow'] = 'true'
                 tailLines = self.get_argument('tailLines', None)
                 if tailLines:
                     params['tailLines'] = tailLines
                 timeout = 0  # disable timeout checks
-            pod_name = pods['items'][0]['metadata']['name']
+                session = self.k8s_client.watch_session
+            pod_name = pods[0]['metadata']['name']
             resp = await self.k8s_client.call_api_raw(
                 method='GET',
                 api='/api/v1/namespaces/{namespace}/pods/{pod_name}/log'.format(namespace=settings.job_namespace, pod_name=pod_name),
-                params=params, timeout=timeout
+                params=params, timeout=timeout, session=session, priority=PRIORITY_HIGH
             )
             return resp
         return None
 
+    def archived_log_range(self, reader):
+        """(start, end) bytes of an archived log to send, from query arguments:
+            tailLines / headLines: last / first lines.
+            startLine & endLine: lines, 0-based, end exclusive.
+            offset & length: bytes.
+        Blocking, run it in fs executor.
+        """
+        tail_lines = self.get_argument('tailLines', None)
+        head_lines = self.get_argument('headLines', None)
+        start_line = self.get_argument('startLine', None)
+        end_line = self.get_argument('endLine', None)
+        offset = self.get_argument('offset', None)
+        length = self.get_argument('length', None)
+        if tail_lines is not None:
+            return reader.tail_offset(int(tail_lines)), reader.size
+        if head_lines is not None:
+            return 0, reader.line_offset(int(head_lines))
+        if start_line is not None or end_line is not None:
+            end = reader.line_offset(int(end_line)) if end_line is not None else reader.size
+            return reader.line_offset(int(start_line or 0)), end
+        start = min(int(offset or 0), reader.size)
+        return start, min(reader.size, start + int(length)) if length is not None else reader.size
+
+    async def send_archived_log(self, job, version):
+        """Stream an archived log version with constant memory, a segment at a time.
+            A `Range: bytes=` header is answered with 206, otherwise the log is gzipped if the client accepts it.
+        """
+        try:
+            reader = await fs.run('open_log', log_store.open_log, job, version)
+        except FileNotFoundError:
+            self.set_status(404)
+            self.finish({'message': 'log {} of job {} not found'.format(version, job)})
+            return
+        size = reader.size
+        range_header = self.request.headers.get('Range', None)
+        if range_header:
+            byte_range = parse_range(range_header, size)
+            if byte_range is None:
+                self.set_status(416)
+                self.set_header('Content-Range', 'bytes */{}'.format(size))
+                self.finish()
+                return
+            start, end = byte_range
+            self.set_status(206)
+            self.set_header('Content-Range', 'bytes {}-{}/{}'.format(start, end - 1, size))
+        else:
+            try:
+                start, end = await fs.run('log_range', self.archived_log_range, reader)
+            except ValueError:
+                self.set_status(400)
+                self.finish({'message': 'tailLines, headLines, startLine, endLine, offset & length must be integers'})
+                return
+        self.set_header('Content-Type', 'text/plain; charset=utf-8')
+        self.set_header('Accept-Ranges', 'bytes')
+        self.set_header('X-Log-Size', str(size))
+        self.set_header('X-Log-Range', '{}-{}'.format(start, end))
+
+        compressor = None
+        if not range_header and 'gzip' in self.request.headers.get('Accept-Encoding', ''):
+            compressor = zlib.compressobj(settings.log_compress_level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+            self.set_header('Content-Encoding', 'gzip')
+            self.set_header('Vary', 'Accept-Encoding')
+        else:
+            self.set_header('Content-Length', str(max(0, end - start)))
+
+        chunks = reader.read_bytes(start, end)
+
+        def next_chunk():
+            """(data, last), compressed if gzip."""
+            chunk = next(chunks, None)
+            if compressor is None:
+                return chunk or b'', chunk is None
+            if chunk is None:
+                return compressor.flush(), True
+            return compressor.compress(chunk) + compressor.flush(zlib.Z_SYNC_FLUSH), False
+
+        try:
+            last = False
+            while not last and not self.closed:
+                data, last = await fs.run('read_log', next_chunk)
+                if data:
+                    self.write(data)
+                    await self.flush()  # wait for the client before reading the next segment
+        except tornado.iostream.StreamClosedError:
+            return
+        finally:
+            chunks.close()
+        if not self.closed:
+            self.finish()
+
     @convert_asyncio_task
     async def get(self, job, version=None):
         if version and version != 'current':
-            with open(os.path.join('/cephfs/ktqueue/logs', job, 'log.{version}.txt'.format(version=version)), 'rb') as f:
-                self.finish(f.read())
+            await self.send_archived_log(job, version)
             return
         self.follow = self.get_argument('follow', None) == 'true'
+        if await self.follow_shared(job, self.send_chunk):
+            return
         resp = await self.get_log_stream(job, version)
         if resp and resp.status == 200:
             try:
@@ -413,8 +799,125 @@ class JobLogHandler(BaseHandler):
             finally:
                 resp.close()
 
+    async def send_chunk(self, chunk):
+        self.write(chunk)
+        await self.flush()
+
+    async def follow_shared(self, job, send):
+        """Follow the log through log_hub, shared with the other viewers of the pod, await `send(chunk)` for every chunk.
+            Return False if it can't be shared: not following, or not settings.log_hub_tail_lines lines asked. The
+            upstream starts with that many lines, a viewer present from the start would get them all whatever it asked.
+        """
+        tail_lines = self.get_argument('tailLines', None)
+        if not self.follow or tail_lines is None or not tail_lines.isdigit() or \
+                int(tail_lines) != settings.log_hub_tail_lines:
+            return False
+        pods = await pod_cache.get_job_pods(self.k8s_client, job)
+        if not pods:
+            return True
+        self.subscriber = log_hub.subscribe(self.k8s_client, pods[0]['metadata']['name'], int(tail_lines))
+        try:
+            while not self.closed:
+                chunk = await self.subscriber.get()
+                if chunk is None:
+                    break
+                await send(chunk)
+        except (tornado.iostream.StreamClosedError, tornado.websocket.WebSocketClosedError):
+            pass
+        finally:
+            self.subscriber.close()
+        return True
+
     def on_connection_close(self):
         self.closed = True
+        if self.subscriber is not None:
+            self.subscriber.close()
+
+
+class JobLogSearchHandler(BaseHandler):
+    """Search logs of jobs on the server, matches are streamed as JSON lines."""
+
+    __running = defaultdict(int)  # user -> searches running in this process
+
+    def initialize(self, k8s_client, db):
+        self.k8s_client = k8s_client
+        self.db = db
+        self.closed = False
+        self.search = None
+
+    @convert_asyncio_task
+    @apiauthenticated
+    async def get(self, job=None):
+        """
+            q: text to search, a regular expression with regex=true, without backreferences and nested quantifiers.
+               A regex taking more than KTQ_LOG_SEARCH_REGEX_TIMEOUT seconds on a block of a log stops the search.
+            ignoreCase: true for a case-insensitive search.
+            job: jobs to search (repeated), unless searching /api/jobs/<job>/log/search.
+            version: log versions to search (repeated, a number or current), default is all of them.
+            context: lines before and after every match.
+            maxMatches: stop after this many matches in all.
+        Every match is a line {"job", "version", "line", "text", "before", "after"}, `line` is 0-based, the last line is
+        {"done": true, "matches", "truncated", "scannedBytes", "seconds", "errors"}.
+        """
+        jobs = [job] if job else self.get_arguments('job')
+        versions = self.get_arguments('version') or None
+        try:
+            pattern = log_search.LogPattern(
+                self.get_argument('q', ''), regex=self.get_argument('regex', None) == 'true',
+                ignore_case=self.get_argument('ignoreCase', None) == 'true')
+            context = min(int(self.get_argument('context', 0)), settings.log_search_max_context)
+            max_matches = min(int(self.get_argument('maxMatches', 1000)), settings.log_search_max_matches)
+        except ValueError as e:
+            self.set_status(400)
+            self.finish({'message': str(e)})
+            return
+        if not jobs or len(jobs) > settings.log_search_max_jobs or context < 0 or max_matches <= 0:
+            self.set_status(400)
+            self.finish({'message': '1 to {} jobs, context >= 0 & maxMatches > 0 are required'.format(
+                settings.log_search_max_jobs)})
+            return
+        user = self.get_current_user()
+        if self.__running[user] >= settings.log_search_per_user:
+            self.set_status(429)
+            self.finish({'message': 'too many searches running(>={}).'.format(settings.log_search_per_user)})
+            return
+        self.__running[user] += 1
+        try:
+            await self.search_logs(jobs, versions, pattern, context, max_matches)
+        finally:
+            self.__running[user] -= 1
+            if not self.__running[user]:
+                del self.__running[user]
+
+    async def search_logs(self, jobs, versions, pattern, context, max_matches):
+        start = time.time()
+        sources = await log_search.log_sources(self.db, self.k8s_client, jobs, versions)
+        self.set_header('Content-Type', 'application/x-ndjson; charset=utf-8')
+
+        async def emit(matches):
+            try:
+                self.write(''.join(json.dumps(match) + '\n' for match in matches))
+                await self.flush()
+            except tornado.iostream.StreamClosedError:
+                self.search.stop()
+
+        self.search = log_search.LogSearch(pattern, emit, context=context, max_matches=max_matches)
+        await self.search.run(sources, self.k8s_client)
+        if self.closed:
+            return
+        self.finish(json.dumps({
+            'done': True,
+            'matches': self.search.matches,
+            'truncated': self.search.truncated,
+            'scannedBytes': self.search.scanned_bytes,
+            'seconds': time.time() - start,
+            'errors': self.search.errors,
+        }) + '\n')
+
+    def on_connection_close(self):
+        self.closed = True
+        if self.search is not None:
+            self.search.stop()
 
 
 class JobLogWSHandler(tornado.websocket.WebSocketHandler, JobLogHandler):
@@ -428,6 +931,9 @@ class JobLogWSHandler(tornado.websocket.WebSocketHandler, JobLogHandler):
     @convert_asyncio_task
     async def open(self, job):
         self.follow = True
+        if await self.follow_shared(job, self.write_message):
+            self.close()
+            return
         resp = await self.get_log_stream(job, 'current')
         if resp and resp.status == 200:
             try:
@@ -442,6 +948,8 @@ class JobLogWSHandler(tornado.websocket.WebSocketHandler, JobLogHandler):
 
     def on_close(self):
         self.closed = True
+        if self.subscriber is not None:
+            self.subscriber.close()
 
     def on_message(self):
         pass
@@ -449,67 +957,50 @@ class JobLogWSHandler(tornado.websocket.WebSocketHandler, JobLogHandler):
 
 class StopJobHandler(BaseHandler):
 
-    def initialize(self, k8s_client, mongo_client):
+    def initialize(self, k8s_client, db):
         self.k8s_client = k8s_client
-        self.mongo_client = mongo_client
-        self.jobs_collection = mongo_client.ktqueue.jobs
+        self.db = db
+        self.jobs_collection = db.jobs
 
     @convert_asyncio_task
     @apiauthenticated
     async def post(self, job):
+        await get_submission_queue().cancel(job)
         await k8s_delete_job(self.k8s_client, job)
-        self.jobs_collection.update_one({'name': job}, {'$set': {'status': 'ManualStop'}})
+        await self.jobs_collection.update_one({'name': job}, {'$set': {'status': 'ManualStop'}})
+        get_change_feed().publish_job(job, {'status': 'ManualStop'})
         self.finish({'message': 'Job {} successful deleted.'.format(job)})
 
 class RestartJobHandler(BaseHandler):
 
-    def initialize(self, k8s_client, mongo_client):
+    def initialize(self, k8s_client, db):
         self.k8s_client = k8s_client
-        self.mongo_client = mongo_client
-        self.jobs_collection = mongo_client.ktqueue.jobs
+        self.db = db
+        self.jobs_collection = db.jobs
 
     @convert_asyncio_task
     @apiauthenticated
     async def post(self, job):
         job_name = job
         await k8s_delete_job(self.k8s_client, job_name)
-        job = defaultdict(lambda: None)
-        job.update(self.jobs_collection.find_one({'name': job_name}))
-        job_dir = os.path.join('/cephfs/ktqueue/jobs/', job['name'])
-
-        job_description = generate_job(
-            name=job['name'], command=job['command'], node=job['node'], gpu_num=job['gpuNum'], image=job['image'],
-            repo=job['name'], branch=job['command'], commit_id=job['commit'], comments=job['comments'],
-            mounts=job['volumeMounts'], cpu_limit=job['cpuLimit'], memory_limit=job['memoryLimit'],
-        )
-
-        if job['status'] == 'FetchError':
-            self.jobs_collection.update_one({'name': job}, {'$set': {'status': 'fetching'}})
-
+        job = await self.jobs_collection.find_one({'name': job_name})
+
+        # Refetch if fetching failed last time
+        submission_queue = get_submission_queue()
+        stage = 'clone' if job['status'] == 'FetchError' else submission_queue.after_clone
+        if stage == 'schedule':  # other stages set the status when they run
+            await self.jobs_collection.update_one({'name': job_name}, {'$set': {'status': 'queued'}})
+            get_change_feed().publish_job(job_name, {'status': 'queued'})
+        await submission_queue.enqueue(job_name=job_name, user=self.get_current_user(), stage=stage)
         self.finish({'message': 'job {} successful restarted.'.format(job['name'])})
 
-        # Refetch
-        if job['status'] == 'FetchError':
-            await clone_code(
-                name=job['name'], repo=job['repo'], branch=job['branch'], commit_id=job['commit'],
-                jobs_collection=self.jobs_collection, job_dir=job_dir,
-                crediential=KTQueueDefaultCredentialProvider(
-                    repo=job['repo'], user=self.get_current_user(), mongo_client=self.mongo_client
-                ))
-
-        await self.k8s_client.call_api(
-            api='/apis/batch/v1/namespaces/{namespace}/jobs'.format(namespace=settings.job_namespace),
-            method='POST',
-            data=job_description
-        )
-
 
 class TensorBoardHandler(BaseHandler):
 
-    def initialize(self, k8s_client, mongo_client):
+    def initialize(self, k8s_client, db):
         self.k8s_client = k8s_client
-        self.mongo_client = mongo_client
-        self.jobs_collection = mongo_client.ktqueue.jobs
+        self.db = db
+        self.jobs_collection = db.jobs
 
     @convert_asyncio_task
     @apiauthenticated
@@ -519,7 +1010,7 @@ class TensorBoardHandler(BaseHandler):
         command = 'tensorboard --logdir {logdir} --host 0.0.0.0'.format(logdir=logdir)
 
         job_record = defaultdict(lambda: None)
-        job_record.update(self.jobs_collection.find_one({'name': job}))
+        job_record.update(await self.jobs_collection.find_one({'name': job}))
         job_description = generate_job(
             name=job_record['name'], command=command, node=job_record['node'], gpu_num=0, image=job_record['image'],
             repo=None, branch=None, commit_id=None, comments=None, mounts=job_record['volumeMounts'],
@@ -548,7 +1039,8 @@ class TensorBoardHandler(BaseHandler):
             data=pod
         )
         if 'metadata' in ret and 'creationTimestamp' in ret['metadata']:
-            self.jobs_collection.update_one({'name': job}, {'$set': {'tensorboard': True}})
+            await self.jobs_collection.update_one({'name': job}, {'$set': {'tensorboard': True}})
+            get_change_feed().publish_job(job, {'tensorboard': True})
         else:
             self.set_status(500)
 
@@ -557,13 +1049,9 @@ class TensorBoardHandler(BaseHandler):
     @convert_asyncio_task
     @apiauthenticated
     async def delete(self, job):
-        pods = await self.k8s_client.call_api(
-            method='GET',
-            api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
-            params={'labelSelector': 'ktqueue-tensorboard-job-name={job}'.format(job=job)}
-        )
-        if pods.get('items', None):
-            pod_name = pods['items'][0]['metadata']['name']
+        pods = await pod_cache.get_tensorboard_pods(self.k8s_client, job)
+        if pods:
+            pod_name = pods[0]['metadata']['name']
             ret = await self.k8s_client.call_api(
                 api='/api/v1/namespaces/{namespace}/pods/{name}'.format(namespace=settings.job_namespace, name=pod_name),
                 method='DELETE',
@@ -572,4 +1060,5 @@ class TensorBoardHandler(BaseHandler):
         else:
             self.set_status(404)
             self.write({'message': 'tensorboard pod not found.'})
-        self.jobs_collection.update_one({'name': job}, {'$set': {'tensorboard': False}})
+        await self.jobs_collection.update_one({'name': job}, {'$set': {'tensorboard': False}})
+        get_change_feed().publish_job(job, {'tensorboard': False})
@@ -0,0 +1,120 @@
+# encoding: utf-8
+import json
+
+import tornado.web
+import tornado.websocket
+import tornado.iostream
+
+from ktqueue.change_feed import get_change_feed
+from .utils import convert_asyncio_task
+from .utils import json_default
+
+
+class JobEventsMixin:
+    """Push job & node changes to a client, see ChangeFeed for the format.
+
+    A client connecting without `since` first gets {"type": "hello", "revision": N},
+    N is the revision to resume from after loading /api/jobs and /api/nodes.
+    If the changes after `since` are no longer kept, or `since` is not a revision, {"type": "reset", "revision": N}
+    is sent, client should reload the lists.
+    """
+
+    closed = False
+    queue = None
+
+    async def send_change(self, change):
+        raise NotImplementedError
+
+    @staticmethod
+    def parse_since(since):
+        """Revision of `since` from the request, -1 if it is malformed."""
+        if since is None:
+            return None
+        try:
+            revision = int(since)
+        except ValueError:
+            return -1
+        return revision if revision >= 0 else -1
+
+    async def stream_changes(self, since):
+        """Send changes after revision `since`, None for a new client, -1 to reset the client."""
+        feed = get_change_feed()
+        self.queue = feed.subscribe()
+        last = since
+        try:
+            if last is None or last < 0:
+                last = feed.revision or 0
+                await self.send_change({'type': 'hello' if since is None else 'reset', 'revision': last})
+            while not self.closed:
+                changes = await feed.changes_since(last)
+                if changes is None:
+                    last = feed.revision
+                    await self.send_change({'type': 'reset', 'revision': last})
+                    changes = []
+                for change in changes:
+                    await self.send_change(change)
+                    last = change['revision']
+
+                while not self.closed:
+                    change = await self.queue.get()
+                    if change is None:  # too slow, resubscribe and catch up from `last`
+                        self.queue = feed.subscribe()
+                        break
+                    if change['revision'] <= last:
+                        continue
+                    await self.send_change(change)
+                    last = change['revision']
+        finally:
+            feed.unsubscribe(self.queue)
+
+    def stop_streaming(self):
+        self.closed = True
+        if self.queue is not None:
+            get_change_feed().unsubscribe(self.queue)
+            if not self.queue.full():
+                self.queue.put_nowait(None)
+
+
+class JobEventsWSHandler(tornado.websocket.WebSocketHandler, JobEventsMixin):
+    """WebSocket /wsapi/jobs?since=<revision>"""
+
+    def check_origin(self, origin):
+        return True
+
+    async def send_change(self, change):
+        await self.write_message(json.dumps(change, default=json_default))
+
+    @convert_asyncio_task
+    async def open(self):
+        since = self.get_argument('since', None)
+        try:
+            await self.stream_changes(self.parse_since(since))
+        except tornado.websocket.WebSocketClosedError:
+            pass
+
+    def on_close(self):
+        self.stop_streaming()
+
+    def on_message(self, message):
+        pass
+
+
+class JobEventsHandler(tornado.web.RequestHandler, JobEventsMixin):
+    """Server-Sent Events /api/jobs/events, resume with `Last-Event-ID` header or `since`"""
+
+    async def send_change(self, change):
+        self.write('id: {}\ndata: {}\n\n'.format(change['revision'], json.dumps(change, default=json_default)))
+        await self.flush()
+
+    @convert_asyncio_task
+    async def get(self):
+        since = self.request.headers.get('Last-Event-ID', None) or self.get_argument('since', None)
+        self.set_header('Content-Type', 'text/event-stream')
+        self.set_header('Cache-Control', 'no-cache')
+        try:
+            await self.stream_changes(self.parse_since(since))
+        except tornado.iostream.StreamClosedError:
+            pass
+
+    def on_connection_close(self):
+        self.stop_streaming()
@@ -0,0 +1,39 @@
+# encoding: utf-8
+import os
+
+import tornado.web
+
+from ktqueue.event_watcher import event_watchers
+from ktqueue.event_watcher import pod_dispatcher
+from ktqueue.fs import fs
+from ktqueue.log_hub import log_hub
+from ktqueue.log_search import search_pool
+from ktqueue.log_shipper import get_log_shipper
+from ktqueue.pod_cache import pod_cache
+from ktqueue.status_writer import get_status_writer
+from ktqueue.submission import get_submission_queue
+
+
+class MetricsHandler(tornado.web.RequestHandler):
+    """Latency histograms & counters of the process serving the request."""
+
+    def initialize(self, k8s_client):
+        self.k8s_client = k8s_client
+
+    def get(self):
+        self.write({
+            'pid': os.getpid(),
+            'fs': fs.latency.to_dict(),
+            'kubernetes': {
+                'latency': self.k8s_client.latency.to_dict(),
+                'counters': dict(self.k8s_client.counters),
+            },
+            'podCache': dict(pod_cache.counters),
+            'statusWriter': dict(get_status_writer().counters, pending=len(get_status_writer().pending)),
+            'watchers': {name: dict(watcher.counters) for name, watcher in event_watchers.items()},
+            'podEvents': pod_dispatcher.stats(),
+            'logHub': log_hub.stats(),
+            'logSearch': dict(search_pool.counters),
+            'logShipper': dict(get_log_shipper().counters),
+            'submissions': dict(get_submission_queue().counters),
+        })
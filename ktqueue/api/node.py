@@ -4,34 +4,72 @@ from collections import defaultdict
 import tornado.web
 
 from .utils import convert_asyncio_task
+from ktqueue.node_inventory import node_inventory
+from ktqueue.node_inventory import compact_node
 
 node_used_gpus = defaultdict(lambda: dict())
 
 
+def node_item(node):
+    gpu_jobs = node_used_gpus.get(node['name'], {})
+    item = dict(node)
+    item['gpu_used'] = sum(gpu_jobs.values())
+    item['jobs'] = dict(gpu_jobs)
+    return item
+
+
 class NodesHandler(tornado.web.RequestHandler):
+    """Nodes are served from node_inventory, the ETag is the inventory revision."""
 
-    def initialize(self, k8s_client, mongo_client):
+    def initialize(self, k8s_client, db):
         self.k8s_client = k8s_client
-        self.mongo_client = mongo_client
+        self.db = db
 
     @convert_asyncio_task
     async def get(self):
-        def used_gpus(node):
-            result = 0
-            for job, num in node_used_gpus[node].items():
-                result += num
-            return result
-
-        ret = await self.k8s_client.call_api(
-            api='/api/v1/nodes',
-            method='GET',
-        )
-
-        self.write({'items': [{
-            'name': node['metadata']['name'],
-            'labels': node['metadata']['labels'],
-            'gpu_used': used_gpus(node['metadata']['name']),
-            'jobs': node_used_gpus[node['metadata']['name']],
-            'gpu_capacity': node['status']['capacity'].get('nvidia.com/gpu', 0),
-        } for node in ret['items']
-        ]})
+        if not node_inventory.synced:  # node watch has not listed yet
+            ret = await self.k8s_client.call_api(
+                api='/api/v1/nodes',
+                method='GET',
+            )
+            self.write({'items': [node_item(compact_node(node)) for node in ret['items']]})
+            return
+
+        self.set_header('Etag', '"{}"'.format(node_inventory.cursor))
+        if self.check_etag_header():
+            self.set_status(304)
+            return
+        self.write({
+            'revision': node_inventory.cursor,
+            'items': [node_item(node) for name, node in sorted(node_inventory.nodes.items())],
+        })
+
+
+class NodesDeltaHandler(tornado.web.RequestHandler):
+    """Return the nodes changed after `since`, the `revision` of a previous response.
+        If `since` is too old or comes from another process (KTQ_WORKERS > 1, several replicas),
+        all nodes are returned with `reset` = true.
+    """
+
+    def get(self):
+        if not node_inventory.synced:
+            self.set_status(503)
+            self.write({'message': 'node inventory is not ready.'})
+            return
+        since = node_inventory.parse_cursor(self.get_argument('since', None))
+        changes = node_inventory.changed_since(since) if since is not None else None
+        if changes is None:
+            self.write({
+                'revision': node_inventory.cursor,
+                'reset': True,
+                'items': [node_item(node) for name, node in sorted(node_inventory.nodes.items())],
+                'deleted': [],
+            })
+            return
+        changed, deleted = changes
+        self.write({
+            'revision': node_inventory.cursor,
+            'reset': False,
+            'items': [node_item(node_inventory.nodes[name]) for name in changed],
+            'deleted': deleted,
+        })
@@ -13,8 +13,8 @@ class GithubOAuth2StartHandler(tornado.web.RequestHandler, tornado.auth.OAuth2Mi
     _OAUTH_AUTHORIZE_URL = 'https://github.com/login/oauth/authorize'
     _OAUTH_ACCESS_TOKEN_URL = 'https://github.com/login/oauth/access_token'
 
-    def initialize(self, mongo_client):
-        self.mongo_client = mongo_client
+    def initialize(self, db):
+        self.db = db
 
     async def get(self):
         code = self.get_argument('code', None)
@@ -53,7 +53,7 @@ class GithubOAuth2StartHandler(tornado.web.RequestHandler, tornado.auth.OAuth2Mi
                 'access_token': access_token,
                 'data': resp
             }
-            self.mongo_client.ktqueue.oauth.update_one(
+            await self.db.oauth.update_one(
                 {'provider': 'github', 'id': resp['login']},
                 {'$set': data},
                 upsert=True
@@ -0,0 +1,14 @@
+# encoding: utf-8
+import tornado.web
+
+from ktqueue.migrations import get_migration_runner
+
+
+class ReadyHandler(tornado.web.RequestHandler):
+    """503 until indexes are built and migrations are applied, with their progress."""
+
+    def get(self):
+        status = get_migration_runner().status()
+        if not status['ready']:
+            self.set_status(503)
+        self.write(status)
@@ -15,9 +15,9 @@ class ReposHandler(BaseHandler):
     __https_pattern = re.compile(r'https:\/\/(\w+@\w+)?[\w.\/\-+]*.git')
     __ssh_pattern = re.compile(r'\w+@[\w.]+:[\w-]+\/[\w\-+]+\.git')
 
-    def initialize(self, mongo_client):
-        self.mongo_client = mongo_client
-        self.repos_collection = self.mongo_client.ktqueue.repos
+    def initialize(self, db):
+        self.db = db
+        self.repos_collection = self.db.repos
 
     @apiauthenticated
     async def post(self):
@@ -52,15 +52,15 @@ class ReposHandler(BaseHandler):
             self.finish(json.dumps({'message': 'illigal repo'}))
             return
 
-        self.repos_collection.update_one({'repo': repo}, {'$set': body}, upsert=True)
+        await self.repos_collection.update_one({'repo': repo}, {'$set': body}, upsert=True)
         self.finish(json.dumps({'message': 'repo {} successful added.'.format(repo)}))
 
     async def get(self):
         page = int(self.get_argument('page', 1))
         page_size = int(self.get_argument('pageSize', 20))
-        count = self.repos_collection.count()
+        count = await self.repos_collection.count()
         repos = []
-        for repo in self.repos_collection.find().sort("_id", -1).skip(page_size * (page - 1)).limit(page_size):
+        for repo in await self.repos_collection.find(sort=[('_id', -1)], skip=page_size * (page - 1), limit=page_size):
             repos.append({
                 '_id': str(repo['_id']),
                 'repo': repo['repo']
@@ -75,12 +75,12 @@ class ReposHandler(BaseHandler):
 
 class RepoHandler(BaseHandler):
 
-    def initialize(self, mongo_client):
-        self.mongo_client = mongo_client
-        self.repos_collection = self.mongo_client.ktqueue.repos
+    def initialize(self, db):
+        self.db = db
+        self.repos_collection = self.db.repos
 
     @apiauthenticated
     async def delete(self, id):
         print(id)
-        self.repos_collection.delete_one({'_id': bson.ObjectId(id)})
+        await self.repos_collection.delete_one({'_id': bson.ObjectId(id)})
         self.finish({'message': 'repos successful added.'})
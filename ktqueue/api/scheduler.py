@@ -0,0 +1,24 @@
+# encoding: utf-8
+import tornado.web
+
+from .utils import convert_asyncio_task
+from ktqueue.scheduler import pending_jobs
+
+
+class SchedulerHandler(tornado.web.RequestHandler):
+    """Queued jobs (higher priority & earlier first) and metrics of the scheduler."""
+
+    def initialize(self, db):
+        self.db = db
+
+    @convert_asyncio_task
+    async def get(self):
+        pending = await pending_jobs(self.db)
+        pending.sort(key=lambda job: (-job['priority'], job['queuedAt']))
+        status = await self.db.cluster_state.find_one({'_id': 'scheduler'}) or {}
+        status.pop('_id', None)
+        for job in pending:
+            job['queuedAt'] = job['queuedAt'].isoformat()
+        if 'updateAt' in status:
+            status['updateAt'] = status['updateAt'].isoformat()
+        self.write({'queue': pending, 'status': status})
@@ -0,0 +1,51 @@
+# encoding: utf-8
+import datetime
+
+import tornado.web
+
+from .utils import convert_asyncio_task
+from ktqueue.stats import DIMENSIONS
+from ktqueue.stats import PERIODS
+from ktqueue.stats import parse_date
+from ktqueue.stats import query_rollups
+
+
+class StatsHandler(tornado.web.RequestHandler):
+    """GPU-hours & finished jobs per user, node or status, from the rollups of ktqueue.stats.
+        dimension: user (default), node or status.
+        period: day (default) or hour.
+        since, until: e.g. 2018-01-01 or 2018-01-01T08, UTC, default is the last 30 days.
+        key[]: only these users / nodes / statuses.
+    """
+
+    def initialize(self, db):
+        self.db = db
+
+    @convert_asyncio_task
+    async def get(self):
+        dimension = self.get_argument('dimension', 'user')
+        period = self.get_argument('period', 'day')
+        keys = self.get_arguments('key[]')
+        try:
+            until = parse_date(self.get_argument('until')) if self.get_argument('until', None) else \
+                datetime.datetime.utcnow()
+            since = parse_date(self.get_argument('since')) if self.get_argument('since', None) else \
+                until - datetime.timedelta(days=30)
+        except ValueError as e:
+            self.set_status(400)
+            self.finish({'message': str(e)})
+            return
+        if dimension not in DIMENSIONS or period not in PERIODS:
+            self.set_status(400)
+            self.finish({'message': 'dimension must be one of {}, period one of {}'.format(DIMENSIONS, PERIODS)})
+            return
+
+        series, totals = await query_rollups(self.db.usage_rollups, period, dimension, since, until, keys=keys)
+        self.write({
+            'dimension': dimension,
+            'period': period,
+            'since': since.isoformat(),
+            'until': until.isoformat(),
+            'series': series,
+            'totals': totals,
+        })
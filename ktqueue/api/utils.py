@@ -1,6 +1,9 @@
 # encoding: utf-8
 import asyncio
+import datetime
 import functools
+
+import bson
 import tornado.web
 
 import ktqueue.settings
@@ -15,6 +18,15 @@ def convert_asyncio_task(method):
     return wrapper
 
 
+def json_default(value):
+    """`default` of json.dumps for documents from MongoDB: datetimes as ISO 8601, ObjectIds as strings."""
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    if isinstance(value, bson.ObjectId):
+        return str(value)
+    raise TypeError('{!r} is not JSON serializable'.format(value))
+
+
 class BaseHandler(tornado.web.RequestHandler):
     def get_current_user(self):
         user = self.get_secure_cookie("user")
@@ -0,0 +1,186 @@
+# encoding: utf-8
+import asyncio
+import logging
+from collections import deque
+
+import pymongo.errors
+
+from ktqueue import settings
+from ktqueue.node_inventory import node_inventory
+
+
+class ChangeFeed:
+    """Job and node changes with a monotonically increasing revision.
+
+    The leader (the process running watch_pod) appends changes to the capped
+    collection `job_events`, the revision is the `_id`. Changes published by
+    the other processes (handlers, submission workers) are written to
+    `outbox`, the leader moves them to `job_events`. Every process tails
+    the collection, keeps recent changes in memory and pushes them to its
+    subscribers.
+
+    A change looks like:
+        {"revision": 12, "type": "job", "name": "test-1", "update": {"status": "Running", ...}}
+        {"revision": 13, "type": "node", "name": "gpu-node-1", "node": {...}}  # node is null when deleted
+    A job update of a job the client does not know yet is a new job.
+    """
+
+    def __init__(self, collection, elector=None, max_backlog=None, outbox=None):
+        self.collection = collection
+        self.outbox = outbox
+        self.elector = elector
+        self.backlog = deque(maxlen=max_backlog or settings.change_feed_backlog)
+        self.revision = None  # last revision received
+        self.next_revision = None  # next revision to publish, only used by leader
+        self.node_revision = None  # last node_inventory revision published
+        self.pending = []
+        self.subscribers = set()
+
+    # leader side
+    def publish(self, changes):
+        """Queue changes, they are written by the next sync() of this process, whether it is the leader or not."""
+        self.pending.extend(changes)
+
+    def publish_job_updates(self, updates):
+        """JobStatusWriter flush callback, `updates` is {job name: $set fields}."""
+        self.publish([{'type': 'job', 'name': name, 'update': fields} for name, fields in updates.items()])
+
+    def publish_job(self, name, fields):
+        """Publish $set `fields` of job `name`, or the whole document of a new job."""
+        self.publish([{'type': 'job', 'name': name, 'update': fields}])
+
+    def collect_node_changes(self):
+        from .api.node import node_item
+        if not node_inventory.synced:
+            return
+        changes = None
+        if self.node_revision is not None:
+            changes = node_inventory.changed_since(self.node_revision)
+        if changes is None:  # publish every node
+            changes = (list(node_inventory.nodes), [])
+        changed, deleted = changes
+        self.node_revision = node_inventory.revision
+        self.publish([{'type': 'node', 'name': name, 'node': node_item(node_inventory.nodes[name])} for name in changed])
+        self.publish([{'type': 'node', 'name': name, 'node': None} for name in deleted])
+
+    async def write_pending(self):
+        if self.next_revision is None:
+            last = await self.collection.find(sort=[('_id', -1)], limit=1)
+            self.next_revision = last[0]['_id'] + 1 if last else 1
+        pending, self.pending = self.pending, []
+        docs = [dict(change, _id=self.next_revision + index) for index, change in enumerate(pending)]
+        try:
+            await self.collection.insert_many(docs)
+        except pymongo.errors.BulkWriteError as e:
+            # changes before the error are written, the rest is written again after the last revision,
+            # e.g. another process published as leader meanwhile
+            self.pending = pending[e.details.get('nInserted', 0):] + self.pending
+            self.next_revision = None
+            raise
+        except Exception:
+            # they may be written or not, a duplicate is better than a change subscribers never see
+            self.pending = pending + self.pending
+            self.next_revision = None
+            raise
+        self.next_revision += len(docs)
+
+    async def read_outbox(self):
+        """Move changes published by the other processes to `pending`, the leader writes them next."""
+        docs = await self.outbox.find(sort=[('_id', 1)], limit=settings.change_feed_batch)
+        if not docs:
+            return
+        await self.outbox.delete_many({'_id': {'$in': [doc['_id'] for doc in docs]}})
+        self.pending = [{key: value for key, value in doc.items() if key != '_id'} for doc in docs] + self.pending
+
+    async def write_outbox(self):
+        pending, self.pending = self.pending, []
+        try:
+            await self.outbox.insert_many([dict(change) for change in pending])
+        except Exception:
+            self.pending = pending + self.pending
+            raise
+
+    # every process
+    async def read_new(self):
+        query = {'_id': {'$gt': self.revision}}
+        docs = await self.collection.find(query, sort=[('_id', 1)], limit=settings.change_feed_batch)
+        for doc in docs:
+            change = dict(doc)
+            change['revision'] = change.pop('_id')
+            self.revision = change['revision']
+            self.backlog.append(change)
+            for queue in list(self.subscribers):
+                try:
+                    queue.put_nowait(change)
+                except asyncio.QueueFull:
+                    # too slow, drop what is queued and tell it to resume from its own revision
+                    while not queue.empty():
+                        queue.get_nowait()
+                    queue.put_nowait(None)
+                    self.subscribers.discard(queue)
+
+    async def sync(self):
+        if self.revision is None:  # start from now, history is read on demand by changes_since()
+            last = await self.collection.find(sort=[('_id', -1)], limit=1)
+            self.revision = last[0]['_id'] if last else 0
+
+        if self.elector is None or self.elector.is_leader:
+            self.collect_node_changes()
+            if self.outbox is not None:
+                await self.read_outbox()
+            if self.pending:
+                await self.write_pending()
+        else:
+            self.next_revision = None
+            self.node_revision = None
+            if self.outbox is None:
+                self.pending = []
+            elif self.pending:
+                await self.write_outbox()
+
+        await self.read_new()
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.exception(e)
+            await asyncio.sleep(settings.change_feed_interval)
+
+    def subscribe(self):
+        """Return a queue receiving new changes, None is put into it when the subscriber is too slow."""
+        queue = asyncio.Queue(maxsize=settings.change_feed_queue_size)
+        self.subscribers.add(queue)
+        return queue
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+    async def changes_since(self, revision):
+        """Changes after `revision`, None if they are no longer kept."""
+        if self.revision is None or revision >= self.revision:
+            return []
+        if self.backlog and self.backlog[0]['revision'] <= revision + 1:
+            return [change for change in self.backlog if change['revision'] > revision]
+        docs = await self.collection.find({'_id': {'$gt': revision, '$lte': self.revision}}, sort=[('_id', 1)])
+        if not docs or docs[0]['_id'] != revision + 1:
+            return None
+        changes = []
+        for doc in docs:
+            change = dict(doc)
+            change['revision'] = change.pop('_id')
+            changes.append(change)
+        return changes
+
+
+_change_feed = None
+
+
+def get_change_feed():
+    global _change_feed
+    if _change_feed is None:
+        from .db import get_db
+        db = get_db()
+        _change_feed = ChangeFeed(db.job_events, outbox=db.job_events_outbox)
+    return _change_feed
@@ -7,6 +7,8 @@ import asyncio
 import logging
 import urllib.parse
 
+from ktqueue.fs import fs
+
 
 class GitCredentialProvider:
     __https_pattern = re.compile(r'https:\/\/(\w+@\w+)?[\w.\/\-+]*.git')
@@ -158,9 +160,9 @@ class Cloner:
             logging.error('\n'.join(retlines))
             logging.error('fetch repo failed with retcode {}.'.format(retcode))
 
-    async def clone_and_copy(self, archive_file=None, keep_archive=False):
-        if not os.path.exists('/cephfs/ktqueue/repos'):
-            os.makedirs('/cephfs/ktqueue/repos')
+    async def archive(self, archive_file=None):
+        """Clone or fetch the repo, resolve commit_id and archive it, return the archive file."""
+        await fs.makedirs('/cephfs/ktqueue/repos')
         self.repo_path = os.path.join('/cephfs/ktqueue/repos', self.repo_hash)
 
         if self.repo_type == 'ssh':
@@ -171,7 +173,7 @@ class Cloner:
                 self.repo_url = self.add_credential_to_https_url(
                     self.repo, username=self.crediential.https_username, password=self.crediential.https_password)
 
-        if not os.path.exists(self.repo_path):  # Then clone it
+        if not await fs.isdir(self.repo_path):  # Then clone it
             await self.clone()
         else:
             await self.fetch()
@@ -183,24 +185,34 @@ class Cloner:
             if not self.commit_id:
                 raise Exception('Branch {branch} not found for {repo}.'.format(branch=self.branch, repo=self.repo))
 
-        if not os.path.exists('/cephfs/ktqueue/repo_archive'):
-            os.makedirs('/cephfs/ktqueue/repo_archive')
+        await fs.makedirs('/cephfs/ktqueue/repo_archive')
         if archive_file is None:
             archive_file = '/cephfs/ktqueue/repo_archive/{}.tar.gz'.format(self.commit_id)
 
         # Arcive commit_id
         logging.info('Arciving {}:{}'.format(self.repo, self.commit_id))
-        with open(archive_file, 'wb') as f:
+        f = await fs.open(archive_file, 'wb')
+        try:
             proc = await asyncio.create_subprocess_exec(*['git', 'archive', self.commit_id, '--format', 'tar.gz'],
                                                         stdout=f, cwd=self.repo_path)
             retcode = await proc.wait()
             if retcode != 0:
                 logging.error('Arcive repo failed with retcode {}'.format(retcode))
+        finally:
+            await fs.run('close', f.close)
+        return archive_file
 
-        if not os.path.exists(self.dst_directory):
-            os.makedirs(self.dst_directory)
-        proc = await asyncio.create_subprocess_exec(*['tar', 'xzf', archive_file], cwd=self.dst_directory)
+    @classmethod
+    async def extract(cls, archive_file, dst_directory):
+        await fs.makedirs(dst_directory)
+        proc = await asyncio.create_subprocess_exec(*['tar', 'xzf', archive_file], cwd=dst_directory)
         retcode = await proc.wait()
+        if retcode != 0:
+            logging.error('Extract {} failed with retcode {}'.format(archive_file, retcode))
+
+    async def clone_and_copy(self, archive_file=None, keep_archive=False):
+        archive_file = await self.archive(archive_file)
+        await self.extract(archive_file, self.dst_directory)
 
         if not keep_archive:
-            os.remove(archive_file)
+            await fs.remove(archive_file)
@@ -0,0 +1,135 @@
+# encoding: utf-8
+import asyncio
+import datetime
+import logging
+import os
+import socket
+import uuid
+
+import pymongo.errors
+
+from ktqueue import settings
+from ktqueue.node_inventory import node_inventory
+
+
+def process_identity():
+    """An identity unique among all KTQueue processes."""
+    return '{}-{}-{}'.format(socket.gethostname(), os.getpid(), uuid.uuid4().hex[:8])
+
+
+class LeaderElector:
+    """Elect one leader among all KTQueue processes with a lease document in MongoDB.
+
+    The leader renews the lease every ttl / 3 seconds, another process takes
+    it over when it has not been renewed for `ttl` seconds.
+    """
+
+    def __init__(self, collection, name, ttl=None):
+        self.collection = collection
+        self.name = name
+        self.ttl = ttl or settings.leader_lease_ttl
+        self.identity = process_identity()
+        self.is_leader = False
+
+    async def try_acquire(self):
+        """Acquire or renew the lease, return whether this process is the leader."""
+        now = datetime.datetime.utcnow()
+        try:
+            await self.collection.find_one_and_update(
+                {'_id': self.name, '$or': [{'holder': self.identity}, {'expireAt': {'$lt': now}}]},
+                {'$set': {
+                    'holder': self.identity,
+                    'renewAt': now,
+                    'expireAt': now + datetime.timedelta(seconds=self.ttl),
+                }},
+                upsert=True,
+            )
+        except pymongo.errors.DuplicateKeyError:  # lease is held by another process
+            self.is_leader = False
+        else:
+            self.is_leader = True
+        return self.is_leader
+
+    async def run(self, on_leader, on_follower):
+        """Keep the lease, run the coroutines from on_leader() while leading, on_follower() otherwise."""
+        role = None
+        tasks = []
+        while True:
+            try:
+                leader = await self.try_acquire()
+            except Exception as e:  # can not renew, step down before someone else takes over
+                logging.exception(e)
+                leader = self.is_leader = False
+
+            if leader != role:
+                logging.info('{} becomes {}'.format(self.identity, 'leader' if leader else 'follower'))
+                for task in tasks:
+                    task.cancel()
+                tasks = [asyncio.ensure_future(coro) for coro in (on_leader() if leader else on_follower())]
+                role = leader
+            await asyncio.sleep(self.ttl / 3)
+
+
+class SharedClusterState:
+    """Share the state only the watching process knows (node_used_gpus, job_tensorboard_map) through MongoDB.
+
+    The leader publishes a snapshot when it changes, other processes load it.
+    """
+
+    def __init__(self, collection, elector):
+        self.collection = collection
+        self.elector = elector
+        self.snapshot = None
+
+    def take_snapshot(self):
+        from .api.tensorboard_proxy import job_tensorboard_map
+        from .api.node import node_used_gpus
+        # node names may contain dots, which can not be used as keys in MongoDB
+        return {
+            'nodeUsedGpus': sorted([
+                {'node': node, 'pod': pod, 'gpus': gpus}
+                for node, pods in node_used_gpus.items() for pod, gpus in pods.items()
+            ], key=lambda item: (item['node'], item['pod'])),
+            'jobTensorboard': sorted([
+                {'job': job, 'host': host} for job, host in job_tensorboard_map.items()
+            ], key=lambda item: item['job']),
+        }
+
+    def apply_snapshot(self, snapshot):
+        from .api.tensorboard_proxy import job_tensorboard_map
+        from .api.node import node_used_gpus
+
+        used_gpus = {}
+        for item in snapshot['nodeUsedGpus']:
+            used_gpus.setdefault(item['node'], {})[item['pod']] = item['gpus']
+        for node in set(node_used_gpus) | set(used_gpus):
+            if node_used_gpus.get(node, {}) != used_gpus.get(node, {}):
+                node_inventory.mark_changed(node)
+        # modules keep references of these dicts, update them in place
+        node_used_gpus.clear()
+        node_used_gpus.update(used_gpus)
+        job_tensorboard_map.clear()
+        job_tensorboard_map.update({item['job']: item['host'] for item in snapshot['jobTensorboard']})
+
+    async def sync(self):
+        if self.elector.is_leader:
+            snapshot = self.take_snapshot()
+            if snapshot != self.snapshot:
+                await self.collection.replace_one(
+                    {'_id': 'state'}, dict(snapshot, updateAt=datetime.datetime.utcnow()), upsert=True)
+                self.snapshot = snapshot
+        else:
+            doc = await self.collection.find_one({'_id': 'state'})
+            if doc:
+                snapshot = {k: doc[k] for k in ('nodeUsedGpus', 'jobTensorboard')}
+                if snapshot != self.snapshot:
+                    self.apply_snapshot(snapshot)
+                    self.snapshot = snapshot
+
+    async def run(self):
+        while True:
+            try:
+                await self.sync()
+            except Exception as e:
+                logging.exception(e)
+            await asyncio.sleep(settings.cluster_state_interval)
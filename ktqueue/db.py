@@ -0,0 +1,152 @@
+# encoding: utf-8
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+from ktqueue import settings
+
+
+class AsyncCollection:
+    """Run pymongo collection methods in a bounded thread pool so the event loop is never blocked."""
+
+    def __init__(self, collection, executor):
+        self.collection = collection
+        self.executor = executor
+
+    @property
+    def name(self):
+        return self.collection.name
+
+    async def run(self, fn, *args, **kwargs):
+        return await asyncio.get_event_loop().run_in_executor(
+            self.executor, functools.partial(fn, *args, **kwargs))
+
+    async def find_one(self, *args, **kwargs):
+        return await self.run(self.collection.find_one, *args, **kwargs)
+
+    async def find(self, filter=None, projection=None, sort=None, skip=0, limit=0):
+        """Return a list, the cursor is consumed in the executor."""
+        def query():
+            cursor = self.collection.find(filter, projection)
+            if sort:
+                cursor = cursor.sort(sort)
+            if skip:
+                cursor = cursor.skip(skip)
+            if limit:
+                cursor = cursor.limit(limit)
+            return list(cursor)
+        return await self.run(query)
+
+    async def count(self, filter=None):
+        return await self.run(self.collection.count_documents, filter or {})
+
+    async def insert_one(self, *args, **kwargs):
+        return await self.run(self.collection.insert_one, *args, **kwargs)
+
+    async def insert_many(self, *args, **kwargs):
+        return await self.run(self.collection.insert_many, *args, **kwargs)
+
+    async def update_one(self, *args, **kwargs):
+        return await self.run(self.collection.update_one, *args, **kwargs)
+
+    async def update_many(self, *args, **kwargs):
+        return await self.run(self.collection.update_many, *args, **kwargs)
+
+    async def find_one_and_update(self, *args, **kwargs):
+        return await self.run(self.collection.find_one_and_update, *args, **kwargs)
+
+    async def replace_one(self, *args, **kwargs):
+        return await self.run(self.collection.replace_one, *args, **kwargs)
+
+    async def delete_one(self, *args, **kwargs):
+        return await self.run(self.collection.delete_one, *args, **kwargs)
+
+    async def delete_many(self, *args, **kwargs):
+        return await self.run(self.collection.delete_many, *args, **kwargs)
+
+    async def bulk_write(self, *args, **kwargs):
+        return await self.run(self.collection.bulk_write, *args, **kwargs)
+
+    async def aggregate(self, pipeline, **kwargs):
+        return await self.run(lambda: list(self.collection.aggregate(pipeline, **kwargs)))
+
+    async def create_index(self, *args, **kwargs):
+        return await self.run(self.collection.create_index, *args, **kwargs)
+
+
+class Database:
+    """The data access layer of ktqueue, every module should get collections from here."""
+
+    def __init__(self, mongo_client=None, max_workers=None):
+        if mongo_client is None:
+            mongo_client = pymongo.MongoClient(settings.mongodb_server)
+        self.mongo_client = mongo_client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or settings.mongodb_executor_workers)
+
+    def collection(self, name):
+        return AsyncCollection(self.mongo_client.ktqueue[name], self.executor)
+
+    @property
+    def jobs(self):
+        return self.collection('jobs')
+
+    @property
+    def repos(self):
+        return self.collection('repos')
+
+    @property
+    def oauth(self):
+        return self.collection('oauth')
+
+    @property
+    def credentials(self):
+        return self.collection('credentials')
+
+    @property
+    def leases(self):
+        return self.collection('leases')
+
+    @property
+    def cluster_state(self):
+        return self.collection('cluster_state')
+
+    @property
+    def job_events(self):
+        return self.collection('job_events')
+
+    @property
+    def job_events_outbox(self):
+        return self.collection('job_events_outbox')
+
+    @property
+    def submissions(self):
+        return self.collection('submissions')
+
+    @property
+    def migrations(self):
+        return self.collection('migrations')
+
+    @property
+    def usage_rollups(self):
+        return self.collection('usage_rollups')
+
+    @property
+    def usage_cursors(self):
+        return self.collection('usage_cursors')
+
+    @property
+    def log_checkpoints(self):
+        return self.collection('log_checkpoints')
+
+
+_db = None
+
+
+def get_db():
+    """Return the Database shared by the whole process."""
+    global _db
+    if _db is None:
+        _db = Database()
+    return _db
@@ -0,0 +1,117 @@
+# encoding: utf-8
+"""Measure event loop lag while /api/jobs-like queries run, with pymongo called in the loop and through AsyncCollection.
+
+Jobs are written to a separate database (ktqueue_benchmark by default), then `--concurrency`
+coroutines run queries while a probe measures how late `asyncio.sleep` wakes up:
+    python -m ktqueue.db_benchmark --jobs 200000 --concurrency 32
+Lag is what every other request (log streams, WebSockets, the pod watch) waits for.
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pymongo
+
+from ktqueue import settings
+from ktqueue.db import AsyncCollection
+from ktqueue.search_benchmark import populate
+
+
+def percentile(values, q):
+    values = sorted(values)
+    if not values:
+        return None
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def query_args(rand, users):
+    """A page of /api/jobs: a filter, newest first, and its total."""
+    query = rand.choice([
+        {'hide': False},
+        {'hide': False, 'user': 'user-{}'.format(rand.randrange(users))},
+        {'hide': False, 'status': 'Running'},
+    ])
+    return query, rand.randrange(20)
+
+
+async def probe(lags, stop, interval=0.01):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(interval)
+        lags.append((time.perf_counter() - start - interval) * 1000)
+
+
+async def run_mode(collection, mode, concurrency, queries, users, page_size, workers, seed):
+    rand = random.Random(seed)
+    async_collection = AsyncCollection(collection, ThreadPoolExecutor(max_workers=workers))
+
+    async def page(query, page):
+        if mode == 'blocking':  # what handlers did before ktqueue.db
+            jobs = list(collection.find(query).sort('_id', -1).skip(page * page_size).limit(page_size))
+            collection.count_documents(query)
+        else:
+            jobs = await async_collection.find(query, sort=[('_id', -1)], skip=page * page_size, limit=page_size)
+            await async_collection.count(query)
+        return jobs
+
+    async def client(n):
+        for _ in range(n):
+            await page(*query_args(rand, users))
+            await asyncio.sleep(0)
+
+    lags = []
+    stop = asyncio.Event()
+    probe_task = asyncio.ensure_future(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*[client(queries // concurrency) for _ in range(concurrency)])
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    async_collection.executor.shutdown()
+    return {
+        'mode': mode,
+        'queries': queries // concurrency * concurrency,
+        'queries_per_s': queries // concurrency * concurrency / elapsed,
+        'lag_ms': {
+            'p50': percentile(lags, 0.5),
+            'p99': percentile(lags, 0.99),
+            'max': max(lags) if lags else None,
+            'samples': len(lags),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default='ktqueue_benchmark')
+    parser.add_argument('--jobs', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--concurrency', type=int, default=32, help='requests in flight')
+    parser.add_argument('--queries', type=int, default=2000)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--workers', type=int, default=settings.mongodb_executor_workers)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true', help='do not rebuild the collection')
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(settings.mongodb_server)
+    collection = client[args.database].jobs
+    if not args.reuse:
+        start = time.time()
+        populate(collection, args.jobs, args.users, args.seed)
+        print('{} jobs written and indexed in {:.1f}s'.format(args.jobs, time.time() - start))
+
+    loop = asyncio.get_event_loop()
+    results = [
+        loop.run_until_complete(run_mode(collection, mode, args.concurrency, args.queries, args.users,
+                                         args.page_size, args.workers, args.seed))
+        for mode in ('blocking', 'executor')
+    ]
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == '__main__':
+    main()
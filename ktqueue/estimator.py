@@ -0,0 +1,76 @@
+# encoding: utf-8
+import datetime
+from collections import defaultdict
+from collections import deque
+
+from ktqueue import settings
+
+
+def parse_time(value):
+    """Parse kubernetes time, e.g. 2018-01-01T00:00:00Z"""
+    return datetime.datetime.strptime(value, '%Y-%m-%dT%H:%M:%SZ')
+
+
+def container_runtime(state):
+    """Seconds a terminated container ran, None if unknown."""
+    terminated = (state or {}).get('terminated', None)
+    if not terminated or not terminated.get('startedAt', None) or not terminated.get('finishedAt', None):
+        return None
+    return (parse_time(terminated['finishedAt']) - parse_time(terminated['startedAt'])).total_seconds()
+
+
+def container_started_at(state):
+    """Start time of a running container as timestamp, None if unknown."""
+    running = (state or {}).get('running', None)
+    if not running or not running.get('startedAt', None):
+        return None
+    return parse_time(running['startedAt']).replace(tzinfo=datetime.timezone.utc).timestamp()
+
+
+class RuntimeEstimator:
+    """Estimate how long a job runs from the runtime of finished jobs.
+
+    Finished jobs are grouped by (user, image, command prefix), (user, image)
+    and user, the estimate is the average runtime of the last `window` jobs
+    of the most specific group with at least `min_samples` jobs. The
+    `wallTime` given by user is an upper bound. None if nothing is known.
+    """
+
+    def __init__(self, window=None, min_samples=None, prefix_tokens=None):
+        self.window = window or settings.runtime_estimate_window
+        self.min_samples = min_samples or settings.runtime_estimate_min_samples
+        self.prefix_tokens = prefix_tokens or settings.runtime_estimate_prefix_tokens
+        self.history = defaultdict(lambda: deque(maxlen=self.window))
+
+    def keys(self, job):
+        user, image = job.get('user', None), job.get('image', None)
+        prefix = ' '.join((job.get('command', None) or '').split()[:self.prefix_tokens])
+        return [(user, image, prefix), (user, image), (user, )]
+
+    def add(self, job, runtime):
+        for key in self.keys(job):
+            self.history[key].append(runtime)
+
+    def estimate(self, job):
+        predicted = None
+        for key in self.keys(job):
+            samples = self.history.get(key, None)
+            if samples and len(samples) >= self.min_samples:
+                predicted = sum(samples) / len(samples)
+                break
+        wall_time = job.get('wallTime', None)
+        if wall_time:
+            return min(wall_time, predicted) if predicted is not None else wall_time
+        return predicted
+
+    async def load(self, jobs_collection):
+        """Rebuild history from the latest finished jobs."""
+        docs = await jobs_collection.find(
+            {'$or': [{'runtime': {'$gt': 0}}, {'state.terminated.finishedAt': {'$exists': True}}]},
+            projection={'user': True, 'image': True, 'command': True, 'runtime': True, 'state': True},
+            sort=[('_id', -1)], limit=settings.runtime_estimate_history)
+        self.history.clear()
+        for doc in reversed(docs):
+            runtime = doc.get('runtime', None) or container_runtime(doc.get('state', None))
+            if runtime:
+                self.add(doc, runtime)
@@ -2,57 +2,356 @@
 import logging
 import asyncio
 import json
+import time
 
 import pymongo
 
 from ktqueue.utils import save_job_log
 from ktqueue.utils import k8s_delete_job
+from ktqueue.pod_cache import pod_cache
+from ktqueue.node_inventory import node_inventory
+from ktqueue.status_writer import JobStatusWriter
+from ktqueue.status_writer import get_status_writer
+from ktqueue.metrics import Histogram
+from ktqueue.estimator import container_runtime
+from ktqueue.stats import UsageRollup
+from ktqueue.kubernetes_client import PRIORITY_HIGH
+from ktqueue.scheduler import FINISHED_STATUS
 from ktqueue import settings
+from ktqueue.db import get_db
+
+# written by handlers & the scheduler, a late update of a pod still alive must not overwrite them
+LIVE_POD_GUARD = FINISHED_STATUS + ('Preempting', 'queued')
+
+event_watchers = {}  # collection -> its EventWatcher in this process, for /api/metrics
 
 
 class EventWatcher:
+    """Watch a collection of kubernetes objects and call `callback` for every event.
+
+    The last seen resourceVersion is tracked so a broken stream is resumed
+    instead of replaying every object as ADDED. Only when the apiserver
+    answers 410 Gone the collection is LISTed once and the watch restarts
+    from the version of that list. A watcher with a `name` is reported by /api/metrics.
+    """
 
-    def __init__(self, k8s_client=None):
+    def __init__(self, k8s_client=None, cache=None, name=None):
         assert k8s_client is not None
         self.k8s_client = k8s_client
+        self.cache = cache
         self.running = True
+        self.resource_version = None
+        self.counters = {
+            'events': 0,
+            'bookmarks': 0,
+            'reconnects': 0,
+            'relists': 0,
+            'replayed_events': 0,
+        }
+        if name is not None:
+            event_watchers[name] = self
+
+    async def relist(self, api, callback, params):
+        """LIST the collection, replay every item as ADDED and remember its resourceVersion."""
+        params = {k: v for k, v in params.items() if k not in ('watch', 'resourceVersion', 'allowWatchBookmarks')}
+        items, resource_version = await self.k8s_client.list_all(api=api, params=params)
+        self.counters['relists'] += 1
+        if self.cache is not None:
+            self.cache.replace(items, resource_version)
+        for item in items:
+            self.counters['replayed_events'] += 1
+            await self.dispatch(callback, {'type': 'ADDED', 'object': item})
+        self.resource_version = resource_version
+
+    async def dispatch(self, callback, event):
+        try:
+            await callback(event)
+        except Exception as e:
+            logging.exception(e)
+            logging.exception('Event is:')
+            logging.exception(event)
+
+    async def handle_line(self, line, callback):
+        """Handle one line of the watch stream, return False if the watch must be restarted by a LIST."""
+        event = json.loads(line.decode('utf-8'))
+        obj = event.get('object', {})
+        if event['type'] == 'ERROR':
+            if obj.get('code', None) == 410:  # resourceVersion too old
+                self.resource_version = None
+                if self.cache is not None:
+                    self.cache.invalidate()
+                return False
+            raise Exception('watch error: {}'.format(obj.get('message', obj)))
+
+        resource_version = obj.get('metadata', {}).get('resourceVersion', None)
+        if event['type'] == 'BOOKMARK':
+            self.counters['bookmarks'] += 1
+            if self.cache is not None:
+                self.cache.touch(resource_version)
+        else:
+            self.counters['events'] += 1
+            if self.cache is not None:
+                self.cache.apply(event)
+            await self.dispatch(callback, event)
+        if resource_version:
+            self.resource_version = resource_version
+        return True
 
     async def poll(self, api, method='GET', callback=None, **kwargs):
         """
         This function will never return, await the future carefully.
+        `api` is the collection path, e.g. /api/v1/namespaces/{namespace}/pods
         """
         assert callback is not None
         timeout = kwargs.pop('timeout', None)
+        params = kwargs.pop('params', {})
+        first = True
         while self.running:
             try:
-                session = self.k8s_client.new_connector_session()
+                if not first:
+                    self.counters['reconnects'] += 1
+                    logging.info('Resume watching {} from resourceVersion {}, counters: {}'.format(
+                        api, self.resource_version, self.counters))
+                first = False
+
+                if self.resource_version is None:
+                    await self.relist(api=api, callback=callback, params=params)
+
+                watch_params = dict(params)
+                watch_params.update({
+                    'watch': 'true',
+                    'allowWatchBookmarks': 'true',
+                    'resourceVersion': self.resource_version,
+                })
                 resp = await self.k8s_client.call_api_raw(
-                    api=api, method=method, timeout=timeout, session=session, **kwargs)
+                    api=api, method=method, timeout=timeout, session=self.k8s_client.watch_session,
+                    priority=PRIORITY_HIGH, params=watch_params, **kwargs)
+                if resp.status == 410:
+                    self.resource_version = None
+                    if self.cache is not None:
+                        self.cache.invalidate()
+                    resp.close()
+                    continue
                 async for line in resp.content:
-                    try:
-                        await callback(json.loads(line.decode('utf-8')))
-                    except Exception as e:
-                        logging.exception(e)
-                        logging.exception('Event is:')
-                        logging.exception(line.decode('utf-8'))
-                    else:
-                        pass
+                    if not line.strip():
+                        continue
+                    if not await self.handle_line(line, callback):
+                        break
+                resp.close()
             except Exception as e:
                 logging.exception(e)
                 await asyncio.sleep(1)
+
+
+class EventDispatcher:
+    """Run an event callback on `workers` tasks, events are sharded by `key(event)`.
+
+    Events with the same key are handled in order by the same worker, events
+    of different keys are handled concurrently. Every worker has a bounded
+    queue, `submit` waits when it is full.
+    """
+
+    def __init__(self, callback, key, workers=None, queue_size=None):
+        self.callback = callback
+        self.key = key
+        self.workers = workers or settings.watch_workers
+        self.queue_size = queue_size or settings.watch_queue_size
+        self.queues = None
+        self.tasks = []
+        self.counters = {
+            'events': 0,
+            'errors': 0,
+        }
+        self.latency = Histogram()
+
+    def start(self):
+        loop = asyncio.get_event_loop()
+        self.queues = [asyncio.Queue(maxsize=self.queue_size) for _ in range(self.workers)]
+        self.tasks = [loop.create_task(self.work(queue)) for queue in self.queues]
+
+    def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        self.queues = None
+        self.tasks = []
+
+    @property
+    def queue_depth(self):
+        return [queue.qsize() for queue in self.queues or []]
+
+    def stats(self):
+        return {
+            'queueDepth': self.queue_depth,
+            'latency': self.latency.to_dict(),
+            'counters': dict(self.counters),
+        }
+
+    async def submit(self, event):
+        if self.queues is None:
+            self.start()
+        queue = self.queues[hash(self.key(event)) % self.workers]
+        await queue.put((time.time(), event))
+
+    async def work(self, queue):
+        while True:
+            enqueue_time, event = await queue.get()
+            try:
+                await self.callback(event)
+            except Exception as e:
+                self.counters['errors'] += 1
+                logging.exception(e)
+                logging.exception('Event is:')
+                logging.exception(event)
             finally:
-                session.close()
+                self.counters['events'] += 1
+                self.latency.observe(time.time() - enqueue_time)
+                queue.task_done()
+
+
+def pod_event_key(event):
+    """Shard pod events by the job they belong to."""
+    metadata = event['object']['metadata']
+    labels = metadata.get('labels') or {}
+    return labels.get('job-name', None) or labels.get('ktqueue-tensorboard-job-name', None) or metadata['name']
+
+
+# pod events of watch_pod, slow events (e.g. saving log of a terminated pod) only block the events of same job
+pod_dispatcher = EventDispatcher(callback=None, key=pod_event_key)
+
+
+def parse_pod_status(pod):
+    """Return (status, status_str, state) of a job pod.
+        status is (state, reason) of its container, e.g. ('terminated', 'Completed').
+    """
+    status = (None, None)
+    state = None
+    if 'containerStatuses' in pod['status']:
+        state = pod['status']['containerStatuses'][0]['state']
+        for k, v in state.items():
+            status = (k, v.get('reason', None))
+        status_str = '{}: {}'.format(*status)
+    elif pod['status']['phase'] == 'Pending':
+        status_str = 'Pending'
+    else:
+        status_str = '{}: {}'.format(pod['status']['phase'], pod['status'].get('reason', None))
+    return status, status_str, state
+
+
+def job_status(status, status_str):
+    """Status of job shown to user."""
+    if status == ('terminated', 'Completed'):
+        return 'Completed'
+    elif status == ('running', None):
+        return 'Running'
+    return status_str
+
+
+def account_pod_gpus(pod, status, gpu_num, deleted=False):
+    """Update node_used_gpus for a job pod, return the node it runs on, or None."""
+    from .api.node import node_used_gpus
+
+    pod_name = pod['metadata']['name']
+    node_name = pod['spec'].get('nodeName', None)
+    if not node_name:
+        return None
+    if deleted or status[0] == 'terminated':
+        node_used_gpus[node_name].pop(pod_name, None)
+        node_inventory.mark_changed(node_name)
+    elif status[0] == 'waiting':  # waiting doesn't use GPU
+        pass
+    else:
+        node_used_gpus[node_name][pod_name] = int(gpu_num)
+        node_inventory.mark_changed(node_name)
+        return node_name
+    return None
+
 
+async def reconcile_pods(k8s_client, db=None):
+    """Rebuild job_tensorboard_map, node_used_gpus and job status from one paginated LIST of pods.
 
-async def watch_pod(k8s_client):
+    Return (resourceVersion of the LIST, terminated job pods). watch_pod
+    resumes from that version and handles the terminated pods (saving log,
+    deleting job) itself.
+    """
     from .api.tensorboard_proxy import job_tensorboard_map
     from .api.node import node_used_gpus
 
-    mongo_client = pymongo.MongoClient(settings.mongodb_server)
-    jobs_collection = mongo_client.ktqueue.jobs
+    start = time.time()
+    db = db or get_db()
+    items, resource_version = await k8s_client.list_all(
+        api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
+        limit=settings.reconcile_page_size,
+    )
+    pod_cache.replace(items, resource_version)
+
+    job_tensorboard_map.clear()
+    node_used_gpus.clear()
+    job_pods = []
+    for pod in items:
+        labels = pod['metadata'].get('labels') or {}
+        if 'ktqueue-tensorboard-job-name' in labels:
+            if pod['status'].get('podIP', None):
+                job_tensorboard_map[labels['ktqueue-tensorboard-job-name']] = pod['status']['podIP']
+        elif 'job-name' in labels and labels.get('ktqueue-watching', None) != 'false':
+            job_pods.append(pod)
+
+    jobs = await db.jobs.find(
+        {'name': {'$in': list({pod['metadata']['labels']['job-name'] for pod in job_pods})}},
+        {'name': 1, 'gpuNum': 1})
+    gpu_nums = {job['name']: job['gpuNum'] for job in jobs}
+
+    job_updates = {}
+    terminated = []
+    terminated_jobs = set()
+    for pod in job_pods:
+        labels = pod['metadata']['labels']
+        job_name = labels['job-name']
+        if job_name not in gpu_nums:
+            continue
+        status, status_str, state = parse_pod_status(pod)
+        if state is None and status_str == 'Pending':
+            job_updates[job_name] = {'status': 'Pending'}
+            continue
+        running_node = account_pod_gpus(pod, status, gpu_nums[job_name])
+        if labels.get('ktqueue-terminating', None) == 'true':
+            continue
+        job_update = {'status': job_status(status, status_str)}
+        if state is not None:
+            job_update['state'] = state
+        if running_node:
+            job_update['runningNode'] = running_node
+        if status[0] == 'terminated' and container_runtime(state) is not None:
+            job_update['runtime'] = container_runtime(state)
+        job_updates[job_name] = job_update
+        if status[0] == 'terminated':
+            terminated.append(pod)
+            terminated_jobs.add(job_name)
+
+    if job_updates:
+        await db.jobs.bulk_write([
+            pymongo.UpdateOne(JobStatusWriter.filter(name, None if name in terminated_jobs else LIVE_POD_GUARD),
+                              {'$set': update})
+            for name, update in job_updates.items()], ordered=False)
+    logging.info('Reconciled {} pods, {} jobs, {} tensorboards in {:.2f}s'.format(
+        len(items), len(job_updates), len(job_tensorboard_map), time.time() - start))
+    return resource_version, terminated
+
+
+async def watch_pod(k8s_client, db=None, resource_version=None, terminated_pods=None, change_feed=None):
+    """Watch pods in job namespace.
+        `resource_version` and `terminated_pods` come from reconcile_pods(), watch starts from that version.
+        status changes are published to `change_feed` if given.
+    """
+    from .api.tensorboard_proxy import job_tensorboard_map
+
+    db = db or get_db()
+    jobs_collection = db.jobs
+    status_writer = get_status_writer()
+    status_writer.on_flush = change_feed.publish_job_updates if change_feed is not None else None
+    usage_rollup = UsageRollup(db)
 
     async def callback(event):
-        labels = event['object']['metadata']['labels']
+        labels = event['object']['metadata'].get('labels') or {}
 
         # TensorBoard Pod
         if 'ktqueue-tensorboard-job-name' in labels:
@@ -72,36 +371,33 @@ async def watch_pod(k8s_client):
             return
         job_name = labels['job-name']
 
-        job_exist = jobs_collection.find_one({'name': job_name})
+        job_exist = await jobs_collection.find_one({'name': job_name}, {'gpuNum': 1, 'user': 1, 'status': 1})
         if not job_exist:
             return
 
-        state = {}
         job_update = {}
-        status = (None, None)
-        if 'containerStatuses' in event['object']['status']:
-            state = event['object']['status']['containerStatuses'][0]['state']
-            for k, v in state.items():
-                status = (k, v.get('reason', None))
-                status_str = '{}: {}'.format(*status)
-                continue
+        status, status_str, state = parse_pod_status(event['object'])
+        if state is not None:
             job_update['state'] = state
-        elif event['object']['status']['phase'] == 'Pending':
-            jobs_collection.update_one({'name': job_name}, {'$set': {'status': 'Pending'}})
+        elif status_str == 'Pending':
+            status_writer.set(job_name, {'status': 'Pending'}, unless=LIVE_POD_GUARD)
             return
-        else:
-            status_str = '{}: {}'.format(event['object']['status']['phase'], event['object']['status']['reason'])
 
         pod_name = event['object']['metadata']['name']
 
         # update Running Node & used GPU
-        if status[0] == 'terminated':
-            node_used_gpus[event['object']['spec']['nodeName']].pop(pod_name, None)
-        elif status[0] == 'waiting':  # waiting doesn't use GPU
-            pass
-        elif event['object']['spec'].get('nodeName', None):
-            job_update['runningNode'] = event['object']['spec']['nodeName']
-            node_used_gpus[event['object']['spec']['nodeName']][pod_name] = int(job_exist['gpuNum'])
+        running_node = account_pod_gpus(event['object'], status, job_exist['gpuNum'], deleted=event['type'] == 'DELETED')
+        if running_node:
+            job_update['runningNode'] = running_node
+
+        # GPU-hours rollups, pods being terminated (stopped, preempted) included
+        try:
+            await usage_rollup.observe(
+                dict(job_exist, name=job_name), event['object']['spec'].get('nodeName', None), state,
+                finished=job_status(status, status_str) if status[0] == 'terminated' else None,
+                deleted=event['type'] == 'DELETED')
+        except Exception as e:
+            logging.exception(e)
 
         # Job is being terminated should not affect job status
         if labels.get('ktqueue-terminating', None) == 'true':
@@ -110,14 +406,11 @@ async def watch_pod(k8s_client):
         logging.info('Job {} enter state {}'.format(job_name, status_str))
 
         # update status
-        if status == ('terminated', 'Completed'):
-            job_update['status'] = 'Completed'
-        elif status == ('running', None):
-            job_update['status'] = 'Running'
-        else:
-            job_update['status'] = status_str
+        job_update['status'] = job_status(status, status_str)
+        if status[0] == 'terminated' and container_runtime(state) is not None:
+            job_update['runtime'] = container_runtime(state)  # for RuntimeEstimator
 
-        jobs_collection.update_one({'name': job_name}, {'$set': job_update})
+        status_writer.set(job_name, job_update, unless=None if status[0] == 'terminated' else LIVE_POD_GUARD)
 
         # When a job is successful finished, save log and do not watch it any more
         if status[0] == 'terminated':
@@ -135,12 +428,55 @@ async def watch_pod(k8s_client):
                 )
                 await k8s_delete_job(k8s_client=k8s_client, job=job_name, pod_name=pod_name, save_log=False)
 
-    event_watcher = EventWatcher(k8s_client=k8s_client)
+    dispatcher = pod_dispatcher
+    dispatcher.callback = callback
+
+    # watch every pod in namespace so that pod_cache is complete, callback ignores 'ktqueue-watching=false' pods itself
+    event_watcher = EventWatcher(k8s_client=k8s_client, cache=pod_cache, name='pods')
+    event_watcher.resource_version = resource_version
+
+    for pod in terminated_pods or []:
+        await dispatcher.submit({'type': 'MODIFIED', 'object': pod})
+
+    rollup_task = asyncio.ensure_future(usage_rollup.run())
+    try:
+        await event_watcher.poll(
+            api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
+            method='GET',
+            callback=dispatcher.submit,
+            timeout=0,
+        )
+    finally:  # cancelled when this process is no longer the leader
+        rollup_task.cancel()
+        dispatcher.stop()
+        await status_writer.flush()
+
+
+async def watch_pod_cache(k8s_client):
+    """Only keep pod_cache up to date, for processes not running watch_pod."""
+    async def callback(event):
+        pass
+
+    event_watcher = EventWatcher(k8s_client=k8s_client, cache=pod_cache, name='pods')
+
+    await event_watcher.poll(
+        api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
+        method='GET',
+        callback=callback,
+        timeout=0,
+    )
+
+
+async def watch_node(k8s_client):
+    """Keep node_inventory up to date."""
+    async def callback(event):
+        pass
+
+    event_watcher = EventWatcher(k8s_client=k8s_client, cache=node_inventory, name='nodes')
 
     await event_watcher.poll(
-        api='/api/v1/watch/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
+        api='/api/v1/nodes',
         method='GET',
         callback=callback,
-        params={'labelSelector': 'ktqueue-watching!=false'},
         timeout=0,
     )
@@ -0,0 +1,132 @@
+# encoding: utf-8
+import asyncio
+import functools
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from ktqueue import settings
+from ktqueue.metrics import HistogramGroup
+
+
+class AsyncFS:
+    """Filesystem operations on the shared filesystem (CephFS) run in a dedicated thread pool.
+
+    Metadata calls may take hundreds of milliseconds when the MDS is busy,
+    they must not block the event loop. Existing directories are cached for
+    `exists_ttl` seconds. Latency of every operation is kept in `latency`.
+    """
+
+    def __init__(self, max_workers=None, exists_ttl=None):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or settings.fs_executor_workers)
+        self.exists_ttl = settings.fs_exists_ttl if exists_ttl is None else exists_ttl
+        self.dirs = {}  # path -> time it was seen
+        self.latency = HistogramGroup()
+
+    async def run(self, name, fn, *args, **kwargs):
+        start = time.time()
+        try:
+            return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(fn, *args, **kwargs))
+        finally:
+            elapsed = time.time() - start
+            self.latency.observe(name, elapsed)
+            if elapsed > settings.fs_slow_threshold:
+                logging.warning('Slow filesystem {} {}: {:.2f}s'.format(name, args[0] if args else '', elapsed))
+
+    def dir_cached(self, path):
+        seen = self.dirs.get(path, None)
+        if seen is not None and time.time() - seen < self.exists_ttl:
+            return True
+        self.dirs.pop(path, None)
+        return False
+
+    async def exists(self, path):
+        if self.dir_cached(path):
+            return True
+        return await self.run('exists', os.path.exists, path)
+
+    async def isdir(self, path):
+        if self.dir_cached(path):
+            return True
+        isdir = await self.run('isdir', os.path.isdir, path)
+        if isdir:
+            self.dirs[path] = time.time()
+        return isdir
+
+    async def makedirs(self, path):
+        """os.makedirs(path, exist_ok=True), skipped if the directory is known to exist."""
+        if self.dir_cached(path):
+            return
+        await self.run('makedirs', os.makedirs, path, exist_ok=True)
+        self.dirs[path] = time.time()
+
+    async def listdir(self, path):
+        return await self.run('listdir', os.listdir, path)
+
+    async def remove(self, path):
+        await self.run('remove', os.remove, path)
+
+    async def read(self, path):
+        def read():
+            with open(path, 'rb') as f:
+                return f.read()
+        return await self.run('read', read)
+
+    async def write(self, path, data, mode='wb'):
+        def write():
+            with open(path, mode) as f:
+                f.write(data)
+        await self.run('write', write)
+
+    async def open(self, path, mode='rb'):
+        return await self.run('open', open, path, mode)
+
+    def writer(self, path, opener=None, chunk_size=None):
+        return AsyncFileWriter(self, path, chunk_size=chunk_size, opener=opener)
+
+
+class AsyncFileWriter:
+    """Write a stream to a file on the shared filesystem in large chunks.
+        async with fs.writer(path) as f:
+            await f.write(chunk)
+        `opener(path)` returns the file-like object to write, open(path, 'wb') by default.
+    """
+
+    def __init__(self, fs, path, chunk_size=None, opener=None):
+        self.fs = fs
+        self.path = path
+        self.chunk_size = chunk_size or settings.fs_write_chunk_size
+        self.opener = opener
+        self.buffer = []
+        self.buffered = 0
+        self.file = None
+
+    async def __aenter__(self):
+        if self.opener is None:
+            self.file = await self.fs.open(self.path, 'wb')
+        else:
+            self.file = await self.fs.run('open', self.opener, self.path)
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        try:
+            await self.flush()
+        finally:
+            await self.fs.run('close', self.file.close)
+
+    async def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.chunk_size:
+            await self.flush()
+
+    async def flush(self):
+        if not self.buffer:
+            return
+        data = b''.join(self.buffer)
+        self.buffer, self.buffered = [], 0
+        await self.fs.run('write', self.file.write, data)
+
+
+fs = AsyncFS()
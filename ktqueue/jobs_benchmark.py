@@ -0,0 +1,82 @@
+# encoding: utf-8
+"""Compare cursor and skip pagination of /api/jobs on a large synthetic collection.
+
+Jobs are written to a separate database (ktqueue_benchmark by default) with the indexes of
+ktqueue.migrations, then pages deep into every filter are explained and timed both ways:
+    python -m ktqueue.jobs_benchmark --jobs 1000000
+A skip page examines every key before it, a cursor page only the page itself.
+"""
+import argparse
+import json
+import time
+
+import pymongo
+
+from ktqueue import settings
+from ktqueue.search_benchmark import plan_stages
+from ktqueue.search_benchmark import populate
+
+
+def filters(users):
+    return [
+        {'hide': False},
+        {'hide': False, 'user': 'user-{}'.format(users // 2)},
+        {'hide': False, 'status': 'Completed'},
+        {'hide': False, 'tags': {'$all': ['paper']}},
+    ]
+
+
+def timed_find(cursor):
+    start = time.perf_counter()
+    jobs = list(cursor.clone())
+    elapsed = time.perf_counter() - start
+    explain = cursor.explain()
+    stats = explain.get('executionStats', {})
+    return {
+        'results': len(jobs),
+        'ms': elapsed * 1000,
+        'stages': plan_stages(explain),
+        'keysExamined': stats.get('totalKeysExamined', None),
+        'docsExamined': stats.get('totalDocsExamined', None),
+    }
+
+
+def run_page(collection, query, page, page_size):
+    """Page `page` (1-based) of `query` with skip, and with the cursor a client would hold at that page."""
+    skip = collection.find(query).sort('_id', -1).skip(page_size * (page - 1)).limit(page_size)
+    result = {'filter': json.dumps(query, sort_keys=True), 'page': page, 'skip': timed_find(skip)}
+    before = list(collection.find(query, {'_id': True}).sort('_id', -1).skip(page_size * (page - 1) - 1).limit(1)) \
+        if page > 1 else []
+    cursor_query = dict(query, _id={'$lt': before[0]['_id']}) if before else query
+    result['cursor'] = timed_find(collection.find(cursor_query).sort('_id', -1).limit(page_size))
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default='ktqueue_benchmark')
+    parser.add_argument('--jobs', type=int, default=1000000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--pages', default='1,10,100,1000,10000', help='comma separated pages to compare')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true', help='do not rebuild the collection')
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(settings.mongodb_server)
+    collection = client[args.database].jobs
+    if not args.reuse:
+        start = time.time()
+        populate(collection, args.jobs, args.users, args.seed)
+        print('{} jobs written and indexed in {:.1f}s'.format(args.jobs, time.time() - start))
+
+    pages = [int(page) for page in args.pages.split(',')]
+    results = [run_page(collection, query, page, args.page_size) for query in filters(args.users) for page in pages]
+    print(json.dumps(results, indent=2))
+    for result in results:
+        print('{filter} page {page}: skip {skip:.1f} ms, cursor {cursor:.1f} ms'.format(
+            filter=result['filter'], page=result['page'], skip=result['skip']['ms'], cursor=result['cursor']['ms']))
+
+
+if __name__ == '__main__':
+    main()
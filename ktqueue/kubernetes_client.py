@@ -1,13 +1,92 @@
 # encoding: utf-8
 import os
 import aiohttp
+import asyncio
+import heapq
+import itertools
 import kubernetes
 import json
+import logging
+import random
 import ssl
+import time
+
+from ktqueue import settings
+from ktqueue.metrics import HistogramGroup
+
+PRIORITY_HIGH = 0  # watch & log streams
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2  # bulk operations, e.g. deleting jobs
+
+
+class RateLimiter:
+    """Token bucket shared by all requests, waiting requests are served by priority then FIFO."""
+
+    def __init__(self, qps, burst):
+        self.qps = qps
+        self.burst = burst
+        self.tokens = burst
+        self.last = time.monotonic()
+        self.waiters = []
+        self.counter = itertools.count()
+        self.timer = None
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.qps)
+        self.last = now
+
+    async def acquire(self, priority=PRIORITY_NORMAL):
+        if self.qps <= 0:  # unlimited
+            return
+        self.refill()
+        if not self.waiters and self.tokens >= 1:
+            self.tokens -= 1
+            return
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), future))
+        self.schedule()
+        await future
+
+    def schedule(self):
+        if self.timer is None and self.waiters:
+            delay = max(0, (1 - self.tokens) / self.qps)
+            self.timer = asyncio.get_event_loop().call_later(delay, self.wakeup)
+
+    def wakeup(self):
+        self.timer = None
+        self.refill()
+        while self.waiters and self.tokens >= 1:
+            _, _, future = heapq.heappop(self.waiters)
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+        self.schedule()
+
+
+def endpoint_of(method, api):
+    """Turn `GET /api/v1/namespaces/ktqueue/pods/foo/log` into `GET /api/v1/namespaces/{namespace}/pods/{name}/log`."""
+    parts = api.strip('/').split('/')
+    prefix_len = 2 if parts[0] == 'api' else 3
+    prefix, rest = parts[:prefix_len], parts[prefix_len:]
+    result = []
+    if rest[:1] == ['watch']:
+        result.append(rest.pop(0))
+    if rest[:1] == ['namespaces'] and len(rest) > 1:
+        result += ['namespaces', '{namespace}']
+        rest = rest[2:]
+    if rest:
+        result.append(rest[0])
+    if len(rest) > 1:
+        result.append('{name}')
+    result += rest[2:]
+    return '{} /{}'.format(method, '/'.join(prefix + result))
 
 
 class kubernetes_client:
 
+    retry_status = (429, 500, 502, 503, 504)
+
     def __init__(self, config=None):
         if config is None:
             config = self.get_service_account_config()
@@ -18,18 +97,32 @@ class kubernetes_client:
         self.schema = config['schema']
         self.api_preifx = "{schema}://{host}:{port}".format(schema=self.schema, host=self.host, port=self.port)
         self.ca_crt = None
-        self.session = self.new_connector_session()
+        self.session = self.new_connector_session(limit=settings.k8s_pool_size)
+        # long running watch / follow log requests have their own pool, they never starve short requests
+        self.watch_session = self.new_connector_session(limit=settings.k8s_watch_pool_size)
+        self.rate_limiter = RateLimiter(qps=settings.k8s_qps, burst=settings.k8s_burst)
+        self.max_retries = settings.k8s_max_retries
+        self.latency = HistogramGroup()
+        self.counters = {
+            'requests': 0,
+            'retries': 0,
+            'errors': 0,
+        }
 
-    def new_connector_session(self):
+    def new_connector_session(self, limit=None):
         """
-        1 TCPConnector can handle 20 connections by default.
+        Connections are kept alive and reused, at most `limit` connections are opened.
         """
+        kwargs = {
+            'limit': limit or settings.k8s_pool_size,
+            'keepalive_timeout': settings.k8s_keepalive_timeout,
+        }
         if self.schema == 'https':
             self.ca_crt = kubernetes.config.incluster_config.SERVICE_CERT_FILENAME
             sslcontext = ssl.create_default_context(cafile=self.ca_crt)
-            conn = aiohttp.TCPConnector(ssl_context=sslcontext)
+            conn = aiohttp.TCPConnector(ssl_context=sslcontext, **kwargs)
         else:
-            conn = aiohttp.TCPConnector()
+            conn = aiohttp.TCPConnector(**kwargs)
         return aiohttp.ClientSession(connector=conn)
 
     @classmethod
@@ -47,7 +140,10 @@ class kubernetes_client:
 
     async def call_api(self, api, method='GET', **kwargs):
         resp = await self.call_api_raw(api=api, method=method, **kwargs)
-        text = await resp.text()
+        try:
+            text = await resp.text()
+        finally:
+            resp.release()
         try:
             result = json.loads(text)
         except Exception as e:
@@ -57,12 +153,70 @@ class kubernetes_client:
         else:
             return result
 
+    async def list_all(self, api, params=None, limit=500, **kwargs):
+        """LIST a collection page by page with `limit` / `continue`.
+            return (items, resourceVersion of the list)
+        """
+        params = dict(params or {})
+        params['limit'] = limit
+        items = []
+        resource_version = None
+        while True:
+            ret = await self.call_api(api=api, method='GET', params=params, **kwargs)
+            if 'items' not in ret:
+                raise Exception('LIST {} failed: {}'.format(api, ret.get('message', ret)))
+            items += ret['items']
+            # every page is served from the snapshot of the first one
+            resource_version = resource_version or ret['metadata']['resourceVersion']
+            if not ret['metadata'].get('continue', None):
+                return items, resource_version
+            params['continue'] = ret['metadata']['continue']
+
+    def backoff(self, attempt, resp=None):
+        """Full jitter exponential backoff, `Retry-After` of a 429 response is respected."""
+        if resp is not None and resp.status == 429 and resp.headers.get('Retry-After', '').isdigit():
+            return int(resp.headers['Retry-After'])
+        return random.uniform(0, min(settings.k8s_backoff_max, settings.k8s_backoff_base * 2 ** attempt))
+
+    def should_retry(self, method, status=None):
+        if status == 429:  # request was rejected, safe to retry any method
+            return True
+        # a POST may have been applied, retrying it could create things twice
+        return method != 'POST' and (status is None or status in self.retry_status)
+
     async def call_api_raw(self, api, method='GET', **kwargs):
         session = kwargs.pop('session', self.session)
+        priority = kwargs.pop('priority', PRIORITY_NORMAL)
         url = self.api_preifx + api
         headers = kwargs.pop('headers', {})
         headers['Authorization'] = 'Bearer {token}'.format(token=self.token)
         headers['Content-Type'] = headers.get('Content-Type', 'application/json')
         if 'data' in kwargs and (isinstance(kwargs['data'], dict) or isinstance(kwargs['data'], list)):
             kwargs['data'] = json.dumps(kwargs['data'])
-        return await session.request(method, url, headers=headers, **kwargs)
+        endpoint = endpoint_of(method, api)
+
+        attempt = 0
+        while True:
+            await self.rate_limiter.acquire(priority)
+            self.counters['requests'] += 1
+            start = time.time()
+            try:
+                resp = await session.request(method, url, headers=headers, **kwargs)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                self.latency.observe(endpoint, time.time() - start)
+                self.counters['errors'] += 1
+                if attempt >= self.max_retries or not self.should_retry(method):
+                    raise
+                delay = self.backoff(attempt)
+                logging.warning('{} failed: {!r}, retry in {:.2f}s'.format(endpoint, e, delay))
+            else:
+                self.latency.observe(endpoint, time.time() - start)
+                if attempt >= self.max_retries or resp.status not in self.retry_status or \
+                        not self.should_retry(method, resp.status):
+                    return resp
+                delay = self.backoff(attempt, resp)
+                logging.warning('{} returned {}, retry in {:.2f}s'.format(endpoint, resp.status, delay))
+                resp.release()
+            self.counters['retries'] += 1
+            attempt += 1
+            await asyncio.sleep(delay)
@@ -0,0 +1,165 @@
+# encoding: utf-8
+import asyncio
+import logging
+from collections import deque
+
+from ktqueue import settings
+from ktqueue.kubernetes_client import PRIORITY_HIGH
+
+
+class LogSubscriber:
+    """Chunks of a followed log for one viewer, buffered up to `limit` bytes.
+
+    A viewer too slow to keep up skips ahead: its buffered chunks are
+    dropped and replaced by a note of how many bytes were skipped.
+    """
+
+    def __init__(self, stream, limit=None):
+        self.stream = stream
+        self.limit = limit or settings.log_hub_subscriber_buffer
+        self.chunks = deque()
+        self.size = 0
+        self.skipped = 0
+        self.ended = False
+        self.event = asyncio.Event()
+
+    def offer(self, chunk):
+        if self.ended:
+            return
+        if self.size + len(chunk) > self.limit:
+            dropped = self.size
+            self.skipped += dropped
+            self.stream.hub.counters['skipped_bytes'] += dropped
+            self.chunks.clear()
+            note = '\n[ktqueue: skipped {} bytes, the connection is too slow]\n'.format(dropped).encode('utf-8')
+            self.chunks.append(note)
+            self.size = len(note)
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        self.event.set()
+
+    def end(self):
+        self.ended = True
+        self.event.set()
+
+    async def get(self):
+        """Next chunk, None at the end of the log or after close()."""
+        while not self.chunks:
+            if self.ended:
+                return None
+            self.event.clear()
+            await self.event.wait()
+        chunk = self.chunks.popleft()
+        self.size -= len(chunk)
+        return chunk
+
+    def close(self):
+        """Unsubscribe, the upstream is closed with its last subscriber."""
+        self.chunks.clear()
+        self.end()
+        self.stream.unsubscribe(self)
+
+
+class PodLogStream:
+    """One `follow` log request of a pod, broadcast to its subscribers.
+
+    The latest `backlog` bytes are kept, a new subscriber starts with
+    their last `tail_lines` lines and then receives live chunks.
+    """
+
+    def __init__(self, hub, k8s_client, pod_name, backlog=None):
+        self.hub = hub
+        self.k8s_client = k8s_client
+        self.pod_name = pod_name
+        self.backlog_limit = backlog or settings.log_hub_backlog
+        self.backlog = deque()
+        self.backlog_size = 0
+        self.subscribers = set()
+        self.task = None
+        self.ended = False
+
+    def subscribe(self, tail_lines):
+        subscriber = LogSubscriber(self)
+        if tail_lines > 0 and self.backlog:
+            data = b''.join(self.backlog)
+            lines = data.splitlines(True)
+            subscriber.offer(b''.join(lines[-tail_lines:]))
+        if self.ended:
+            subscriber.end()
+            return subscriber
+        self.subscribers.add(subscriber)
+        if self.task is None:
+            self.task = asyncio.ensure_future(self.run())
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        self.subscribers.discard(subscriber)
+        if not self.subscribers and not self.ended:
+            self.close()
+
+    def close(self):
+        self.ended = True
+        self.hub.streams.pop(self.pod_name, None)
+        if self.task is not None:
+            self.task.cancel()
+        for subscriber in list(self.subscribers):
+            subscriber.end()
+
+    def broadcast(self, chunk):
+        self.backlog.append(chunk)
+        self.backlog_size += len(chunk)
+        while self.backlog_size > self.backlog_limit and len(self.backlog) > 1:
+            self.backlog_size -= len(self.backlog.popleft())
+        for subscriber in list(self.subscribers):
+            subscriber.offer(chunk)
+
+    async def run(self):
+        self.hub.counters['upstreams'] += 1
+        resp = None
+        try:
+            resp = await self.k8s_client.call_api_raw(
+                method='GET',
+                api='/api/v1/namespaces/{namespace}/pods/{pod_name}/log'.format(
+                    namespace=settings.job_namespace, pod_name=self.pod_name),
+                params={'follow': 'true', 'tailLines': str(settings.log_hub_tail_lines)},
+                timeout=0, session=self.k8s_client.watch_session, priority=PRIORITY_HIGH)
+            if resp.status == 200:
+                async for chunk in resp.content.iter_any():
+                    self.broadcast(chunk)
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            if resp is not None:
+                resp.close()
+            self.task = None
+            if not self.ended:
+                self.close()
+
+
+class LogHub:
+    """Followed logs of pods, one upstream per pod however many viewers it has."""
+
+    def __init__(self):
+        self.streams = {}  # pod name -> PodLogStream
+        self.counters = {
+            'upstreams': 0,
+            'subscriptions': 0,
+            'skipped_bytes': 0,
+        }
+
+    def subscribe(self, k8s_client, pod_name, tail_lines):
+        """Return a LogSubscriber of the log of `pod_name`, starting with its last `tail_lines` lines."""
+        stream = self.streams.get(pod_name, None)
+        if stream is None:
+            stream = self.streams[pod_name] = PodLogStream(self, k8s_client, pod_name)
+        self.counters['subscriptions'] += 1
+        return stream.subscribe(tail_lines)
+
+    def stats(self):
+        return dict(self.counters, streams=len(self.streams),
+                    subscribers=sum(len(stream.subscribers) for stream in self.streams.values()))
+
+
+log_hub = LogHub()
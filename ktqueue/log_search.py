@@ -0,0 +1,557 @@
+# encoding: utf-8
+"""Search archived and live job logs on the server.
+
+A log is scanned a block at a time: a segment of a segmented log, a MiB of
+a plain log, about settings.log_segment_size bytes of a live log. The
+pattern is searched in the whole block, with bytes.find for a literal,
+and only matched lines and their context are sliced out. Scans run in
+their own thread pool, so a search never holds up other filesystem
+operations, a regex is searched in a worker process killed when it runs
+longer than settings.log_search_regex_timeout. Every match is streamed as
+it is found:
+    {'job': 'a', 'version': 3, 'line': 120, 'text': '...', 'before': [...], 'after': [...]}
+`line` is 0-based like startLine of the log API, `version` is 'current'
+for the log of a running pod. Throughput in MB/s is measured by:
+    python -m ktqueue.log_search benchmark --size 256  # MiB of synthetic log
+"""
+import argparse
+import asyncio
+import collections
+import functools
+import json
+import logging
+import multiprocessing
+import os
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from re import _parser as sre_parse  # python >= 3.11
+except ImportError:
+    import sre_parse
+
+from ktqueue import settings
+from ktqueue import log_store
+from ktqueue.kubernetes_client import PRIORITY_HIGH
+
+MAX_LINE_LENGTH = 4096  # bytes of a line returned, longer lines are cut
+
+LogSource = collections.namedtuple('LogSource', ['job', 'version', 'pod_name'])
+
+REPEATS = tuple(getattr(sre_parse, op) for op in ('MAX_REPEAT', 'MIN_REPEAT', 'POSSESSIVE_REPEAT') if hasattr(sre_parse, op))
+MAX_NESTED_REPEAT = 10  # a group repeated at most this many times may contain quantifiers, e.g. (\d{1,3}\.){3}
+
+
+def check_regex(pattern, in_repeat=False):
+    """Raise ValueError if the parsed `pattern` may backtrack exponentially: backreferences & nested quantifiers.
+        Only a quick answer to obvious cases, e.g. (a|aa)*x passes, RegexPool bounds the time of any pattern.
+    """
+    for op, av in pattern:
+        if op in (sre_parse.GROUPREF, sre_parse.GROUPREF_EXISTS):
+            raise ValueError('backreferences are not supported')
+        if op in REPEATS:
+            if in_repeat and av[1] > 1:
+                raise ValueError('nested quantifiers are not supported, e.g. (a+)*')
+            check_regex(av[2], in_repeat or av[1] > MAX_NESTED_REPEAT)
+            continue
+        items = list(av) if isinstance(av, (list, tuple)) else [av]
+        while items:  # subpatterns of groups, branches & lookarounds
+            item = items.pop()
+            if isinstance(item, sre_parse.SubPattern):
+                check_regex(item, in_repeat)
+            elif isinstance(item, (list, tuple)):
+                items.extend(item)
+
+
+def regex_find(regex, haystack, position=0):
+    found = regex.search(haystack, position)
+    return found.start() if found is not None else -1
+
+
+def match_lines(find, haystack, limit=None):
+    """Start of the first match of every line of `haystack`, which ends with a newline, at most `limit` of them."""
+    starts, position = [], 0
+    while limit is None or len(starts) < limit:
+        found = find(haystack, position)
+        if not 0 <= found < len(haystack):
+            break
+        starts.append(found)
+        position = haystack.index(b'\n', found) + 1  # the next line, one match per line
+    return starts
+
+
+def regex_worker(conn):
+    """Main of a RegexPool process: receive (pattern, flags, haystack, limit), send match_lines() or an exception."""
+    compiled = {}
+    while True:
+        try:
+            pattern, flags, haystack, limit = conn.recv()
+        except EOFError:
+            return
+        try:
+            if (pattern, flags) not in compiled:
+                compiled.clear()
+                compiled[(pattern, flags)] = re.compile(pattern, flags)
+            result = match_lines(functools.partial(regex_find, compiled[(pattern, flags)]), haystack, limit)
+        except Exception as e:
+            result = e
+        conn.send(result)
+
+
+class RegexTimeout(Exception):
+    pass
+
+
+class RegexPool:
+    """Processes searching regular expressions, one killed with its search once it runs longer than `timeout`.
+        The regex engine holds the GIL, a pattern backtracking exponentially in a thread would freeze the
+        whole server. Processes are started when needed and kept for the next searches.
+    """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout or settings.log_search_regex_timeout
+        self.context = multiprocessing.get_context('spawn')  # the server has threads, don't fork it
+        self.idle = []  # (process, connection)
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        with self.lock:
+            if self.idle:
+                return self.idle.pop()
+        conn, child_conn = self.context.Pipe()
+        process = self.context.Process(target=regex_worker, args=(child_conn,), daemon=True)
+        process.start()
+        child_conn.close()
+        return process, conn
+
+    def match_lines(self, regex, haystack, limit=None):
+        """match_lines() of `regex` in a process, blocking. Raise RegexTimeout if it takes too long."""
+        process, conn = self.acquire()
+        try:
+            conn.send((regex.pattern, regex.flags, haystack, limit))
+            if not conn.poll(self.timeout):
+                raise RegexTimeout('regex search timed out after {} seconds, try a simpler pattern'.format(
+                    self.timeout))
+            result = conn.recv()
+        except BaseException:
+            process.terminate()
+            process.join()
+            conn.close()
+            raise
+        with self.lock:
+            self.idle.append((process, conn))
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+
+regex_pool = RegexPool()
+
+
+class LogPattern:
+    """A literal or a regular expression searched in blocks of a log.
+        Literals are searched with bytes.find, many times faster than the regex engine. Case is ignored
+        for ASCII letters only, as re.IGNORECASE does on bytes. A regex is searched in a process of
+        `regex_pool`. Raise ValueError if it is invalid or rejected by check_regex().
+    """
+
+    def __init__(self, q, regex=False, ignore_case=False, pool=None):
+        if not q:
+            raise ValueError('q is required')
+        self.ignore_case = ignore_case
+        self.literal = None
+        self.regex = None
+        self.regex_pool = pool or regex_pool
+        if not regex:
+            self.literal = q.encode('utf-8').lower() if ignore_case else q.encode('utf-8')
+            return
+        flags = re.MULTILINE | (re.IGNORECASE if ignore_case else 0)
+        try:
+            check_regex(sre_parse.parse(q.encode('utf-8'), flags))
+            self.regex = re.compile(q.encode('utf-8'), flags)
+        except re.error as e:
+            raise ValueError('invalid regex: {}'.format(e))
+
+    def prepare(self, block):
+        """What find() searches in, positions are the same as in `block`."""
+        return block.lower() if self.literal is not None and self.ignore_case else block
+
+    def find(self, haystack, position=0):
+        """Start of the first match at or after `position`, -1 if none. A regex is searched in this process."""
+        if self.literal is not None:
+            return haystack.find(self.literal, position)
+        return regex_find(self.regex, haystack, position)
+
+    def match_lines(self, haystack, limit=None):
+        """Start of the first match of every line of `haystack`, at most `limit` of them. Raise RegexTimeout."""
+        if self.literal is not None:
+            return match_lines(self.find, haystack, limit)
+        return self.regex_pool.match_lines(self.regex, haystack, limit)
+
+
+def decode_line(line):
+    return line[:MAX_LINE_LENGTH].decode('utf-8', 'replace').rstrip('\r')
+
+
+def lines_before(block, end, count):
+    """Up to `count` lines of `block` before `end`, a line start."""
+    start, lines = end, 0
+    while lines < count and start > 0:
+        start = block.rfind(b'\n', 0, start - 1) + 1
+        lines += 1
+    return block[start:end - 1].split(b'\n') if lines else []
+
+
+def lines_after(block, start, count):
+    """Up to `count` lines of `block` from `start`, a line start. `block` ends with a newline."""
+    end, lines = start, 0
+    while lines < count and end < len(block):
+        end = block.index(b'\n', end) + 1
+        lines += 1
+    return block[start:end - 1].split(b'\n') if lines else []
+
+
+class LogScanner:
+    """Search one log fed a block at a time, every call returns the matches finished.
+        A match is finished once the `context` lines after it are seen, or at the end of the log.
+        Blocking, feed() and close() should run in the search pool.
+    """
+
+    def __init__(self, pattern, context=0, max_matches=None):
+        self.pattern = pattern
+        self.context = context
+        self.max_matches = max_matches
+        self.line = 0  # number of the next complete line
+        self.partial = []  # chunks of a line not ended yet
+        self.before = collections.deque(maxlen=context)
+        self.pending = []  # matches waiting for lines after them
+        self.matches = 0
+        self.scanned = 0
+
+    @property
+    def full(self):
+        return self.max_matches is not None and self.matches >= self.max_matches
+
+    @property
+    def done(self):
+        """Nothing more will be found."""
+        return self.full and not self.pending
+
+    def feed(self, data):
+        self.scanned += len(data)
+        end = data.rfind(b'\n') + 1
+        if not end:
+            self.partial.append(data)
+            return []
+        if self.partial:
+            self.partial.append(data[:end])
+            block = b''.join(self.partial)
+        else:
+            block = data if end == len(data) else data[:end]
+        self.partial = [data[end:]] if end < len(data) else []
+        return self.scan(block)
+
+    def close(self):
+        """End of the log, return the matches left."""
+        finished = []
+        if self.partial:
+            finished = self.scan(b''.join(self.partial) + b'\n')
+            self.partial = []
+        finished += self.pending
+        self.pending = []
+        return finished
+
+    def scan(self, block):
+        """Search the complete lines of `block`, only matches and their context are split into lines."""
+        haystack = self.pattern.prepare(block)
+        limit = self.max_matches - self.matches if self.max_matches is not None else None
+        starts = [] if self.full else self.pattern.match_lines(haystack, limit)
+        finished = []
+        if self.pending:
+            head = [decode_line(line) for line in lines_after(block, 0, self.context)]
+            for match in self.pending:
+                match['after'] += head[:self.context - len(match['after'])]
+            finished += [match for match in self.pending if len(match['after']) >= self.context]
+            self.pending = [match for match in self.pending if len(match['after']) < self.context]
+
+        index = position = 0
+        for found in starts:
+            index += block.count(b'\n', position, found)
+            start = block.rfind(b'\n', 0, found) + 1
+            position = block.index(b'\n', found) + 1
+            before = lines_before(block, start, self.context)
+            needed = self.context - len(before)
+            if needed and self.before:
+                before = list(self.before)[-needed:] + before
+            match = {
+                'line': self.line + index,
+                'text': decode_line(block[start:position - 1]),
+                'before': [decode_line(line) for line in before],
+                'after': [decode_line(line) for line in lines_after(block, position, self.context)],
+            }
+            (finished if len(match['after']) >= self.context else self.pending).append(match)
+            self.matches += 1
+            index += 1
+
+        self.line += index + block.count(b'\n', position)
+        if self.context:
+            self.before.extend(lines_before(block, len(block), self.context))
+        return finished
+
+
+class LogSearchPool:
+    """Threads scanning logs, apart from the fs executor. zlib releases the GIL, the regex engine does not."""
+
+    def __init__(self, max_workers=None):
+        self.max_workers = max_workers or settings.log_search_workers
+        self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self.counters = {
+            'searches': 0,
+            'logs': 0,
+            'scanned_bytes': 0,
+            'matches': 0,
+            'regex_timeouts': 0,
+        }
+
+    async def run(self, fn, *args):
+        return await asyncio.get_event_loop().run_in_executor(self.executor, functools.partial(fn, *args))
+
+
+search_pool = LogSearchPool()
+
+
+class LogSearch:
+    """One search over logs of jobs, `await emit(matches)` is called with matches as they are found.
+        It stops after `max_matches` matches in all, `truncated` tells if there were more.
+    """
+
+    def __init__(self, pattern, emit, context=0, max_matches=1000, pool=None):
+        self.pattern = pattern
+        self.emit = emit
+        self.context = context
+        self.max_matches = max_matches
+        self.pool = pool or search_pool
+        self.matches = 0
+        self.scanned_bytes = 0
+        self.truncated = False
+        self.stopped = False
+        self.errors = []
+
+    def stop(self):
+        self.stopped = True
+
+    async def send(self, source, matches):
+        if self.stopped or not matches:
+            return
+        if self.matches + len(matches) > self.max_matches:
+            matches = matches[:self.max_matches - self.matches]
+            self.truncated = True
+            self.stop()
+        for match in matches:
+            match['job'], match['version'] = source.job, source.version
+        self.matches += len(matches)
+        self.pool.counters['matches'] += len(matches)
+        if matches:
+            await self.emit(matches)
+
+    async def scan_archived(self, source, scanner):
+        reader = await self.pool.run(log_store.open_log, source.job, source.version)
+        chunks = reader.read_bytes()
+
+        def step():
+            chunk = next(chunks, None)
+            if chunk is None:
+                return scanner.close(), True
+            return scanner.feed(chunk), False
+
+        try:
+            last = False
+            while not last and not scanner.done and not self.stopped:
+                matches, last = await self.pool.run(step)
+                await self.send(source, matches)
+        finally:
+            chunks.close()
+
+    async def scan_live(self, source, scanner, k8s_client):
+        resp = await k8s_client.call_api_raw(
+            method='GET',
+            api='/api/v1/namespaces/{namespace}/pods/{pod_name}/log'.format(
+                namespace=settings.job_namespace, pod_name=source.pod_name),
+            timeout=0, session=k8s_client.watch_session, priority=PRIORITY_HIGH)
+        try:
+            if resp.status != 200:
+                return
+            buffer, buffered = [], 0
+            async for chunk in resp.content.iter_any():
+                buffer.append(chunk)
+                buffered += len(chunk)
+                if buffered >= settings.log_segment_size:
+                    await self.send(source, await self.pool.run(scanner.feed, b''.join(buffer)))
+                    buffer, buffered = [], 0
+                    if scanner.done or self.stopped:
+                        return
+            matches = await self.pool.run(scanner.feed, b''.join(buffer))
+            await self.send(source, matches + await self.pool.run(scanner.close))
+        finally:
+            resp.close()
+
+    async def scan(self, source, k8s_client=None):
+        if self.stopped:
+            return
+        self.pool.counters['logs'] += 1
+        # one more than the cap, to tell if the results are truncated
+        scanner = LogScanner(self.pattern, self.context, self.max_matches + 1)
+        try:
+            if source.version == 'current':
+                await self.scan_live(source, scanner, k8s_client)
+            else:
+                await self.scan_archived(source, scanner)
+        except FileNotFoundError:
+            self.errors.append({'job': source.job, 'version': source.version, 'message': 'log not found'})
+        except RegexTimeout as e:  # would be as slow in other logs
+            self.pool.counters['regex_timeouts'] += 1
+            self.errors.append({'job': source.job, 'version': source.version, 'message': str(e)})
+            self.stop()
+        except Exception as e:
+            if self.stopped:  # the client is gone
+                return
+            logging.exception(e)
+            self.errors.append({'job': source.job, 'version': source.version, 'message': str(e)})
+        finally:
+            self.scanned_bytes += scanner.scanned
+            self.pool.counters['scanned_bytes'] += scanner.scanned
+
+    async def run(self, sources, k8s_client=None):
+        """Scan `sources` (LogSource), as many at a time as the pool has workers."""
+        self.pool.counters['searches'] += 1
+        semaphore = asyncio.Semaphore(self.pool.max_workers)
+
+        async def scan(source):
+            async with semaphore:
+                await self.scan(source, k8s_client)
+
+        await asyncio.gather(*[scan(source) for source in sources])
+
+
+async def log_sources(db, k8s_client, jobs, versions=None):
+    """LogSource of every log of `jobs`, only `versions` (numbers as str, or 'current') if given.
+        By default the version being shipped from a running pod is left out, its log is searched as 'current'.
+    """
+    from ktqueue.fs import fs
+    from ktqueue.pod_cache import pod_cache
+    sources = []
+    for job in jobs:
+        directory = log_store.log_dir(job)
+        archived = log_store.log_versions(await fs.listdir(directory)) if await fs.isdir(directory) else []
+        pods = await pod_cache.get_job_pods(k8s_client, job)
+        pod_name = pods[0]['metadata']['name'] if pods else None
+        shipping = None
+        if pod_name and versions is None:
+            checkpoint = await db.log_checkpoints.find_one(
+                {'_id': pod_name, 'done': {'$ne': True}}, projection={'version': True})
+            shipping = checkpoint.get('version', None) if checkpoint else None
+        for version in archived:
+            if version != shipping and (versions is None or str(version) in versions):
+                sources.append(LogSource(job, version, None))
+        if pod_name and (versions is None or 'current' in versions):
+            sources.append(LogSource(job, 'current', pod_name))
+    return sources
+
+
+def per_line_search(path, pattern):
+    """Baseline: what a script grepping a downloaded log does, a line at a time."""
+    count = 0
+    with open(path, 'rb') as f:
+        for line in f:
+            if pattern.find(pattern.prepare(line)) >= 0:
+                count += 1
+    return count
+
+
+def scan_reader(reader, pattern, context):
+    scanner = LogScanner(pattern, context)
+    count = 0
+    for chunk in reader.read_bytes():
+        count += len(scanner.feed(chunk))
+    return count + len(scanner.close())
+
+
+def benchmark(size, context=2, logs=8, workers=None, directory=None):
+    directory = tempfile.mkdtemp(dir=directory)
+    try:
+        plain = os.path.join(directory, 'job-0', 'log.1.txt')
+        os.makedirs(os.path.dirname(plain))
+        log_store.synthetic_log(plain, size)
+        log_store.convert(plain, keep=True)
+        segmented = plain + '.gz'
+        megabytes = os.path.getsize(plain) / 1e6
+        patterns = [
+            ('rare literal', LogPattern('WARNING:tensorflow')),
+            ('literal', LogPattern('loss=2.99')),
+            ('ignore case', LogPattern('warning', ignore_case=True)),
+            ('regex', LogPattern(r'loss=(?:2\.99\d+|nan)', regex=True)),
+        ]
+        results = {'size': os.path.getsize(plain), 'context': context, 'mb_per_s': {}, 'matches': {}}
+        for name, pattern in patterns:
+            expected = per_line_search(plain, pattern)
+            results['matches'][name] = expected
+            results['mb_per_s'][name] = {}
+            for method, fn in [('per_line', lambda: per_line_search(plain, pattern)),
+                               ('plain', lambda: scan_reader(log_store.PlainLogReader(plain), pattern, context)),
+                               ('segmented', lambda: scan_reader(log_store.SegmentedLogReader(segmented), pattern, context))]:
+                ms, count = log_store.timed(fn, repeat=3)
+                assert count == expected, (name, method, count, expected)
+                results['mb_per_s'][name][method] = megabytes / ms * 1000
+
+        # `logs` jobs searched at once through the pool, as the API does
+        for i in range(1, logs):
+            job_dir = os.path.join(directory, 'job-{}'.format(i))
+            os.makedirs(job_dir)
+            for filename in ('log.1.txt.gz', 'log.1.idx'):
+                shutil.copy(os.path.join(directory, 'job-0', filename), job_dir)
+        log_store.LOG_ROOT = directory  # this process only serves the benchmark
+        pool = LogSearchPool(workers)
+        sources = [LogSource('job-{}'.format(i), 1, None) for i in range(logs)]
+
+        async def emit(matches):
+            pass
+
+        name, pattern = patterns[-1]
+        search = LogSearch(pattern, emit, context=context, max_matches=10 ** 9, pool=pool)
+        start = time.perf_counter()
+        asyncio.get_event_loop().run_until_complete(search.run(sources))
+        elapsed = time.perf_counter() - start
+        assert search.matches == results['matches'][name] * logs and not search.errors
+        results['pool'] = {'logs': logs, 'workers': pool.max_workers, 'pattern': name,
+                           'mb_per_s': megabytes * logs / elapsed}
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    parser_benchmark = subparsers.add_parser('benchmark', help='search throughput in MB/s of uncompressed log')
+    parser_benchmark.add_argument('--size', type=float, default=256, help='MiB of synthetic log')
+    parser_benchmark.add_argument('--context', type=int, default=2)
+    parser_benchmark.add_argument('--logs', type=int, default=8, help='logs searched at once through the pool')
+    parser_benchmark.add_argument('--workers', type=int, default=None)
+    parser_benchmark.add_argument('--dir', default=None, help='where to write, e.g. on CephFS')
+    args = parser.parse_args()
+
+    if args.command == 'benchmark':
+        print(json.dumps(benchmark(int(args.size * 1024 * 1024), args.context, args.logs, args.workers, args.dir),
+                         indent=2, sort_keys=True))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,282 @@
+# encoding: utf-8
+import asyncio
+import datetime
+import logging
+import time
+
+import pymongo
+import pymongo.errors
+
+from ktqueue import settings
+from ktqueue import log_store
+from ktqueue.cluster import process_identity
+from ktqueue.fs import fs
+from ktqueue.kubernetes_client import PRIORITY_HIGH
+from ktqueue.pod_cache import pod_cache
+
+
+def timestamp_key(timestamp):
+    """Sortable key of a RFC3339Nano timestamp, whose fraction may be shortened."""
+    seconds, _, fraction = timestamp.rstrip('Z').partition('.')
+    return seconds, int(fraction.ljust(9, '0')[:9] or 0)
+
+
+def since_time(timestamp):
+    """sinceTime of kubernetes only has seconds."""
+    return timestamp.partition('.')[0].rstrip('Z') + 'Z'
+
+
+class LogCheckpoint:
+    """The last line shipped of a pod log: its timestamp and how many lines had it, several lines may have the same."""
+
+    def __init__(self, doc):
+        self.last_timestamp = doc.get('lastTimestamp', None)
+        self.last_key = timestamp_key(self.last_timestamp) if self.last_timestamp else None
+        self.last_count = doc.get('lastTimestampLines', 0)
+        # lines up to (last_key, last_count) are shipped already, skipped when the stream is resumed
+        self.resume_key, self.resume_count, self.seen = self.last_key, self.last_count, 0
+
+    def filter(self, lines):
+        """Strip timestamps of `lines` (b'<timestamp> <line>'), skipping those shipped before, return the new lines."""
+        new_lines = []
+        for line in lines:
+            timestamp, _, text = line.partition(b' ')
+            try:
+                timestamp = timestamp.decode('ascii')
+                key = timestamp_key(timestamp)
+            except (UnicodeDecodeError, ValueError):  # not prefixed, e.g. a line cut by the apiserver
+                new_lines.append(line)
+                continue
+            if self.resume_key is not None:
+                if key < self.resume_key:
+                    continue
+                if key == self.resume_key:
+                    self.seen += 1
+                    if self.seen <= self.resume_count:
+                        continue
+                self.resume_key = None
+            if key == self.last_key:
+                self.last_count += 1
+            else:
+                self.last_key, self.last_count = key, 1
+            self.last_timestamp = timestamp
+            new_lines.append(text)
+        return new_lines
+
+
+class LogShipper:
+    """Copy logs of running job pods to the archived log while they run, so little is lost if
+    a node dies and little is left to save when a pod terminates.
+
+    The leader follows every running job pod with `timestamps=true`, new
+    lines are appended to the segmented log (ktqueue.log_store) and a
+    checkpoint is recorded in `log_checkpoints` every
+    settings.log_checkpoint_interval seconds. A stream that breaks is
+    resumed from the checkpoint with `sinceTime`, lines up to the last
+    shipped timestamp are skipped and whatever was written after the
+    checkpoint is truncated. One process ships a pod at a time, it holds
+    the checkpoint with a lease, save_job_log asks the holder to stop and
+    ships the rest itself.
+    """
+
+    def __init__(self, db):
+        self.collection = db.log_checkpoints
+        self.identity = process_identity()
+        self.tasks = {}  # pod name -> following task
+        self.stopping = set()  # pod names
+        self.version_lock = asyncio.Lock()
+        self.counters = {
+            'follows': 0,
+            'checkpoints': 0,
+            'shipped_bytes': 0,
+            'finished': 0,
+        }
+
+    def lease_expire_at(self):
+        return datetime.datetime.utcnow() + datetime.timedelta(seconds=settings.log_ship_lease_ttl)
+
+    async def claim(self, job_name, pod_name):
+        """Hold the checkpoint of a pod, created if missing. None if another process holds it or it's done."""
+        doc = await self.collection.find_one_and_update(
+            {'_id': pod_name, 'done': {'$ne': True}, '$or': [
+                {'owner': None}, {'owner': self.identity}, {'leaseExpireAt': {'$lt': datetime.datetime.utcnow()}}]},
+            {'$set': {'owner': self.identity, 'leaseExpireAt': self.lease_expire_at(), 'stopRequested': False}},
+            return_document=pymongo.ReturnDocument.AFTER)
+        if doc is not None:
+            return doc
+        doc = {'_id': pod_name, 'job': job_name, 'version': None, 'offset': 0, 'owner': self.identity,
+               'leaseExpireAt': self.lease_expire_at(), 'stopRequested': False, 'done': False,
+               'updatedAt': datetime.datetime.utcnow()}
+        try:
+            await self.collection.insert_one(doc)
+        except pymongo.errors.DuplicateKeyError:
+            return None
+        return doc
+
+    async def release(self, pod_name, done=False):
+        update = {'owner': None, 'updatedAt': datetime.datetime.utcnow()}
+        if done:
+            update['done'] = True
+        await self.collection.update_one({'_id': pod_name, 'owner': self.identity}, {'$set': update})
+
+    async def open_writer(self, doc):
+        """SegmentedLogWriter appending at the checkpoint, the log version is allocated at the first time."""
+        if doc['version'] is None:
+            async with self.version_lock:
+                await fs.makedirs(log_store.log_dir(doc['job']))
+                versions = log_store.log_versions(await fs.listdir(log_store.log_dir(doc['job'])))
+                doc['version'] = max(versions + [0]) + 1
+                writer = await fs.run('open', log_store.SegmentedLogWriter,
+                                      log_store.segmented_path(doc['job'], doc['version']))
+            await self.collection.update_one({'_id': doc['_id']}, {'$set': {'version': doc['version']}})
+            return writer
+        return await fs.run('open', log_store.SegmentedLogWriter,
+                            log_store.segmented_path(doc['job'], doc['version']), append_at=doc['offset'])
+
+    async def checkpoint(self, doc, writer, checkpoint, pending):
+        """Write `pending` lines as a segment and record the checkpoint, False if this process must stop."""
+        if pending:
+            data = b''.join(pending)
+            await fs.run('write', writer.write_segment, data)
+            self.counters['shipped_bytes'] += len(data)
+        self.counters['checkpoints'] += 1
+        result = await self.collection.update_one(
+            {'_id': doc['_id'], 'owner': self.identity, 'stopRequested': {'$ne': True}},
+            {'$set': {
+                'offset': writer.offset,
+                'size': writer.raw_offset,
+                'lastTimestamp': checkpoint.last_timestamp,
+                'lastTimestampLines': checkpoint.last_count,
+                'leaseExpireAt': self.lease_expire_at(),
+                'updatedAt': datetime.datetime.utcnow(),
+            }})
+        return result.matched_count == 1
+
+    async def ship(self, doc, k8s_client, follow=False):
+        """Ship the log of a claimed pod from its checkpoint, until the end of log (or until stopped with `follow`).
+            Return False if stopped.
+        """
+        pod_name = doc['_id']
+        checkpoint = LogCheckpoint(doc)
+        params = {'timestamps': 'true'}
+        if follow:
+            params['follow'] = 'true'
+        if checkpoint.last_timestamp:
+            params['sinceTime'] = since_time(checkpoint.last_timestamp)
+        resp = await k8s_client.call_api_raw(
+            method='GET',
+            api='/api/v1/namespaces/{namespace}/pods/{pod_name}/log'.format(
+                namespace=settings.job_namespace, pod_name=pod_name),
+            params=params, priority=PRIORITY_HIGH,
+            **({'timeout': 0, 'session': k8s_client.watch_session} if follow else {}))
+        writer = None
+        try:
+            if resp.status != 200:  # pod is gone, what was shipped is all there is
+                logging.info('Ship log of {}, resp.status = {}'.format(pod_name, resp.status))
+                return True
+            writer = await self.open_writer(doc)
+            pending, pending_size, partial = [], 0, b''
+            last_checkpoint = time.time()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(resp.content.readany(), timeout=1)
+                except asyncio.TimeoutError:
+                    chunk = None
+                end = chunk == b''
+                if chunk or (end and partial):
+                    lines = (partial + (chunk or b'')).split(b'\n')
+                    partial = lines.pop() if not end else b''
+                    new_lines = checkpoint.filter(line for line in lines if line)
+                    for line in new_lines:
+                        pending.append(line + b'\n')
+                        pending_size += len(line) + 1
+                stopped = pod_name in self.stopping
+                if end or stopped or pending_size >= writer.segment_size or \
+                        time.time() - last_checkpoint >= settings.log_checkpoint_interval:
+                    if not await self.checkpoint(doc, writer, checkpoint, pending):
+                        return False
+                    pending, pending_size = [], 0
+                    last_checkpoint = time.time()
+                if end:
+                    return True
+                if stopped:
+                    return False
+        finally:
+            resp.close()
+            if writer is not None:
+                await fs.run('close', writer.close)
+
+    async def follow(self, job_name, pod_name, k8s_client):
+        self.counters['follows'] += 1
+        try:
+            doc = await self.claim(job_name, pod_name)
+            if doc is not None:
+                try:
+                    await self.ship(doc, k8s_client, follow=True)
+                finally:
+                    await self.release(pod_name)
+        except Exception as e:
+            logging.exception(e)
+        finally:
+            self.tasks.pop(pod_name, None)
+            self.stopping.discard(pod_name)
+
+    async def finish(self, job_name, pod_name, k8s_client, follow=False):
+        """Ship the rest of the log of a pod and mark it done, with `follow` until its container exits."""
+        task = self.tasks.get(pod_name, None)
+        if task is not None:
+            self.stopping.add(pod_name)
+            await asyncio.wait([task])
+        else:  # another process may be following it
+            await self.collection.update_one(
+                {'_id': pod_name, 'owner': {'$nin': [None, self.identity]}}, {'$set': {'stopRequested': True}})
+        deadline = time.time() + settings.log_ship_lease_ttl + settings.log_checkpoint_interval
+        while True:
+            doc = await self.claim(job_name, pod_name)
+            if doc is not None:
+                break
+            done = await self.collection.find_one({'_id': pod_name, 'done': True}, projection={'_id': True})
+            if done or time.time() > deadline:
+                if not done:
+                    logging.warning('Log of {} is shipped by another process, not saved'.format(pod_name))
+                return
+            await asyncio.sleep(1)
+        try:
+            ended = await self.ship(doc, k8s_client, follow=follow)
+        except BaseException:
+            await self.release(pod_name)
+            raise
+        await self.release(pod_name, done=ended)
+        self.counters['finished'] += 1
+
+    def follow_running_pods(self, k8s_client):
+        for pod in list(pod_cache.pods.values()):
+            labels = pod['metadata'].get('labels') or {}
+            pod_name = pod['metadata']['name']
+            if 'job-name' not in labels or pod_name in self.tasks or \
+                    labels.get('ktqueue-watching', None) == 'false' or labels.get('ktqueue-terminating', None) == 'true':
+                continue
+            statuses = pod['status'].get('containerStatuses', None) or []
+            if statuses and 'running' in (statuses[0].get('state', None) or {}):
+                self.tasks[pod_name] = asyncio.ensure_future(self.follow(labels['job-name'], pod_name, k8s_client))
+
+    async def run(self, k8s_client):
+        """Follow running job pods, run by the leader."""
+        try:
+            while True:
+                if pod_cache.synced:
+                    self.follow_running_pods(k8s_client)
+                await asyncio.sleep(settings.log_checkpoint_interval)
+        finally:  # no longer the leader, followers checkpoint and stop
+            self.stopping.update(self.tasks)
+
+
+_log_shipper = None
+
+
+def get_log_shipper():
+    global _log_shipper
+    if _log_shipper is None:
+        from .db import get_db
+        _log_shipper = LogShipper(get_db())
+    return _log_shipper
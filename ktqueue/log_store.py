@@ -0,0 +1,492 @@
+# encoding: utf-8
+"""Archived job logs, stored as compressed segments with a line index.
+
+Version N of a job log is written to /cephfs/ktqueue/logs/<job>/:
+    log.N.txt.gz   independent gzip members of about `segment_size` bytes of log each,
+                   cut at line ends, so `zcat` still reads the whole log
+    log.N.idx      one line per segment, appended after the segment is written:
+                   offset length first_line newlines raw_offset raw_length
+A line range or the tail is read by decompressing only the segments
+holding it. Segments written after the last index line (the writer died)
+are found by scanning the rest of the file. Old plain `log.N.txt` are
+still readable, and converted by:
+    python -m ktqueue.log_store convert [--keep]
+    python -m ktqueue.log_store benchmark --size 1024  # MiB, compares size & tail latency
+"""
+import argparse
+import bisect
+import json
+import random
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import zlib
+
+from ktqueue import settings
+
+LOG_ROOT = '/cephfs/ktqueue/logs'
+LOG_FILE_PATTERN = re.compile(r'^log\.(?P<id>\d+)\.txt(?P<gz>\.gz)?$')
+
+
+def log_dir(job_name):
+    return os.path.join(LOG_ROOT, job_name)
+
+
+def segmented_path(job_name, version):
+    return os.path.join(log_dir(job_name), 'log.{}.txt.gz'.format(version))
+
+
+def plain_path(job_name, version):
+    return os.path.join(log_dir(job_name), 'log.{}.txt'.format(version))
+
+
+def index_path(path):
+    return path[:-len('.txt.gz')] + '.idx'
+
+
+def log_versions(filenames):
+    """Versions of the log files in `filenames`, plain or segmented."""
+    versions = set()
+    for filename in filenames:
+        match = LOG_FILE_PATTERN.match(filename)
+        if match:
+            versions.add(int(match.group('id')))
+    return sorted(versions)
+
+
+class Segment:
+    __slots__ = ('offset', 'length', 'first_line', 'newlines', 'raw_offset', 'raw_length')
+
+    def __init__(self, offset, length, first_line, newlines, raw_offset, raw_length):
+        self.offset = offset
+        self.length = length
+        self.first_line = first_line  # newlines before this segment
+        self.newlines = newlines
+        self.raw_offset = raw_offset
+        self.raw_length = raw_length
+
+    def to_line(self):
+        return '{} {} {} {} {} {}\n'.format(
+            self.offset, self.length, self.first_line, self.newlines, self.raw_offset, self.raw_length)
+
+
+def compress_segment(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)  # gzip member
+    return compressor.compress(data) + compressor.flush()
+
+
+class SegmentedLogWriter:
+    """File-like writer of a segmented log, `path` is the .txt.gz file. Blocking, run it in fs executor.
+        With `append_at`, the log is truncated to the last segment ending there (e.g. a checkpoint) and appended to.
+    """
+
+    def __init__(self, path, segment_size=None, level=None, append_at=None):
+        self.path = path
+        self.segment_size = segment_size or settings.log_segment_size
+        self.level = settings.log_compress_level if level is None else level
+        self.buffer = bytearray()
+        self.offset = self.lines = self.raw_offset = 0
+        if append_at is None or not os.path.exists(path):
+            self.file = open(path, 'wb')
+            self.index = open(index_path(path), 'w')
+            return
+        segments = [segment for segment in load_index(path) if segment.offset + segment.length <= append_at]
+        if segments:
+            last = segments[-1]
+            self.offset = last.offset + last.length
+            self.lines = last.first_line + last.newlines
+            self.raw_offset = last.raw_offset + last.raw_length
+        self.file = open(path, 'r+b')
+        self.file.truncate(self.offset)
+        self.file.seek(self.offset)
+        self.index = open(index_path(path), 'w')
+        self.index.write(''.join(segment.to_line() for segment in segments))
+        self.index.flush()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= self.segment_size:
+            end = self.buffer.rfind(b'\n', 0, self.segment_size * 2) + 1  # cut at a line end
+            if not end:
+                if len(self.buffer) < self.segment_size * 2:  # wait for the end of a long line
+                    break
+                end = self.segment_size * 2
+            self.write_segment(bytes(self.buffer[:end]))
+            del self.buffer[:end]
+        return len(data)
+
+    def write_segment(self, data):
+        if not data:
+            return
+        compressed = compress_segment(data, self.level)
+        self.file.write(compressed)
+        self.file.flush()
+        segment = Segment(self.offset, len(compressed), self.lines, data.count(b'\n'), self.raw_offset, len(data))
+        self.index.write(segment.to_line())
+        self.index.flush()
+        self.offset += segment.length
+        self.lines += segment.newlines
+        self.raw_offset += segment.raw_length
+
+    def close(self):
+        try:
+            self.write_segment(bytes(self.buffer))
+            self.buffer = bytearray()
+        finally:
+            self.file.close()
+            self.index.close()
+
+
+def scan_segments(f, offset, first_line, raw_offset, block_size=1024 * 1024):
+    """Find the complete gzip members from `offset` to the end of file `f`."""
+    segments = []
+    f.seek(offset)
+    pending = b''
+    while True:
+        block = f.read(block_size)
+        pending += block
+        while pending:
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = decompressor.decompress(pending)
+            except zlib.error:  # garbage after the last complete member
+                return segments
+            if not decompressor.eof:  # incomplete member, read more
+                break
+            length = len(pending) - len(decompressor.unused_data)
+            segment = Segment(offset, length, first_line, data.count(b'\n'), raw_offset, len(data))
+            segments.append(segment)
+            offset += length
+            first_line += segment.newlines
+            raw_offset += segment.raw_length
+            pending = decompressor.unused_data
+        if not block:
+            return segments
+
+
+def load_index(path):
+    """Segments of the segmented log at `path`, from its index and a scan of what the index misses."""
+    segments = []
+    try:
+        with open(index_path(path)) as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) != 6:  # partially written
+                    break
+                segments.append(Segment(*[int(field) for field in fields]))
+    except FileNotFoundError:
+        pass
+    end = segments[-1].offset + segments[-1].length if segments else 0
+    if os.path.getsize(path) > end:
+        last = segments[-1] if segments else None
+        with open(path, 'rb') as f:
+            segments += scan_segments(
+                f, end, last.first_line + last.newlines if last else 0, last.raw_offset + last.raw_length if last else 0)
+    return segments
+
+
+class SegmentedLogReader:
+    """Read byte ranges, line ranges & tail of a segmented log, decompressing only the segments needed.
+        Blocking, every call (and every step of read_bytes) should run in fs executor.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.segments = load_index(path)
+        self.raw_offsets = [segment.raw_offset for segment in self.segments]
+        self.line_ends = [segment.first_line + segment.newlines for segment in self.segments]
+        self.cached = (None, None)  # (index, data) of the last segment decompressed
+
+    @property
+    def size(self):
+        return self.segments[-1].raw_offset + self.segments[-1].raw_length if self.segments else 0
+
+    @property
+    def newlines(self):
+        return self.line_ends[-1] if self.segments else 0
+
+    def read_segment(self, index, f=None):
+        if self.cached[0] != index:
+            segment = self.segments[index]
+            if f is None:
+                with open(self.path, 'rb') as f:
+                    f.seek(segment.offset)
+                    compressed = f.read(segment.length)
+            else:
+                f.seek(segment.offset)
+                compressed = f.read(segment.length)
+            self.cached = (index, zlib.decompress(compressed, 16 + zlib.MAX_WBITS))
+        return self.cached[1]
+
+    def read_bytes(self, start=0, end=None):
+        """Yield the log from byte `start` to `end` (exclusive), a segment at a time."""
+        end = self.size if end is None else min(end, self.size)
+        if start >= end:
+            return
+        with open(self.path, 'rb') as f:
+            for index in range(max(0, bisect.bisect_right(self.raw_offsets, start) - 1), len(self.segments)):
+                segment = self.segments[index]
+                data = self.read_segment(index, f)
+                yield data[max(0, start - segment.raw_offset):end - segment.raw_offset]
+                if segment.raw_offset + segment.raw_length >= end:
+                    break
+
+    def line_offset(self, line):
+        """Byte offset where line `line` (0-based) starts, size of the log if it has less lines."""
+        if line <= 0:
+            return 0
+        index = bisect.bisect_left(self.line_ends, line)  # the segment holding the newline before the line
+        if index >= len(self.segments):
+            return self.size
+        segment = self.segments[index]
+        data = self.read_segment(index)
+        position = -1
+        for _ in range(line - segment.first_line):
+            position = data.index(b'\n', position + 1)
+        return segment.raw_offset + position + 1
+
+    def tail_offset(self, lines):
+        """Byte offset where the last `lines` lines start, an unterminated last line counts."""
+        if lines <= 0 or not self.segments:
+            return self.size
+        total = self.newlines
+        if not self.read_segment(len(self.segments) - 1).endswith(b'\n'):
+            total += 1
+        return self.line_offset(max(0, total - lines))
+
+    def read_lines(self, start=0, end=None):
+        """Lines [start, end) (0-based, end exclusive) joined as bytes."""
+        end = self.size if end is None else self.line_offset(end)
+        return b''.join(self.read_bytes(self.line_offset(start), end))
+
+    def tail(self, lines):
+        return b''.join(self.read_bytes(self.tail_offset(lines)))
+
+
+class PlainLogReader:
+    """Same interface for old plain text logs."""
+
+    block_size = 1024 * 1024
+
+    def __init__(self, path):
+        self.path = path
+
+    @property
+    def size(self):
+        return os.path.getsize(self.path)
+
+    def read_bytes(self, start=0, end=None):
+        end = self.size if end is None else min(end, self.size)
+        with open(self.path, 'rb') as f:
+            f.seek(start)
+            while start < end:
+                data = f.read(min(self.block_size, end - start))
+                if not data:
+                    break
+                start += len(data)
+                yield data
+
+    def line_offset(self, line):
+        if line <= 0:
+            return 0
+        offset = 0
+        with open(self.path, 'rb') as f:
+            while True:
+                data = f.read(self.block_size)
+                if not data:
+                    return offset
+                newlines = data.count(b'\n')
+                if newlines >= line:
+                    position = -1
+                    for _ in range(line):
+                        position = data.index(b'\n', position + 1)
+                    return offset + position + 1
+                line -= newlines
+                offset += len(data)
+
+    def tail_offset(self, lines):
+        """Scan backwards from the end."""
+        with open(self.path, 'rb') as f:
+            end = position = f.seek(0, os.SEEK_END)
+            if lines <= 0 or not end:
+                return end
+            f.seek(end - 1)
+            newlines = -1 if f.read(1) == b'\n' else 0  # the newline ending the last line
+            while position > 0:
+                read = min(self.block_size, position)
+                position -= read
+                f.seek(position)
+                data = f.read(read)
+                count = data.count(b'\n')
+                if newlines + count >= lines:
+                    index = len(data)
+                    for _ in range(lines - newlines):
+                        index = data.rindex(b'\n', 0, index)
+                    return position + index + 1
+                newlines += count
+            return 0
+
+    def read_lines(self, start=0, end=None):
+        end = self.size if end is None else self.line_offset(end)
+        return b''.join(self.read_bytes(self.line_offset(start), end))
+
+    def tail(self, lines):
+        return b''.join(self.read_bytes(self.tail_offset(lines)))
+
+
+def open_log(job_name, version):
+    """Reader of a log version, segmented if it exists, plain otherwise. Raise FileNotFoundError."""
+    path = segmented_path(job_name, version)
+    if os.path.exists(path):
+        return SegmentedLogReader(path)
+    path = plain_path(job_name, version)
+    if os.path.exists(path):
+        return PlainLogReader(path)
+    raise FileNotFoundError(path)
+
+
+def convert(path, keep=False, segment_size=None, level=None):
+    """Convert the plain log `path` (log.N.txt) to a segmented log, return (plain size, compressed size).
+        Readers see either the plain or the complete segmented log.
+    """
+    target = path + '.gz'
+    tmp = path[:-len('.txt')] + '.tmp.txt.gz'
+    writer = SegmentedLogWriter(tmp, segment_size=segment_size, level=level)
+    try:
+        with open(path, 'rb') as f:
+            while True:
+                data = f.read(writer.segment_size)
+                if not data:
+                    break
+                writer.write(data)
+    finally:
+        writer.close()
+    os.rename(index_path(tmp), index_path(target))
+    os.rename(tmp, target)
+    sizes = (os.path.getsize(path), os.path.getsize(target))
+    if not keep:
+        os.remove(path)
+    return sizes
+
+
+def convert_all(root, keep=False, min_age=3600):
+    """Convert every plain log under `root` not modified in `min_age` seconds."""
+    converted = plain = compressed = 0
+    for job_name in sorted(os.listdir(root)):
+        directory = os.path.join(root, job_name)
+        if not os.path.isdir(directory):
+            continue
+        for filename in sorted(os.listdir(directory)):
+            path = os.path.join(directory, filename)
+            match = LOG_FILE_PATTERN.match(filename)
+            if not match or match.group('gz') or time.time() - os.path.getmtime(path) < min_age:
+                continue
+            if os.path.exists(path + '.gz'):  # converted with --keep
+                continue
+            sizes = convert(path, keep=keep)
+            converted += 1
+            plain += sizes[0]
+            compressed += sizes[1]
+            print('{}: {} -> {} bytes'.format(path, *sizes))
+    return converted, plain, compressed
+
+
+def synthetic_log(path, size, seed=0):
+    """A training log of about `size` bytes: progress lines with numbers, some warnings and tracebacks."""
+    rand = random.Random(seed)
+    written = step = 0
+    with open(path, 'wb') as f:
+        while written < size:
+            step += 1
+            if rand.random() < 0.001:
+                line = 'WARNING:tensorflow:From /usr/lib/python3/site-packages/model.py:{}: deprecated\n'.format(
+                    rand.randrange(1000))
+            else:
+                line = '[2018-01-01 00:{:02d}:{:02d}] epoch {} step {} loss={:.6f} acc={:.4f} lr={:.2e} {:.1f} img/s\n'.format(
+                    step // 60 % 60, step % 60, step // 5000, step, rand.random() * 3, rand.random(), 1e-3 * rand.random(),
+                    rand.gauss(800, 50))
+            data = line.encode('utf-8')
+            f.write(data)
+            written += len(data)
+    return step
+
+
+def timed(fn, repeat=5):
+    """Best of `repeat` runs in milliseconds, and the result."""
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = (time.perf_counter() - start) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def benchmark(size, tail_lines=100, directory=None):
+    directory = tempfile.mkdtemp(dir=directory)
+    try:
+        plain = os.path.join(directory, 'log.1.txt')
+        lines = synthetic_log(plain, size)
+        segmented = plain + '.gz'
+        write_ms, _ = timed(lambda: convert(plain, keep=True), repeat=1)
+
+        def naive_tail():  # what the API did: read the whole file
+            with open(plain, 'rb') as f:
+                return b''.join(f.read().splitlines(True)[-tail_lines:])
+
+        results = {
+            'size': {'plain': os.path.getsize(plain), 'segmented': os.path.getsize(segmented),
+                     'index': os.path.getsize(index_path(segmented))},
+            'lines': lines,
+            'convert_ms': write_ms,
+            'tail_ms': {},
+            'middle_range_ms': {},
+        }
+        results['size']['ratio'] = results['size']['plain'] / results['size']['segmented']
+        expected = None
+        for name, fn in [('plain_full_read', naive_tail),
+                         ('plain_seek', lambda: PlainLogReader(plain).tail(tail_lines)),
+                         ('segmented', lambda: SegmentedLogReader(segmented).tail(tail_lines))]:
+            results['tail_ms'][name], data = timed(fn)
+            expected = expected or data
+            assert data == expected, name
+        middle = lines // 2
+        expected = None
+        for name, fn in [('plain_scan', lambda: PlainLogReader(plain).read_lines(middle, middle + tail_lines)),
+                         ('segmented', lambda: SegmentedLogReader(segmented).read_lines(middle, middle + tail_lines))]:
+            results['middle_range_ms'][name], data = timed(fn)
+            expected = expected or data
+            assert data == expected, name
+        return results
+    finally:
+        shutil.rmtree(directory)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='command')
+    parser_convert = subparsers.add_parser('convert', help='convert plain logs to segmented logs')
+    parser_convert.add_argument('--root', default=LOG_ROOT)
+    parser_convert.add_argument('--keep', action='store_true', help='keep the plain logs')
+    parser_convert.add_argument('--min-age', type=float, default=3600, help='skip logs modified in these seconds')
+    parser_benchmark = subparsers.add_parser('benchmark', help='compare storage size & read latency')
+    parser_benchmark.add_argument('--size', type=float, default=256, help='MiB of synthetic log')
+    parser_benchmark.add_argument('--tail-lines', type=int, default=100)
+    parser_benchmark.add_argument('--dir', default=None, help='where to write, e.g. on CephFS')
+    args = parser.parse_args()
+
+    if args.command == 'convert':
+        converted, plain, compressed = convert_all(args.root, keep=args.keep, min_age=args.min_age)
+        print('{} logs converted, {} -> {} bytes.'.format(converted, plain, compressed))
+    elif args.command == 'benchmark':
+        print(json.dumps(benchmark(int(args.size * 1024 * 1024), args.tail_lines, args.dir), indent=2, sort_keys=True))
+    else:
+        parser.print_help()
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,48 @@
+# encoding: utf-8
+
+
+class Histogram:
+    """Histogram of latencies in seconds, every value is counted in the first bucket it fits."""
+
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 60, float('inf'))
+
+    def __init__(self, buckets=None):
+        self.buckets = tuple(buckets or self.default_buckets)
+        self.counts = [0] * len(self.buckets)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+        for i, bucket in enumerate(self.buckets):
+            if value <= bucket:
+                self.counts[i] += 1
+                break
+
+    def to_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'max': self.max,
+            'avg': self.sum / self.count if self.count else 0.0,
+            'buckets': {str(bucket): count for bucket, count in zip(self.buckets, self.counts)},
+        }
+
+
+class HistogramGroup(dict):
+    """Histograms by name, created on first use."""
+
+    def __init__(self, buckets=None):
+        super().__init__()
+        self.buckets = buckets
+
+    def observe(self, name, value):
+        if name not in self:
+            self[name] = Histogram(self.buckets)
+        self[name].observe(value)
+
+    def to_dict(self):
+        return {name: histogram.to_dict() for name, histogram in sorted(self.items())}
@@ -0,0 +1,214 @@
+# encoding: utf-8
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import time
+
+import pymongo
+
+from ktqueue import search
+from ktqueue import settings
+from ktqueue.cluster import LeaderElector
+
+# (collection, keys, options), built in background by MigrationRunner
+INDEXES = [
+    ('jobs', [("name", pymongo.ASCENDING)], {'unique': True}),
+    ('jobs', [("hide", pymongo.ASCENDING)], {}),
+    ('jobs', [("status", pymongo.ASCENDING)], {}),
+    # /api/jobs filters, sorted by _id (newest first)
+    ('jobs', [("hide", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("hide", pymongo.ASCENDING), ("fav", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("hide", pymongo.ASCENDING), ("status", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("hide", pymongo.ASCENDING), ("user", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("hide", pymongo.ASCENDING), ("node", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("hide", pymongo.ASCENDING), ("tags", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("status", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("tensorboard", pymongo.ASCENDING), ("_id", pymongo.DESCENDING)], {}),
+    ('jobs', [("scheduledAt", pymongo.ASCENDING)], {'sparse': True}),
+    # /api/jobs/search, see ktqueue.search; prefix search uses the `name` index
+    ('jobs', [(field, pymongo.TEXT) for field in sorted(search.TEXT_WEIGHTS)],
+     {'name': search.TEXT_INDEX, 'weights': search.TEXT_WEIGHTS, 'default_language': 'none'}),
+    ('submissions', [("job", pymongo.ASCENDING)], {'unique': True}),
+    ('submissions', [("stage", pymongo.ASCENDING), ("state", pymongo.ASCENDING), ("leaseExpireAt", pymongo.ASCENDING)], {}),
+    ('usage_rollups', [("period", pymongo.ASCENDING), ("dimension", pymongo.ASCENDING), ("start", pymongo.ASCENDING)], {}),
+    ('log_checkpoints', [("updatedAt", pymongo.ASCENDING)],
+     {'expireAfterSeconds': 30 * 24 * 3600, 'partialFilterExpression': {'done': True}}),
+    ('credentials', [("repo", pymongo.ASCENDING)], {'unique': True}),
+    ('oauth', [("provider", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], {'unique': True}),
+]
+
+MIGRATIONS = []
+
+
+def migration(version, description):
+    """Register a migration, it runs once in order of version and must be safe to run again if interrupted."""
+    def decorator(fn):
+        MIGRATIONS.append((version, description, fn))
+        MIGRATIONS.sort(key=lambda item: item[0])
+        return fn
+    return decorator
+
+
+async def batched_update(collection, filter, update, progress=None):
+    """update_many in batches of settings.migration_batch_size, `update` must make documents not match `filter`."""
+    total = await collection.count(filter)
+    done = 0
+    while True:
+        docs = await collection.find(filter, projection={'_id': True}, limit=settings.migration_batch_size)
+        if not docs:
+            break
+        await collection.update_many({'_id': {'$in': [doc['_id'] for doc in docs]}}, update)
+        done += len(docs)
+        logging.info('Migrating {}: {}/{} {}'.format(collection.name, done, total, filter))
+        if progress:
+            progress(len(docs))
+    return done
+
+
+@migration(1, 'default hide & fav to false')
+async def default_hide_fav(db, progress):
+    await batched_update(db.jobs, {'hide': {'$exists': False}}, {'$set': {'hide': False}}, progress)
+    await batched_update(db.jobs, {'fav': {'$exists': False}}, {'$set': {'fav': False}}, progress)
+
+
+@migration(2, 'default memoryLimit & cpuLimit to null')
+async def default_limits(db, progress):
+    await batched_update(db.jobs, {'memoryLimit': {'$exists': False}}, {'$set': {'memoryLimit': None}}, progress)
+    await batched_update(db.jobs, {'cpuLimit': {'$exists': False}}, {'$set': {'cpuLimit': None}}, progress)
+
+
+@migration(3, 'rename commit_id to commit, gpu_num to gpuNum')
+async def rename_fields(db, progress):
+    await batched_update(db.jobs, {'commit_id': {'$exists': True}}, {'$rename': {'commit_id': 'commit'}}, progress)
+    await batched_update(db.jobs, {'gpu_num': {'$exists': True}}, {'$rename': {'gpu_num': 'gpuNum'}}, progress)
+
+
+@migration(4, 'move usage rollup cursors from jobs to usage_cursors')
+async def move_usage_cursors(db, progress):
+    # UsageRollup reads a job's old fields until its cursor exists, a cursor it already wrote is newer
+    filter = {'accountedUntil': {'$exists': True}}
+    while True:
+        jobs = await db.jobs.find(filter, projection={'name': True, 'accountedUntil': True, 'accountedRun': True},
+                                  limit=settings.migration_batch_size)
+        if not jobs:
+            break
+        await db.usage_cursors.bulk_write([pymongo.UpdateOne(
+            {'_id': job['name']},
+            {'$max': {'accountedUntil': job['accountedUntil']},
+             '$setOnInsert': {'accountedRun': job.get('accountedRun', None)}},
+            upsert=True) for job in jobs], ordered=False)
+        await db.jobs.update_many({'_id': {'$in': [job['_id'] for job in jobs]}},
+                                  {'$unset': {'accountedUntil': '', 'accountedRun': ''}})
+        logging.info('Migrating jobs: {} usage cursors moved'.format(len(jobs)))
+        progress(len(jobs))
+    await batched_update(db.jobs, {'accountedRun': {'$exists': True}}, {'$unset': {'accountedRun': ''}}, progress)
+
+
+def indexes_revision():
+    return hashlib.sha1(json.dumps(INDEXES, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class MigrationRunner:
+    """Build indexes and apply migrations in background, while the server is already serving.
+
+    Applied migrations are recorded in the `migrations` collection, one
+    process (holding the `migrations` lease) runs them, the others wait
+    and report the progress. `status()` is served by /api/ready.
+    """
+
+    def __init__(self, db):
+        self.db = db
+        self.collection = db.migrations
+        self.elector = LeaderElector(db.leases, 'migrations', ttl=settings.migration_lease_ttl)
+        self.records = {}
+        self.ready = False
+        self.error = None
+
+    async def load_state(self):
+        self.records = {doc['_id']: doc for doc in await self.collection.find()}
+        indexes = self.records.get('indexes', {})
+        self.ready = (indexes.get('state', None) == 'done' and indexes.get('revision', None) == indexes_revision() and
+                      all(self.records.get(version, {}).get('state', None) == 'done' for version, _, _ in MIGRATIONS))
+
+    async def record(self, key, **fields):
+        await self.collection.update_one({'_id': key}, {'$set': fields}, upsert=True)
+
+    async def build_indexes(self):
+        revision = indexes_revision()
+        if self.records.get('indexes', {}).get('revision', None) == revision and \
+                self.records['indexes'].get('state', None) == 'done':
+            return
+        await self.record('indexes', state='running', revision=revision, startedAt=datetime.datetime.utcnow())
+        for collection, keys, options in INDEXES:
+            start = time.time()
+            await self.db.collection(collection).create_index(keys, background=True, **options)
+            logging.info('Index {} {} built in {:.2f}s'.format(collection, keys, time.time() - start))
+        await self.record('indexes', state='done', finishedAt=datetime.datetime.utcnow())
+
+    async def migrate(self):
+        for version, description, fn in MIGRATIONS:
+            if self.records.get(version, {}).get('state', None) == 'done':
+                continue
+            logging.info('Running migration {}: {}'.format(version, description))
+            start = time.time()
+            await self.record(version, description=description, state='running', processed=0,
+                              startedAt=datetime.datetime.utcnow())
+            processed = [0]
+
+            def progress(count):
+                processed[0] += count
+
+            await fn(self.db, progress)
+            await self.record(version, state='done', processed=processed[0], finishedAt=datetime.datetime.utcnow())
+            logging.info('Migration {} done in {:.2f}s, {} documents'.format(version, time.time() - start, processed[0]))
+
+    async def keep_lease(self):
+        while True:
+            await asyncio.sleep(self.elector.ttl / 3)
+            await self.elector.try_acquire()
+
+    async def run(self):
+        while not self.ready:
+            try:
+                await self.load_state()
+                if not self.ready and await self.elector.try_acquire():
+                    keep_lease = asyncio.ensure_future(self.keep_lease())
+                    try:
+                        await self.build_indexes()
+                        await self.migrate()
+                    finally:
+                        keep_lease.cancel()
+                    await self.load_state()
+                self.error = None
+            except Exception as e:
+                logging.exception(e)
+                self.error = str(e)
+            if not self.ready:
+                await asyncio.sleep(settings.migration_poll_interval)
+
+    def status(self):
+        records = self.records
+        return {
+            'ready': self.ready,
+            'error': self.error,
+            'indexes': records.get('indexes', {}).get('state', 'pending'),
+            'migrations': [{
+                'version': version,
+                'description': description,
+                'state': records.get(version, {}).get('state', 'pending'),
+                'processed': records.get(version, {}).get('processed', 0),
+            } for version, description, _ in MIGRATIONS],
+        }
+
+
+_migration_runner = None
+
+
+def get_migration_runner():
+    global _migration_runner
+    if _migration_runner is None:
+        from .db import get_db
+        _migration_runner = MigrationRunner(get_db())
+    return _migration_runner
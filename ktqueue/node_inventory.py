@@ -0,0 +1,139 @@
+# encoding: utf-8
+import time
+import uuid
+from collections import OrderedDict
+
+from ktqueue import settings
+
+
+def compact_node(node):
+    """Keep only what KTQueue needs from a kubernetes Node object."""
+    metadata = node['metadata']
+    status = node.get('status', {})
+    labels = metadata.get('labels') or {}
+    capacity = status.get('capacity', {})
+    allocatable = status.get('allocatable', {})
+    resources = ('cpu', 'memory', 'nvidia.com/gpu')
+    ready = False
+    for condition in status.get('conditions', []):
+        if condition['type'] == 'Ready':
+            ready = condition['status'] == 'True'
+    return {
+        'name': metadata['name'],
+        'hostname': labels.get('kubernetes.io/hostname', metadata['name']),  # what nodeSelector & the UI use
+        'labels': {k: v for k, v in labels.items() if k in settings.node_labels},
+        'capacity': {k: capacity[k] for k in resources if k in capacity},
+        'allocatable': {k: allocatable[k] for k in resources if k in allocatable},
+        'gpu_capacity': int(capacity.get('nvidia.com/gpu', 0)),
+        'ready': ready,
+        'unschedulable': node.get('spec', {}).get('unschedulable', False),
+    }
+
+
+class NodeInventory:
+    """Compact in-memory model of the cluster nodes, fed by a node EventWatcher.
+
+    Every change of a node (including its GPU usage, see `mark_changed`)
+    increases `revision`, so clients can use it as ETag and ask for the
+    nodes changed since a revision. Revisions are per process, `cursor`
+    (`<epoch>-<revision>`) tells which process they come from.
+    """
+
+    def __init__(self, max_tombstones=1000):
+        self.nodes = {}
+        self.revision = 0
+        self.epoch = uuid.uuid4().hex[:12]  # revisions restart from 0 with the process, and differ between processes
+        self.changes = OrderedDict()  # node name -> revision of last change, oldest first
+        self.min_revision = 0  # changes after this revision are all in `changes`
+        self.max_tombstones = max_tombstones
+        self.resource_version = None
+        self.synced = False
+        self.last_sync = 0
+
+    def mark_changed(self, name):
+        self.revision += 1
+        self.changes.pop(name, None)
+        self.changes[name] = self.revision
+        # forget deleted nodes when there are too many
+        while len(self.changes) > len(self.nodes) + self.max_tombstones:
+            oldest, revision = next(iter(self.changes.items()))
+            if oldest in self.nodes:
+                break
+            self.changes.pop(oldest)
+            self.min_revision = revision
+
+    def set_node(self, node):
+        model = compact_node(node)
+        if self.nodes.get(model['name']) != model:  # heartbeats do not change the model
+            self.nodes[model['name']] = model
+            self.mark_changed(model['name'])
+
+    def remove_node(self, name):
+        if self.nodes.pop(name, None) is not None:
+            self.mark_changed(name)
+
+    # EventWatcher cache interface
+    def replace(self, items, resource_version):
+        names = set()
+        for node in items:
+            names.add(node['metadata']['name'])
+            self.set_node(node)
+        for name in list(self.nodes):
+            if name not in names:
+                self.remove_node(name)
+        self.synced = True
+        self.touch(resource_version)
+
+    def apply(self, event):
+        if event['type'] == 'DELETED':
+            self.remove_node(event['object']['metadata']['name'])
+        else:
+            self.set_node(event['object'])
+        self.touch(event['object']['metadata'].get('resourceVersion', None))
+
+    def touch(self, resource_version=None):
+        if resource_version:
+            self.resource_version = resource_version
+        self.last_sync = time.time()
+
+    def invalidate(self):
+        self.synced = False
+
+    def resolve(self, node):
+        """Name of the node a job is pinned to by its name or hostname label, None if there is no such node."""
+        if node in self.nodes:
+            return node
+        for name, model in self.nodes.items():
+            if model['hostname'] == node:
+                return name
+        return None
+
+    def hostname(self, name):
+        """Hostname label of node `name`, for nodeSelector."""
+        node = self.nodes.get(name, None)
+        return node['hostname'] if node is not None else name
+
+    @property
+    def cursor(self):
+        return '{}-{}'.format(self.epoch, self.revision)
+
+    def parse_cursor(self, cursor):
+        """Revision of a cursor of this process, None if it is from another process or invalid."""
+        epoch, _, revision = (cursor or '').rpartition('-')
+        if epoch != self.epoch or not revision.isdigit():
+            return None
+        return int(revision)
+
+    def changed_since(self, revision):
+        """Return (changed node names, deleted node names), or None if `revision` is too old."""
+        if revision < self.min_revision or revision > self.revision:  # too old, or from before a restart
+            return None
+        changed, deleted = [], []
+        for name, change_revision in reversed(self.changes.items()):
+            if change_revision <= revision:
+                break
+            (changed if name in self.nodes else deleted).append(name)
+        return changed, deleted
+
+
+node_inventory = NodeInventory()
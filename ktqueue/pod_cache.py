@@ -0,0 +1,109 @@
+# encoding: utf-8
+import time
+import logging
+from collections import defaultdict
+
+from ktqueue import settings
+
+
+class PodCache:
+    """An informer-like in-memory copy of the pods in job namespace.
+
+    It is fed by the pod EventWatcher, pods are indexed by the labels
+    listed in `indexed_labels`. Lookups are answered from memory while the
+    cache is fresh, i.e. the watcher has LISTed once and received an event or
+    bookmark within `max_staleness` seconds; otherwise the apiserver is asked.
+    """
+
+    indexed_labels = ('job-name', 'ktqueue-tensorboard-job-name')
+
+    def __init__(self, max_staleness=120):
+        self.max_staleness = max_staleness
+        self.pods = {}
+        self.indexes = {label: defaultdict(set) for label in self.indexed_labels}
+        self.resource_version = None
+        self.synced = False
+        self.last_sync = 0
+        self.counters = {
+            'hits': 0,
+            'misses': 0,
+        }
+
+    def _index(self, pod):
+        name = pod['metadata']['name']
+        labels = pod['metadata'].get('labels') or {}
+        for label in self.indexed_labels:
+            if label in labels:
+                self.indexes[label][labels[label]].add(name)
+
+    def _unindex(self, pod):
+        name = pod['metadata']['name']
+        labels = pod['metadata'].get('labels') or {}
+        for label in self.indexed_labels:
+            if label in labels:
+                names = self.indexes[label][labels[label]]
+                names.discard(name)
+                if not names:
+                    self.indexes[label].pop(labels[label], None)
+
+    def replace(self, items, resource_version):
+        """Replace whole content with the result of a LIST."""
+        self.pods = {}
+        self.indexes = {label: defaultdict(set) for label in self.indexed_labels}
+        for pod in items:
+            self.pods[pod['metadata']['name']] = pod
+            self._index(pod)
+        self.synced = True
+        self.touch(resource_version)
+
+    def apply(self, event):
+        """Apply a watch event."""
+        pod = event['object']
+        name = pod['metadata']['name']
+        old = self.pods.pop(name, None)
+        if old is not None:
+            self._unindex(old)
+        if event['type'] != 'DELETED':
+            self.pods[name] = pod
+            self._index(pod)
+        self.touch(pod['metadata'].get('resourceVersion', None))
+
+    def touch(self, resource_version=None):
+        if resource_version:
+            self.resource_version = resource_version
+        self.last_sync = time.time()
+
+    def invalidate(self):
+        """Called when the watch is broken, lookups go to apiserver until the watch catches up."""
+        self.synced = False
+
+    def is_fresh(self):
+        return self.synced and time.time() - self.last_sync < self.max_staleness
+
+    def lookup(self, label, value):
+        return [self.pods[name] for name in sorted(self.indexes[label].get(value, ()))]
+
+    async def get_pods(self, k8s_client, label, value):
+        """Return pods labeled `label`=`value`, like `items` of a LIST."""
+        assert label in self.indexed_labels
+        if self.is_fresh():
+            self.counters['hits'] += 1
+            return self.lookup(label, value)
+
+        self.counters['misses'] += 1
+        logging.debug('pod cache miss for {}={}'.format(label, value))
+        pods = await k8s_client.call_api(
+            method='GET',
+            api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
+            params={'labelSelector': '{label}={value}'.format(label=label, value=value)}
+        )
+        return pods.get('items', None) or []
+
+    async def get_job_pods(self, k8s_client, job):
+        return await self.get_pods(k8s_client, 'job-name', job)
+
+    async def get_tensorboard_pods(self, k8s_client, job):
+        return await self.get_pods(k8s_client, 'ktqueue-tensorboard-job-name', job)
+
+
+pod_cache = PodCache()
@@ -0,0 +1,445 @@
+# encoding: utf-8
+import asyncio
+import datetime
+import logging
+import time
+from collections import defaultdict
+from collections import deque
+
+import pymongo
+
+from ktqueue import settings
+from ktqueue.change_feed import get_change_feed
+from ktqueue.metrics import HistogramGroup
+from ktqueue.estimator import RuntimeEstimator
+from ktqueue.estimator import container_started_at
+from ktqueue.utils import k8s_evict_job
+from ktqueue.node_inventory import node_inventory
+
+FINISHED_STATUS = ('Completed', 'ManualStop', 'FetchError', 'CreateError')
+INFINITY = float('inf')
+
+
+def is_finished(status):
+    return status in FINISHED_STATUS or str(status).startswith('terminated')
+
+
+def node_free_gpus(nodes, used, reserved):
+    """GPUs left on every schedulable node.
+        nodes: compact nodes from node_inventory
+        used, reserved: {node name: gpus}
+    """
+    return {
+        name: node['gpu_capacity'] - used.get(name, 0) - reserved.get(name, 0)
+        for name, node in nodes.items() if node['ready'] and not node['unschedulable']
+    }
+
+
+def best_fit(job, free, allowed=None):
+    """Return (fits, node), node is the one which fits `job` with least GPUs left."""
+    gpus = job['gpuNum']
+    if gpus == 0:  # jobs without GPU are left to kubernetes
+        return True, job['node']
+    candidates = [job['node']] if job['node'] else free
+    fits = [(free[node] - gpus, node) for node in candidates
+            if free.get(node, -1) >= gpus and (allowed is None or allowed(node))]
+    if not fits:
+        return False, None
+    return True, min(fits)[1]
+
+
+def expected_end(start, estimate, now):
+    """When a job started at `start` is expected to end, inf if its runtime is unknown."""
+    if estimate is None:
+        return INFINITY
+    if start + estimate < now:  # it has run longer than expected, assume it ends soon
+        return now + settings.backfill_overrun_grace
+    return start + estimate
+
+
+def shadow_time(job, free, running, now):
+    """Return (start, spare GPUs, node), the earliest `job` can start on a node, None if unknown.
+        running: {node: [(expected end, GPUs)]}
+    """
+    gpus = job['gpuNum']
+    best = None
+    for node in ([job['node']] if job['node'] else free):
+        if node not in free:
+            continue
+        available, start = free[node], now
+        for end, used in sorted(running.get(node, [])):
+            if available >= gpus:
+                break
+            available, start = available + used, end
+        if available < gpus or start == INFINITY:
+            continue
+        if best is None or (start, available - gpus, node) < best:
+            best = (start, available - gpus, node)
+    return best
+
+
+def plan(pending, free, usage, now=None, running=None):
+    """Choose the jobs which can start now.
+
+    pending: [{'name', 'user', 'gpuNum', 'priority', 'node', 'queuedAt', 'estimate'}]
+    free: {node: free GPUs}, updated in place
+    usage: {user: GPUs in use}, updated in place
+    running: {node: [(expected end, GPUs)]}, updated in place, enables backfill
+
+    Jobs are taken by priority (higher first), then from the user using
+    the least GPUs (fair share), then first come first served. A job which
+    doesn't fit is skipped.
+    With backfill (EASY), the oldest jobs of the highest priority level
+    start first while they fit, the first one which doesn't reserves the
+    earliest time enough GPUs are expected to be free on a node. The other
+    jobs then go in fair share order, a job only goes to the reserved node
+    if it's expected to end before then or uses GPUs the reservation
+    doesn't need. Return [(job, node)].
+    """
+    levels = defaultdict(lambda: defaultdict(deque))
+    for job in sorted(pending, key=lambda job: job['queuedAt']):
+        levels[job['priority']][job['user']].append(job)
+
+    reservation = None  # [start, spare GPUs, node], False if the oldest job blocked can't get one
+
+    def allowed(job):
+        def check(node):
+            if not reservation or node != reservation[2]:
+                return True
+            if expected_end(now, job.get('estimate', None), now) <= reservation[0]:
+                return True
+            return job['gpuNum'] <= reservation[1]
+        return check
+
+    released = []
+
+    def release(job, node):
+        if node in free:
+            free[node] -= job['gpuNum']
+            if running is not None:
+                end = expected_end(now, job.get('estimate', None), now)
+                running.setdefault(node, []).append((end, job['gpuNum']))
+                if reservation and node == reservation[2] and end > reservation[0]:
+                    reservation[1] -= job['gpuNum']  # still running at the reserved start
+        usage[job['user']] = usage.get(job['user'], 0) + job['gpuNum']
+        released.append((job, node))
+
+    def pop(queues, user):
+        job = queues[user].popleft()
+        if not queues[user]:
+            del queues[user]
+        return job
+
+    for priority in sorted(levels, reverse=True):
+        queues = levels[priority]
+        while running is not None and reservation is None and queues:  # the head of the level, oldest first
+            job = pop(queues, min(queues, key=lambda user: queues[user][0]['queuedAt']))
+            fits, node = best_fit(job, free)
+            if fits:
+                release(job, node)
+                continue
+            reservation = shadow_time(job, free, running, now)
+            reservation = list(reservation) if reservation else False
+        while queues:
+            job = pop(queues, min(queues, key=lambda user: (usage.get(user, 0), queues[user][0]['queuedAt'])))
+            fits, node = best_fit(job, free, allowed(job) if running is not None else None)
+            if fits:
+                release(job, node)
+    return released
+
+
+def choose_victims(job, free, preemptible):
+    """Return (node, victims), the running jobs to preempt so `job` fits on node, None if impossible.
+        preemptible: {node: [{'name', 'priority', 'gpuNum', 'startedAt'}]}
+    Only jobs of lower priority are preempted, lowest priority and latest
+    started first. The node needing the lowest priority victims, then the
+    fewest GPUs preempted is chosen (best fit).
+    """
+    best = None
+    for node in ([job['node']] if job['node'] else free):
+        if node not in free:
+            continue
+        available = free[node]
+        victims = []
+        candidates = sorted(
+            (victim for victim in preemptible.get(node, []) if victim['priority'] < job['priority']),
+            key=lambda victim: (victim['priority'], -victim['startedAt']))
+        for victim in candidates:
+            if available >= job['gpuNum']:
+                break
+            victims.append(victim)
+            available += victim['gpuNum']
+        if available < job['gpuNum'] or not victims:
+            continue
+        key = (max(victim['priority'] for victim in victims), sum(victim['gpuNum'] for victim in victims),
+               len(victims), node)
+        if best is None or key < best[0]:
+            best = (key, node, victims)
+    return (best[1], best[2]) if best else None
+
+
+async def pending_jobs(db):
+    """Jobs waiting in the `schedule` stage."""
+    submissions = await db.submissions.find(
+        {'stage': 'schedule', 'state': 'queued'}, projection={'job': True, 'stageQueuedAt': True})
+    if not submissions:
+        return []
+    queued_at = {submission['job']: submission['stageQueuedAt'] for submission in submissions}
+    jobs = await db.jobs.find(
+        {'name': {'$in': list(queued_at)}},
+        projection={'name': True, 'user': True, 'gpuNum': True, 'priority': True, 'node': True,
+                    'image': True, 'command': True, 'wallTime': True, 'pendingReason': True})
+    return [{
+        'name': job['name'],
+        'user': job.get('user', None),
+        'gpuNum': int(job.get('gpuNum', 0) or 0),
+        'priority': job.get('priority', 0) or 0,
+        'node': job.get('node', None),
+        'image': job.get('image', None),
+        'command': job.get('command', None),
+        'wallTime': job.get('wallTime', None),
+        'queuedAt': queued_at[job['name']],
+        'pendingReason': job.get('pendingReason', None),
+    } for job in jobs]
+
+
+class Scheduler:
+    """Release queued jobs to kubernetes only when they can start.
+
+    Jobs wait in the `schedule` stage of the SubmissionQueue. Every cycle
+    the scheduler computes free GPUs from node_inventory, node_used_gpus and
+    the GPUs reserved by jobs released but not running yet, pins the jobs
+    chosen by plan() to their node and moves them to the `create` stage.
+    Only the leader runs it, node_used_gpus is only accurate there.
+    """
+
+    def __init__(self, db, submission_queue, k8s_client=None):
+        self.db = db
+        self.k8s_client = k8s_client
+        self.jobs_collection = db.jobs
+        self.submission_queue = submission_queue
+        self.latency = HistogramGroup(
+            buckets=(0.01, 0.1, 1, 5, 10, 30, 60, 300, 600, 1800, 3600, 4 * 3600, 24 * 3600, float('inf')))
+        self.counters = defaultdict(int)
+        self.queue_length = 0
+        self.status_published_at = 0
+        self.estimator = RuntimeEstimator()
+        self.estimator_loaded_at = 0
+        self.evicting = set()  # jobs being preempted by this process
+
+    async def load_pending(self):
+        return await pending_jobs(self.db)
+
+    async def load_usage(self, now):
+        """Return (GPUs used per node, GPUs reserved per node, GPUs used or reserved per user,
+            {node: [(expected end, GPUs)]} of running and reserved jobs,
+            {node: [running jobs]} for choose_victims(), GPUs being freed by preemption per node).
+        """
+        from .api.node import node_used_gpus
+
+        used = {node: sum(pods.values()) for node, pods in node_used_gpus.items()}
+        reserved = defaultdict(int)
+        usage = defaultdict(int)
+        running = defaultdict(list)
+        preemptible = defaultdict(list)
+        incoming = defaultdict(int)
+        since = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.scheduler_reservation_ttl)
+        jobs = await self.jobs_collection.find(
+            {'$or': [{'status': {'$in': ['Running', 'Preempting']}}, {'scheduledAt': {'$gt': since}}]},
+            projection={'name': True, 'user': True, 'gpuNum': True, 'status': True, 'scheduledNode': True,
+                        'runningNode': True, 'state': True, 'image': True, 'command': True, 'wallTime': True,
+                        'priority': True})
+        for job in jobs:
+            gpus = int(job.get('gpuNum', 0) or 0)
+            estimate = self.estimator.estimate(job)
+            if job['status'] == 'Preempting':
+                if job.get('runningNode', None):
+                    incoming[job['runningNode']] += gpus
+                continue
+            if job['status'] == 'Running':
+                usage[job.get('user', None)] += gpus
+                if job.get('runningNode', None):
+                    started_at = container_started_at(job.get('state', None)) or now
+                    running[job['runningNode']].append((expected_end(started_at, estimate, now), gpus))
+                    preemptible[job['runningNode']].append({
+                        'name': job['name'], 'user': job.get('user', None), 'gpuNum': gpus,
+                        'priority': job.get('priority', 0) or 0, 'startedAt': started_at,
+                    })
+                continue
+            if is_finished(job['status']):
+                continue
+            node = job.get('scheduledNode', None)
+            pod_prefix = job['name'] + '-'
+            if node and not any(pod.startswith(pod_prefix) for pod in node_used_gpus.get(node, {})):
+                reserved[node] += gpus  # released, pod is not using GPU yet
+                running[node].append((expected_end(now, estimate, now), gpus))
+            usage[job.get('user', None)] += gpus
+        return used, reserved, usage, running, preemptible, incoming
+
+    async def release(self, released):
+        now = datetime.datetime.utcnow()
+        updates = []
+        for job, node in released:
+            wait = (now - job['queuedAt']).total_seconds()
+            self.latency.observe('queue_wait', wait)
+            update = {'scheduledAt': now, 'scheduledNode': node, 'timings.scheduleQueued': wait,
+                      'scheduledHostname': node_inventory.hostname(node) if node else None, 'pendingReason': None}
+            updates.append(pymongo.UpdateOne({'name': job['name']}, {'$set': update}))
+        await self.jobs_collection.bulk_write(updates, ordered=False)
+        get_change_feed().publish([
+            {'type': 'job', 'name': job['name'], 'update': {
+                'scheduledAt': now, 'scheduledNode': node, 'pendingReason': None,
+                'scheduledHostname': node_inventory.hostname(node) if node else None}}
+            for job, node in released])
+        await self.submission_queue.release([job['name'] for job, node in released])
+        self.counters['released'] += len(released)
+
+    @staticmethod
+    def pin_nodes(pending, free):
+        """Replace `node` of pinned jobs, a hostname label from the UI or a node name, by the node name plan() uses.
+            Return {job name: why it can't start} for jobs pinned to a missing or unschedulable node.
+        """
+        reasons = {}
+        for job in pending:
+            if not job['node']:
+                continue
+            name = node_inventory.resolve(job['node'])
+            if name is None:
+                reasons[job['name']] = 'node {} not found'.format(job['node'])
+                continue
+            if name not in free:
+                reasons[job['name']] = 'node {} is cordoned or not ready'.format(job['node'])
+            job['node'] = name
+        return reasons
+
+    async def save_pending_reasons(self, pending, reasons, released_names):
+        """Show why pinned jobs wait as `pendingReason`, written only when it changes."""
+        changed = [(job['name'], reasons.get(job['name'], None)) for job in pending
+                   if job['name'] not in released_names and job['pendingReason'] != reasons.get(job['name'], None)]
+        if not changed:
+            return
+        await self.jobs_collection.bulk_write([
+            pymongo.UpdateOne({'name': name}, {'$set': {'pendingReason': reason}}) for name, reason in changed],
+            ordered=False)
+        get_change_feed().publish([
+            {'type': 'job', 'name': name, 'update': {'pendingReason': reason}} for name, reason in changed])
+
+    async def cycle(self):
+        if not node_inventory.synced:
+            return
+        start = time.time()
+        if settings.scheduler_backfill and start - self.estimator_loaded_at > settings.runtime_estimate_refresh:
+            await self.estimator.load(self.jobs_collection)
+            self.estimator_loaded_at = start
+        pending = await self.load_pending()
+        self.queue_length = len(pending)
+        if pending:
+            for job in pending:
+                job['estimate'] = self.estimator.estimate(job)
+            used, reserved, usage, running, preemptible, incoming = await self.load_usage(start)
+            free = node_free_gpus(node_inventory.nodes, used, reserved)
+            reasons = self.pin_nodes(pending, free)
+            plan_start = time.time()
+            released = plan(pending, free, usage, now=start, running=running if settings.scheduler_backfill else None)
+            self.latency.observe('plan', time.time() - plan_start)
+            if released:
+                await self.release(released)
+                self.queue_length -= len(released)
+            released_names = {job['name'] for job, node in released}
+            await self.save_pending_reasons(pending, reasons, released_names)
+            if settings.preemption_enabled:
+                blocked = [job for job in pending if job['name'] not in released_names]
+                await self.preempt_for(blocked, free, preemptible, incoming)
+        await self.recover_preempting()
+        self.counters['cycles'] += 1
+        self.latency.observe('cycle', time.time() - start)
+        await self.publish_status()
+
+    async def preempt_for(self, blocked, free, preemptible, incoming):
+        """Preempt lower priority running jobs for the blocked jobs, higher priority first."""
+        free = {node: gpus + incoming.get(node, 0) for node, gpus in free.items()}
+        victims_left = settings.preemption_max_per_cycle
+        for job in sorted(blocked, key=lambda job: (-job['priority'], job['queuedAt'])):
+            if job['gpuNum'] == 0 or victims_left <= 0:
+                continue
+            fits, node = best_fit(job, free)
+            if fits:  # GPUs of jobs being preempted are enough, wait for them
+                free[node] -= job['gpuNum']
+                continue
+            choice = choose_victims(job, free, preemptible)
+            if choice is None:
+                continue
+            node, victims = choice
+            for victim in victims:
+                preemptible[node].remove(victim)
+                free[node] += victim['gpuNum']
+                await self.preempt(victim, job)
+                victims_left -= 1
+            free[node] -= job['gpuNum']
+
+    async def preempt(self, victim, job):
+        logging.info('Preempt job {} for {}'.format(victim['name'], job['name']))
+        update = {'status': 'Preempting', 'preemptedAt': datetime.datetime.utcnow(), 'preemptedBy': job['name']}
+        ret = await self.jobs_collection.update_one(
+            {'name': victim['name'], 'status': 'Running'}, {'$set': update, '$inc': {'preemptions': 1}})
+        if ret.modified_count:
+            get_change_feed().publish_job(victim['name'], update)
+        self.counters['preempted'] += 1
+        self.evicting.add(victim['name'])
+        asyncio.ensure_future(self.evict(victim))
+
+    async def evict(self, victim):
+        try:
+            await k8s_evict_job(self.k8s_client, victim['name'])
+        except Exception as e:  # recover_preempting will requeue it
+            logging.exception(e)
+            return
+        finally:
+            self.evicting.discard(victim['name'])
+        await self.requeue(victim['name'], victim['user'])
+
+    async def requeue(self, job_name, user):
+        """Put a preempted job back to the queue, its code is already in the job directory."""
+        ret = await self.jobs_collection.update_one(
+            {'name': job_name, 'status': 'Preempting'},
+            {'$set': {'status': 'queued'}, '$unset': {'scheduledAt': '', 'scheduledNode': '', 'scheduledHostname': ''}})
+        if ret.modified_count:  # not stopped by user meanwhile
+            get_change_feed().publish_job(
+                job_name, {'status': 'queued', 'scheduledAt': None, 'scheduledNode': None, 'scheduledHostname': None})
+            await self.submission_queue.enqueue(job_name=job_name, user=user, stage='schedule')
+
+    async def recover_preempting(self):
+        """Requeue jobs whose eviction was interrupted, e.g. by a leader change."""
+        deadline = datetime.datetime.utcnow() - datetime.timedelta(seconds=settings.preemption_grace_period + 120)
+        jobs = await self.jobs_collection.find(
+            {'status': 'Preempting', 'preemptedAt': {'$lt': deadline}}, projection={'name': True, 'user': True})
+        for job in jobs:
+            if job['name'] not in self.evicting:
+                await self.requeue(job['name'], job.get('user', None))
+
+    async def publish_status(self):
+        """Save queue length & metrics for GET /api/scheduler, other processes don't run the scheduler."""
+        if time.time() - self.status_published_at < settings.scheduler_status_interval:
+            return
+        self.status_published_at = time.time()
+        await self.db.cluster_state.replace_one({'_id': 'scheduler'}, {
+            'queueLength': self.queue_length,
+            'counters': dict(self.counters),
+            # bucket bounds contain dots, which can not be used as keys
+            'latency': {name: dict(histogram, buckets=list(histogram['buckets'].items()))
+                        for name, histogram in self.latency.to_dict().items()},
+            'updateAt': datetime.datetime.utcnow(),
+        }, upsert=True)
+
+    async def run(self):
+        wakeup = self.submission_queue.wakeup['schedule']
+        while True:
+            wakeup.clear()
+            try:
+                await self.cycle()
+            except Exception as e:
+                logging.exception(e)
+            try:
+                await asyncio.wait_for(wakeup.wait(), settings.scheduler_interval)
+            except asyncio.TimeoutError:
+                pass
@@ -0,0 +1,58 @@
+# encoding: utf-8
+"""Queries of job search, shared by /api/jobs/search and the benchmark.
+
+Full-text search uses the `jobs_text` text index over name, comments,
+command, image and repo, and results are ranked by text score. Prefix
+search is an anchored, case sensitive regex on `name`, so it is answered
+by the unique `name` index, and results are sorted by name. Both use
+keyset pagination: the cursor is the sort key of the last result.
+"""
+import re
+
+import bson
+
+TEXT_INDEX = 'jobs_text'
+TEXT_WEIGHTS = {'name': 10, 'comments': 5, 'command': 2, 'image': 1, 'repo': 1}
+
+
+def prefix_filter(prefix):
+    return {'$regex': '^' + re.escape(prefix)}
+
+
+def encode_cursor(job, text):
+    if text:
+        return '{!r}:{}'.format(job['score'], job['_id'])
+    return job['name']
+
+
+def text_pipeline(q, query, projection=None, cursor=None, limit=20):
+    """Aggregation pipeline of full-text search, sorted by score then newest first.
+        `query` holds the other filters, it must not contain $text.
+    """
+    match = dict(query, **{'$text': {'$search': q}})
+    pipeline = [
+        {'$match': match},
+        {'$addFields': {'score': {'$meta': 'textScore'}}},
+    ]
+    if cursor:
+        score, _, last_id = cursor.partition(':')
+        score, last_id = float(score), bson.ObjectId(last_id)
+        pipeline.append({'$match': {'$or': [
+            {'score': {'$lt': score}},
+            {'score': score, '_id': {'$lt': last_id}},
+        ]}})
+    pipeline += [
+        {'$sort': {'score': -1, '_id': -1}},
+        {'$limit': limit},
+    ]
+    if projection:
+        pipeline.append({'$project': dict({field: True for field in projection}, score=True, name=True)})
+    return pipeline
+
+
+def prefix_query(prefix, query, cursor=None):
+    """find() filter of prefix search, to be sorted by name."""
+    name = prefix_filter(prefix)
+    if cursor:
+        name['$gt'] = cursor
+    return dict(query, name=name)
@@ -0,0 +1,147 @@
+# encoding: utf-8
+"""Benchmark job search on a large synthetic collection, and check that no query scans the collection.
+
+Jobs are written to a separate database (ktqueue_benchmark by default) with the indexes of
+ktqueue.migrations, then every query is explained and timed:
+    python -m ktqueue.search_benchmark --jobs 1000000
+Exit status is 1 if any winning plan contains COLLSCAN.
+"""
+import argparse
+import json
+import random
+import sys
+import time
+
+import bson
+import pymongo
+
+from ktqueue import search
+from ktqueue import settings
+from ktqueue.migrations import INDEXES
+
+WORDS = ['resnet', 'bert', 'gan', 'lstm', 'transformer', 'baseline', 'ablation', 'finetune', 'imagenet', 'cifar',
+         'coco', 'squad', 'dropout', 'warmup', 'lr', 'adam', 'sgd', 'mixup', 'distill', 'pretrain']
+
+
+def synthetic_jobs(jobs, users, seed):
+    rand = random.Random(seed)
+    for i in range(jobs):
+        words = rand.sample(WORDS, 3)
+        user = 'user-{}'.format(rand.randrange(users))
+        yield {
+            '_id': bson.ObjectId(),
+            'name': '{}-{}-{}'.format(user, '-'.join(words[:2]), i),
+            'user': user,
+            'comments': ' '.join(rand.sample(WORDS, 4)),
+            'command': 'python3 train.py --model {} --dataset {} --seed {}'.format(words[0], words[2], i),
+            'image': 'registry/{}:latest'.format(rand.choice(['tensorflow', 'pytorch', 'mxnet'])),
+            'repo': 'https://github.com/{}/{}.git'.format(user, words[0]),
+            'status': rand.choice(['Completed', 'Completed', 'Completed', 'ManualStop', 'Running', 'Pending']),
+            'node': 'node-{}'.format(rand.randrange(32)),
+            'tags': rand.sample(['exp', 'paper', 'debug', 'prod'], rand.randrange(3)),
+            'hide': rand.random() < 0.2,
+            'fav': rand.random() < 0.05,
+            'gpuNum': rand.choice([1, 1, 2, 4, 8]),
+        }
+
+
+def populate(collection, jobs, users, seed, batch_size=10000):
+    collection.drop()
+    batch = []
+    for job in synthetic_jobs(jobs, users, seed):
+        batch.append(job)
+        if len(batch) == batch_size:
+            collection.insert_many(batch, ordered=False)
+            batch = []
+    if batch:
+        collection.insert_many(batch, ordered=False)
+    for name, keys, options in INDEXES:
+        if name == 'jobs':
+            collection.create_index(keys, **options)
+
+
+def plan_stages(explain):
+    """Stages of the winning plan(s) in an explain output, for find and aggregate alike."""
+    stages = []
+
+    def walk(node, winning):
+        if isinstance(node, dict):
+            if winning and 'stage' in node:
+                stages.append(node['stage'])
+            for key, value in node.items():
+                if key == 'rejectedPlans':
+                    continue
+                walk(value, winning or key in ('winningPlan', 'queryPlan'))
+        elif isinstance(node, list):
+            for value in node:
+                walk(value, winning)
+    walk(explain, False)
+    return stages
+
+
+def queries(users):
+    user = 'user-{}'.format(users // 2)
+    return [
+        ('text', 'bert', {'hide': False}),
+        ('text', 'resnet imagenet', {'hide': False, 'user': {'$in': [user]}}),
+        ('text', 'transformer', {'hide': False, 'tags': {'$all': ['paper']}}),
+        ('prefix', user, {'hide': False}),
+        ('prefix', user + '-bert', {}),
+        ('prefix', user, {'hide': False, 'status': 'Completed'}),
+    ]
+
+
+def run_query(db, kind, value, query, page_size):
+    collection = db.jobs
+    if kind == 'text':
+        pipeline = search.text_pipeline(value, query, limit=page_size)
+        start = time.perf_counter()
+        jobs = list(collection.aggregate(pipeline))
+        elapsed = time.perf_counter() - start
+        explain = db.command('aggregate', collection.name, pipeline=pipeline, explain=True)
+    else:
+        cursor = collection.find(search.prefix_query(value, query)).sort('name', 1).limit(page_size)
+        start = time.perf_counter()
+        jobs = list(cursor.clone())
+        elapsed = time.perf_counter() - start
+        explain = cursor.explain()
+    stats = explain.get('executionStats', {})
+    return {
+        'kind': kind,
+        'value': value,
+        'filter': json.dumps(query, sort_keys=True),
+        'results': len(jobs),
+        'ms': elapsed * 1000,
+        'stages': plan_stages(explain),
+        'docsExamined': stats.get('totalDocsExamined', None),
+        'keysExamined': stats.get('totalKeysExamined', None),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--database', default='ktqueue_benchmark')
+    parser.add_argument('--jobs', type=int, default=200000)
+    parser.add_argument('--users', type=int, default=50)
+    parser.add_argument('--page-size', type=int, default=20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--reuse', action='store_true', help='do not rebuild the collection')
+    args = parser.parse_args()
+
+    client = pymongo.MongoClient(settings.mongodb_server)
+    db = client[args.database]
+    if not args.reuse:
+        start = time.time()
+        populate(db.jobs, args.jobs, args.users, args.seed)
+        print('{} jobs written and indexed in {:.1f}s'.format(args.jobs, time.time() - start))
+
+    results = [run_query(db, kind, value, query, args.page_size) for kind, value, query in queries(args.users)]
+    print(json.dumps(results, indent=2))
+    collscans = [result for result in results if 'COLLSCAN' in result['stages']]
+    for result in collscans:
+        print('COLLSCAN: {} {} {}'.format(result['kind'], result['value'], result['filter']))
+    return 1 if collscans else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
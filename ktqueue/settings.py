@@ -1,6 +1,79 @@
 import os
 
 mongodb_server = os.environ.get('KTQ_MONGODB_SERVER', 'ktqueue-mongodb')
+mongodb_executor_workers = int(os.environ.get('KTQ_MONGODB_EXECUTOR_WORKERS', '16'))
+status_flush_interval = float(os.environ.get('KTQ_STATUS_FLUSH_INTERVAL', '0.5'))  # max latency of job status writes, in seconds
+status_flush_batch = int(os.environ.get('KTQ_STATUS_FLUSH_BATCH', '500'))
+watch_workers = int(os.environ.get('KTQ_WATCH_WORKERS', '16'))  # number of tasks handling pod events concurrently
+watch_queue_size = int(os.environ.get('KTQ_WATCH_QUEUE_SIZE', '1000'))
+k8s_pool_size = int(os.environ.get('KTQ_K8S_POOL_SIZE', '64'))  # connections to apiserver
+k8s_watch_pool_size = int(os.environ.get('KTQ_K8S_WATCH_POOL_SIZE', '64'))  # connections for watch & follow log
+k8s_keepalive_timeout = float(os.environ.get('KTQ_K8S_KEEPALIVE_TIMEOUT', '60'))
+k8s_qps = float(os.environ.get('KTQ_K8S_QPS', '50'))  # 0 means unlimited
+k8s_burst = int(os.environ.get('KTQ_K8S_BURST', '100'))
+k8s_max_retries = int(os.environ.get('KTQ_K8S_MAX_RETRIES', '3'))
+k8s_backoff_base = float(os.environ.get('KTQ_K8S_BACKOFF_BASE', '0.2'))
+k8s_backoff_max = float(os.environ.get('KTQ_K8S_BACKOFF_MAX', '10'))
+node_labels = os.environ.get('KTQ_NODE_LABELS', 'kubernetes.io/hostname').split(',')  # node labels returned by /api/nodes
+reconcile_page_size = int(os.environ.get('KTQ_RECONCILE_PAGE_SIZE', '500'))  # pods per LIST page at startup
+reconcile_timeout = float(os.environ.get('KTQ_RECONCILE_TIMEOUT', '60'))  # give up reconciliation after, in seconds
+workers = int(os.environ.get('KTQ_WORKERS', '1'))  # number of server processes, 0 means one per CPU
+leader_lease_ttl = float(os.environ.get('KTQ_LEADER_LEASE_TTL', '15'))  # seconds before another process takes over the watcher
+cluster_state_interval = float(os.environ.get('KTQ_CLUSTER_STATE_INTERVAL', '1'))  # seconds between shared state syncs
+jobs_count_cache_ttl = float(os.environ.get('KTQ_JOBS_COUNT_CACHE_TTL', '10'))  # seconds a cached total of /api/jobs is used
+change_feed_interval = float(os.environ.get('KTQ_CHANGE_FEED_INTERVAL', '0.5'))  # seconds between job_events polls
+change_feed_backlog = int(os.environ.get('KTQ_CHANGE_FEED_BACKLOG', '10000'))  # changes kept in memory for resuming
+change_feed_batch = int(os.environ.get('KTQ_CHANGE_FEED_BATCH', '1000'))
+change_feed_queue_size = int(os.environ.get('KTQ_CHANGE_FEED_QUEUE_SIZE', '1000'))  # per subscriber
+change_feed_size = int(os.environ.get('KTQ_CHANGE_FEED_SIZE', str(64 * 1024 * 1024)))  # bytes of capped collection job_events
+submit_clone_concurrency = int(os.environ.get('KTQ_SUBMIT_CLONE_CONCURRENCY', '4'))  # git clones per process
+submit_create_concurrency = int(os.environ.get('KTQ_SUBMIT_CREATE_CONCURRENCY', '8'))  # job creations per process
+submit_lease_ttl = float(os.environ.get('KTQ_SUBMIT_LEASE_TTL', '30'))  # seconds before a submission of a dead worker is resumed
+submit_max_attempts = int(os.environ.get('KTQ_SUBMIT_MAX_ATTEMPTS', '5'))
+submit_poll_interval = float(os.environ.get('KTQ_SUBMIT_POLL_INTERVAL', '2'))
+batch_max_jobs = int(os.environ.get('KTQ_BATCH_MAX_JOBS', '1000'))  # jobs per POST /api/jobs/batch
+scheduler_enabled = os.environ.get('KTQ_SCHEDULER', '1') == '1'  # queue jobs until they can start
+scheduler_interval = float(os.environ.get('KTQ_SCHEDULER_INTERVAL', '1'))
+scheduler_reservation_ttl = float(os.environ.get('KTQ_SCHEDULER_RESERVATION_TTL', '600'))  # seconds GPUs of a released job are reserved until it runs
+scheduler_status_interval = float(os.environ.get('KTQ_SCHEDULER_STATUS_INTERVAL', '5'))
+migration_batch_size = int(os.environ.get('KTQ_MIGRATION_BATCH_SIZE', '1000'))  # documents updated per batch
+migration_lease_ttl = float(os.environ.get('KTQ_MIGRATION_LEASE_TTL', '30'))
+migration_poll_interval = float(os.environ.get('KTQ_MIGRATION_POLL_INTERVAL', '5'))
+stats_flush_interval = float(os.environ.get('KTQ_STATS_FLUSH_INTERVAL', '300'))  # seconds between GPU-hours rollups of running jobs
+log_segment_size = int(os.environ.get('KTQ_LOG_SEGMENT_SIZE', str(1024 * 1024)))  # bytes of log per compressed segment
+log_compress_level = int(os.environ.get('KTQ_LOG_COMPRESS_LEVEL', '6'))  # gzip level of archived logs
+log_hub_tail_lines = int(os.environ.get('KTQ_LOG_HUB_TAIL_LINES', '1000'))  # tailLines of shared followed logs, other values get their own upstream
+log_hub_backlog = int(os.environ.get('KTQ_LOG_HUB_BACKLOG', str(1024 * 1024)))  # bytes of a followed log kept for new viewers
+log_hub_subscriber_buffer = int(os.environ.get('KTQ_LOG_HUB_SUBSCRIBER_BUFFER', str(4 * 1024 * 1024)))  # a slower viewer skips ahead
+log_shipper_enabled = os.environ.get('KTQ_LOG_SHIPPER', '1') == '1'  # archive logs of running pods incrementally
+log_checkpoint_interval = float(os.environ.get('KTQ_LOG_CHECKPOINT_INTERVAL', '30'))  # seconds between log checkpoints
+log_ship_lease_ttl = float(os.environ.get('KTQ_LOG_SHIP_LEASE_TTL', '120'))
+log_search_workers = int(os.environ.get('KTQ_LOG_SEARCH_WORKERS', '4'))  # threads scanning logs for /api/logs/search
+log_search_max_matches = int(os.environ.get('KTQ_LOG_SEARCH_MAX_MATCHES', '10000'))
+log_search_max_context = int(os.environ.get('KTQ_LOG_SEARCH_MAX_CONTEXT', '10'))  # lines before & after a match
+log_search_max_jobs = int(os.environ.get('KTQ_LOG_SEARCH_MAX_JOBS', '100'))  # jobs searched by one request
+log_search_per_user = int(os.environ.get('KTQ_LOG_SEARCH_PER_USER', '2'))  # searches a user can run at once in a process
+log_search_regex_timeout = float(os.environ.get('KTQ_LOG_SEARCH_REGEX_TIMEOUT', '10'))  # seconds a regex may search a block
+fs_executor_workers = int(os.environ.get('KTQ_FS_EXECUTOR_WORKERS', '8'))  # threads for shared filesystem operations
+fs_exists_ttl = float(os.environ.get('KTQ_FS_EXISTS_TTL', '30'))  # seconds an existing directory is cached
+fs_write_chunk_size = int(os.environ.get('KTQ_FS_WRITE_CHUNK_SIZE', str(1024 * 1024)))
+fs_slow_threshold = float(os.environ.get('KTQ_FS_SLOW_THRESHOLD', '1'))  # log filesystem operations slower than this
+# priority classes of jobs, name:priority, a job can preempt running jobs of lower priority
+priority_classes = {
+    name.strip(): int(priority)
+    for name, priority in (item.split(':') for item in os.environ.get('KTQ_PRIORITY_CLASSES', 'low:-10,normal:0,high:10').split(','))
+}
+default_priority_class = os.environ.get('KTQ_DEFAULT_PRIORITY_CLASS', 'normal')  # of jobs submitted without priorityClass
+preemption_enabled = os.environ.get('KTQ_PREEMPTION', '1') == '1'
+preemption_grace_period = int(os.environ.get('KTQ_PREEMPTION_GRACE_PERIOD', '120'))  # seconds between SIGTERM and SIGKILL
+preemption_max_per_cycle = int(os.environ.get('KTQ_PREEMPTION_MAX_PER_CYCLE', '8'))  # jobs preempted per scheduler cycle
+scheduler_backfill = os.environ.get('KTQ_SCHEDULER_BACKFILL', '0') == '1'  # EASY backfill with runtime estimates, off until measured on replayed history
+backfill_overrun_grace = float(os.environ.get('KTQ_BACKFILL_OVERRUN_GRACE', '300'))  # seconds a job running longer than estimated is still expected to run
+runtime_estimate_window = int(os.environ.get('KTQ_RUNTIME_ESTIMATE_WINDOW', '5'))  # recent jobs averaged per group
+runtime_estimate_min_samples = int(os.environ.get('KTQ_RUNTIME_ESTIMATE_MIN_SAMPLES', '2'))
+runtime_estimate_prefix_tokens = int(os.environ.get('KTQ_RUNTIME_ESTIMATE_PREFIX_TOKENS', '3'))  # words of command to group jobs by
+runtime_estimate_history = int(os.environ.get('KTQ_RUNTIME_ESTIMATE_HISTORY', '20000'))  # finished jobs loaded
+runtime_estimate_refresh = float(os.environ.get('KTQ_RUNTIME_ESTIMATE_REFRESH', '300'))
 job_namespace = os.environ.get('KTQ_JOB_NAMESPACE', 'ktqueue')
 auth_required = True if os.environ.get('KTQ_AUTH_REQUIRED', '0') == '1' else False
 cookie_secret = os.environ.get('KTQ_COOKIE_SECRET', '')
@@ -0,0 +1,260 @@
+# encoding: utf-8
+"""Run the scheduler over a synthetic workload or exported job history, without kubernetes or MongoDB.
+
+Compares first come first served (the baseline), fair share without and with backfill:
+    python -m ktqueue.simulator --jobs 5000 --nodes 32 --gpus 8 --users 10
+    python -m ktqueue.simulator --export history.jsonl  # finished jobs in MongoDB
+    python -m ktqueue.simulator --replay history.jsonl --nodes 32 --gpus 8
+"""
+import argparse
+import datetime
+import heapq
+import json
+import random
+import time
+from collections import defaultdict
+
+from ktqueue import settings
+from ktqueue.estimator import RuntimeEstimator
+from ktqueue.estimator import container_runtime
+from ktqueue.scheduler import best_fit
+from ktqueue.scheduler import expected_end
+from ktqueue.scheduler import plan
+
+
+def synthetic_workload(jobs, users, arrival_rate, gpu_choices, mean_duration, high_priority_ratio, seed):
+    """Poisson arrivals, every user repeats a few experiments of log-normal durations (seconds)."""
+    rand = random.Random(seed)
+    experiments = {
+        'user-{}'.format(user): [
+            (rand.choice(gpu_choices), rand.lognormvariate(0, 1) * mean_duration / 1.65)  # mean of lognormvariate(0, 1) is ~1.65
+            for _ in range(3)
+        ] for user in range(users)
+    }
+    now = 0.0
+    workload = []
+    for i in range(jobs):
+        now += rand.expovariate(arrival_rate)
+        user = 'user-{}'.format(int(rand.paretovariate(1.2)) % users)  # a few heavy users
+        experiment = rand.randrange(len(experiments[user]))
+        gpu_num, duration = experiments[user][experiment]
+        workload.append({
+            'name': 'job-{}'.format(i),
+            'user': user,
+            'image': 'image',
+            'command': 'python3 experiment-{}.py --seed {}'.format(experiment, i),
+            'gpuNum': gpu_num,
+            'priority': 1 if rand.random() < high_priority_ratio else 0,
+            'node': None,
+            'wallTime': None,
+            'submit': now,
+            'duration': duration * rand.lognormvariate(0, 0.3),
+        })
+    return workload
+
+
+def export_history(output):
+    """Write finished jobs in MongoDB as a workload, one JSON per line."""
+    import pymongo
+
+    client = pymongo.MongoClient(settings.mongodb_server)
+    count = 0
+    with open(output, 'w') as f:
+        for job in client.ktqueue.jobs.find(
+                {'$or': [{'runtime': {'$gt': 0}}, {'state.terminated.finishedAt': {'$exists': True}}]},
+                sort=[('_id', pymongo.ASCENDING)]):
+            duration = job.get('runtime', None) or container_runtime(job.get('state', None))
+            if not duration:
+                continue
+            f.write(json.dumps({
+                'name': job['name'],
+                'user': job.get('user', None),
+                'image': job.get('image', None),
+                'command': job.get('command', None),
+                'gpuNum': int(job.get('gpuNum', 0) or 0),
+                'priority': job.get('priority', 0) or 0,
+                'node': None,  # nodes of the replay are made up
+                'wallTime': job.get('wallTime', None),
+                'submit': job['_id'].generation_time.timestamp(),
+                'duration': duration,
+            }) + '\n')
+            count += 1
+    return count
+
+
+def load_workload(path):
+    with open(path) as f:
+        workload = [json.loads(line) for line in f if line.strip()]
+    workload.sort(key=lambda job: job['submit'])
+    if workload:
+        first = workload[0]['submit']
+        for job in workload:
+            job['submit'] -= first
+    return workload
+
+
+def fcfs_plan(pending, free, usage, now=None, running=None):
+    """By priority then first come first served, the first job which doesn't fit blocks the others."""
+    released = []
+    for job in sorted(pending, key=lambda job: (-job['priority'], job['queuedAt'])):
+        fits, node = best_fit(job, free)
+        if not fits:
+            break
+        if node in free:
+            free[node] -= job['gpuNum']
+        usage[job['user']] = usage.get(job['user'], 0) + job['gpuNum']
+        released.append((job, node))
+    return released
+
+
+def simulate(workload, nodes, backfill=False, plan=plan):
+    """Replay `workload` on `nodes` ({name: GPUs}), return per job waits and scheduler statistics.
+        With backfill, runtime is estimated from the jobs finished so far in the replay.
+    """
+    epoch = datetime.datetime(2000, 1, 1)
+    events = []  # (time, order, job), job finishes if it is running, arrives otherwise
+    for order, job in enumerate(workload):
+        heapq.heappush(events, (job['submit'], order, job))
+    order = len(workload)
+
+    estimator = RuntimeEstimator()
+    free = dict(nodes)
+    usage = defaultdict(int)
+    pending = {}
+    running = {}  # name -> (node, start, estimate, GPUs)
+    waits = {}
+    plan_times = []
+    busy_gpu_seconds = 0.0
+    now = 0.0
+    last = None
+    while events:
+        now = events[0][0]
+        if last is not None:
+            busy_gpu_seconds += (sum(nodes.values()) - sum(free.values())) * (now - last)
+        last = now
+        while events and events[0][0] == now:
+            _, _, job = heapq.heappop(events)
+            if job['name'] in running:
+                node = running.pop(job['name'])[0]
+                if node in free:
+                    free[node] += job['gpuNum']
+                usage[job['user']] -= job['gpuNum']
+                estimator.add(job, job['duration'])
+            else:
+                pending[job['name']] = dict(job, queuedAt=epoch + datetime.timedelta(seconds=job['submit']))
+
+        running_ends = None
+        if backfill:
+            for job in pending.values():
+                job['estimate'] = estimator.estimate(job)
+            running_ends = defaultdict(list)
+            for node, start, estimate, gpus in running.values():
+                running_ends[node].append((expected_end(start, estimate, now), gpus))
+
+        start = time.perf_counter()
+        released = plan(list(pending.values()), free, usage, now=now, running=running_ends)
+        plan_times.append(time.perf_counter() - start)
+        for job, node in released:
+            del pending[job['name']]
+            running[job['name']] = (node, now, job.get('estimate', None), job['gpuNum'])
+            waits[job['name']] = now - job['submit']
+            heapq.heappush(events, (now + job['duration'], order, job))
+            order += 1
+
+    return {
+        'waits': waits,
+        'unscheduled': sorted(pending),
+        'makespan': now,
+        'utilization': busy_gpu_seconds / (sum(nodes.values()) * now) if now else 0.0,
+        'plan_times': plan_times,
+    }
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def report(workload, result):
+    jobs = {job['name']: job for job in workload}
+    waits = list(result['waits'].values())
+    by_user = defaultdict(list)
+    by_priority = defaultdict(list)
+    by_gpus = defaultdict(list)
+    for name, wait in result['waits'].items():
+        by_user[jobs[name]['user']].append(wait)
+        by_priority[jobs[name]['priority']].append(wait)
+        by_gpus[jobs[name]['gpuNum']].append(wait)
+    return {
+        'jobs': len(workload),
+        'scheduled': len(waits),
+        'unscheduled': len(result['unscheduled']),
+        'wait': {
+            'avg': sum(waits) / len(waits) if waits else 0.0,
+            'p50': percentile(waits, 0.5),
+            'p95': percentile(waits, 0.95),
+            'max': max(waits) if waits else 0.0,
+        },
+        'wait_avg_by_priority': {str(p): sum(w) / len(w) for p, w in sorted(by_priority.items())},
+        'wait_avg_by_user': {user: sum(w) / len(w) for user, w in sorted(by_user.items())},
+        'wait_max_by_gpus': {str(gpus): max(w) for gpus, w in sorted(by_gpus.items())},
+        'makespan': result['makespan'],
+        'utilization': result['utilization'],
+        'plan': {
+            'cycles': len(result['plan_times']),
+            'avg': sum(result['plan_times']) / len(result['plan_times']) if result['plan_times'] else 0.0,
+            'max': max(result['plan_times']) if result['plan_times'] else 0.0,
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--export', metavar='FILE', help='export finished jobs in MongoDB to FILE and exit')
+    parser.add_argument('--replay', metavar='FILE', help='replay a workload exported by --export')
+    parser.add_argument('--jobs', type=int, default=2000)
+    parser.add_argument('--nodes', type=int, default=16)
+    parser.add_argument('--gpus', type=int, default=8, help='GPUs per node')
+    parser.add_argument('--users', type=int, default=8)
+    parser.add_argument('--arrival-rate', type=float, default=0.01, help='jobs per second')
+    parser.add_argument('--gpu-choices', default='1,1,1,2,2,4,8')
+    parser.add_argument('--mean-duration', type=float, default=3600, help='seconds')
+    parser.add_argument('--high-priority-ratio', type=float, default=0.1)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    if args.export:
+        print('{} jobs exported.'.format(export_history(args.export)))
+        return
+
+    if args.replay:
+        workload = load_workload(args.replay)
+    else:
+        workload = synthetic_workload(
+            jobs=args.jobs, users=args.users, arrival_rate=args.arrival_rate,
+            gpu_choices=[int(n) for n in args.gpu_choices.split(',')], mean_duration=args.mean_duration,
+            high_priority_ratio=args.high_priority_ratio, seed=args.seed)
+    nodes = {'node-{}'.format(i): args.gpus for i in range(args.nodes)}
+
+    results = {
+        'fcfs': report(workload, simulate(workload, nodes, plan=fcfs_plan)),
+        'no_backfill': report(workload, simulate(workload, nodes, backfill=False)),
+        'backfill': report(workload, simulate(workload, nodes, backfill=True)),
+    }
+    results['gain'] = {}  # over the baseline
+    baseline = results['fcfs']
+    for name in ('no_backfill', 'backfill'):
+        after = results[name]
+        results['gain'][name] = {
+            'utilization': after['utilization'] - baseline['utilization'],
+            'wait_avg': 1 - after['wait']['avg'] / baseline['wait']['avg'] if baseline['wait']['avg'] else 0.0,
+            'wait_p95': 1 - after['wait']['p95'] / baseline['wait']['p95'] if baseline['wait']['p95'] else 0.0,
+            'wait_max': 1 - after['wait']['max'] / baseline['wait']['max'] if baseline['wait']['max'] else 0.0,
+        }
+    print(json.dumps(results, indent=2, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,253 @@
+# encoding: utf-8
+"""GPU-hours & job counts rolled up in hourly and daily buckets per user, node and status.
+
+Every rollup document is one (period, dimension, key, start) bucket:
+    {'period': 'hour', 'dimension': 'user', 'key': 'alice', 'start': datetime, 'gpuSeconds': 7200.0, 'jobs': 1}
+GPU time of user & node buckets is split across the hours it was used, a
+finished run is counted in `jobs` of the bucket it finished in. Status
+buckets only count finished runs (and their whole GPU time) by final status.
+
+UsageRollup keeps them up to date from pod events of watch_pod, the time
+a job has been accounted for is kept in its `usage_cursors` document
+({_id: job name, accountedUntil, accountedRun}) so a replayed event is
+never counted twice. Rebuild from job documents with:
+    python -m ktqueue.stats --backfill
+"""
+import argparse
+import asyncio
+import datetime
+import logging
+import time
+from collections import defaultdict
+
+import pymongo
+
+from ktqueue import settings
+from ktqueue.estimator import parse_time
+
+PERIODS = ('hour', 'day')
+DIMENSIONS = ('user', 'node', 'status')
+
+
+def container_interval(state):
+    """(startedAt, finishedAt) of a container as UTC datetime, finishedAt is None if it is running."""
+    state = state or {}
+    for key in ('running', 'terminated'):
+        started_at = (state.get(key, None) or {}).get('startedAt', None)
+        if started_at:
+            finished_at = state[key].get('finishedAt', None) if key == 'terminated' else None
+            return parse_time(started_at), parse_time(finished_at) if finished_at else None
+    return None
+
+
+def bucket_start(moment, period):
+    moment = moment.replace(minute=0, second=0, microsecond=0)
+    return moment.replace(hour=0) if period == 'day' else moment
+
+
+def split_hours(start, end):
+    """Yield (hour, seconds) of [start, end) in every hour it overlaps."""
+    hour = bucket_start(start, 'hour')
+    while hour < end:
+        next_hour = hour + datetime.timedelta(hours=1)
+        seconds = (min(end, next_hour) - max(start, hour)).total_seconds()
+        if seconds > 0:
+            yield hour, seconds
+        hour = next_hour
+
+
+def rollup_id(period, dimension, key, start):
+    return '{}:{}:{}:{}'.format(period, dimension, key, start.strftime('%Y%m%d%H'))
+
+
+def increments(user, node, gpus, since, end, finished=None, started=None):
+    """Rollup increments {(period, dimension, key, start): [gpuSeconds, jobs]} of a job using `gpus` in [since, end).
+        `finished` is the final status if the run ended at `end`, the run started at `started`.
+    """
+    incs = defaultdict(lambda: [0.0, 0])
+    keys = [('user', user or 'unknown')]
+    if node:
+        keys.append(('node', node))
+    for hour, seconds in split_hours(since, end):
+        for period in PERIODS:
+            for dimension, key in keys:
+                incs[(period, dimension, key, bucket_start(hour, period))][0] += seconds * gpus
+    if finished:
+        runtime = (end - (started or since)).total_seconds()
+        for period in PERIODS:
+            for dimension, key in keys:
+                incs[(period, dimension, key, bucket_start(end, period))][1] += 1
+            incs[(period, 'status', finished, bucket_start(end, period))][0] += runtime * gpus
+            incs[(period, 'status', finished, bucket_start(end, period))][1] += 1
+    return incs
+
+
+def rollup_updates(incs):
+    return [
+        pymongo.UpdateOne(
+            {'_id': rollup_id(period, dimension, key, start)},
+            {
+                '$setOnInsert': {'period': period, 'dimension': dimension, 'key': key, 'start': start},
+                '$inc': {'gpuSeconds': gpu_seconds, 'jobs': jobs},
+            },
+            upsert=True)
+        for (period, dimension, key, start), (gpu_seconds, jobs) in incs.items()
+    ]
+
+
+class UsageRollup:
+    """Account GPU time of jobs in rollups as pod events come, run by the leader with watch_pod.
+
+    Running jobs are accounted every `interval` seconds, a run is finished
+    when its pod terminates or is deleted. `accountedUntil` of the job's
+    cursor is advanced atomically before the rollups are incremented, and a
+    finished run is recorded in `accountedRun`, so replays of the same events
+    (relist, reconcile, a new leader) add nothing. A crash between the two
+    writes loses at most one interval instead of counting it twice.
+    """
+
+    def __init__(self, db, interval=None):
+        self.jobs_collection = db.jobs
+        self.cursors = db.usage_cursors
+        self.collection = db.usage_rollups
+        self.interval = interval or settings.stats_flush_interval
+        self.running = {}  # job name -> (job, node, startedAt)
+
+    async def observe(self, job, node, state, finished=None, deleted=False):
+        """Handle a pod event of `job` ({name, user, gpuNum, status}) on `node`.
+            `finished` is the final status if the container terminated.
+        """
+        interval = container_interval(state)
+        if interval is None:
+            return
+        started, end = interval
+        if end is None and not deleted:
+            self.running[job['name']] = (job, node, started)
+            return
+        self.running.pop(job['name'], None)
+        await self.account(job, node, started, end or datetime.datetime.utcnow(), finished=finished or job['status'])
+
+    async def account(self, job, node, started, end, finished=None):
+        """Account [accountedUntil, end) of the run started at `started`, count the run if it is `finished`."""
+        gpus = int(job.get('gpuNum', 0) or 0)
+        run = started.isoformat()
+        filter = {'_id': job['name']}
+        update = {'$max': {'accountedUntil': end}}
+        if finished:
+            filter['accountedRun'] = {'$ne': run}
+            update['$set'] = {'accountedRun': run}
+        try:
+            before = await self.cursors.find_one_and_update(filter, update, upsert=True)
+        except pymongo.errors.DuplicateKeyError:  # finished run already counted
+            return
+        if before is None:  # no cursor yet, older versions kept it in the job until migration 4 moves it
+            before = await self.jobs_collection.find_one(
+                {'name': job['name']}, {'accountedUntil': True, 'accountedRun': True}) or {}
+            if finished and before.get('accountedRun', None) == run:
+                return
+        since = max(started, before.get('accountedUntil', None) or started)
+        if since >= end and not finished:
+            return
+        incs = increments(job.get('user', None), node, gpus, since, max(since, end), finished=finished, started=started)
+        if incs:
+            await self.collection.bulk_write(rollup_updates(incs), ordered=False)
+
+    async def flush(self):
+        now = datetime.datetime.utcnow()
+        for job, node, started in list(self.running.values()):
+            try:
+                await self.account(job, node, started, now)
+            except Exception as e:
+                logging.exception(e)
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            await self.flush()
+
+
+def parse_date(value):
+    """Parse 2018-01-01, 2018-01-01T08 or 2018-01-01T08:30:00 as UTC."""
+    for fmt in ('%Y-%m-%d', '%Y-%m-%dT%H', '%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M:%SZ'):
+        try:
+            return datetime.datetime.strptime(value, fmt)
+        except ValueError:
+            pass
+    raise ValueError('invalid date {}'.format(value))
+
+
+async def query_rollups(collection, period, dimension, since, until, keys=None):
+    """Buckets of [since, until), answered by the (period, dimension, start) index."""
+    query = {'period': period, 'dimension': dimension, 'start': {'$gte': bucket_start(since, period), '$lt': until}}
+    if keys:
+        query['key'] = {'$in': keys}
+    docs = await collection.find(
+        query, projection={'_id': False, 'key': True, 'start': True, 'gpuSeconds': True, 'jobs': True},
+        sort=[('start', pymongo.ASCENDING)])
+    series = []
+    totals = defaultdict(lambda: {'gpuHours': 0.0, 'jobs': 0})
+    for doc in docs:
+        gpu_hours = doc.get('gpuSeconds', 0) / 3600
+        series.append({'key': doc['key'], 'start': doc['start'].isoformat(), 'gpuHours': gpu_hours,
+                       'jobs': doc.get('jobs', 0)})
+        totals[doc['key']]['gpuHours'] += gpu_hours
+        totals[doc['key']]['jobs'] += doc.get('jobs', 0)
+    totals = [dict(total, key=key) for key, total in totals.items()]
+    totals.sort(key=lambda total: -total['gpuHours'])
+    return series, totals
+
+
+def backfill(client, batch_size=1000):
+    """Rebuild rollups from the last run recorded in every job document.
+        Earlier runs of a job are not recorded and not counted. Events accounted
+        by the leader while this runs may be counted twice, run it when it is quiet.
+    """
+    db = client.ktqueue
+    db.usage_rollups.delete_many({})
+    now = datetime.datetime.utcnow()
+    incs = defaultdict(lambda: [0.0, 0])
+    cursor_updates = []
+    count = 0
+    for job in db.jobs.find({'state': {'$exists': True}}, projection={
+            'name': True, 'user': True, 'gpuNum': True, 'status': True, 'state': True, 'runningNode': True, 'node': True}):
+        interval = container_interval(job['state'])
+        if interval is None:
+            continue
+        started, end = interval
+        finished = job['status'] if end is not None else None
+        end = end or now
+        node = job.get('runningNode', None) or job.get('node', None)
+        for key, inc in increments(job.get('user', None), node, int(job.get('gpuNum', 0) or 0), started, end,
+                                   finished=finished, started=started).items():
+            incs[key][0] += inc[0]
+            incs[key][1] += inc[1]
+        cursor = {'accountedUntil': end}
+        if finished:
+            cursor['accountedRun'] = started.isoformat()
+        cursor_updates.append(pymongo.ReplaceOne({'_id': job['name']}, cursor, upsert=True))
+        count += 1
+        if len(cursor_updates) >= batch_size:
+            db.usage_cursors.bulk_write(cursor_updates, ordered=False)
+            cursor_updates = []
+    if cursor_updates:
+        db.usage_cursors.bulk_write(cursor_updates, ordered=False)
+    updates = rollup_updates(incs)
+    for i in range(0, len(updates), batch_size):
+        db.usage_rollups.bulk_write(updates[i:i + batch_size], ordered=False)
+    return count, len(updates)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--backfill', action='store_true', help='rebuild rollups from job documents')
+    args = parser.parse_args()
+    if not args.backfill:
+        parser.print_help()
+        return
+    start = time.time()
+    jobs, buckets = backfill(pymongo.MongoClient(settings.mongodb_server))
+    print('{} jobs rolled up into {} buckets in {:.1f}s.'.format(jobs, buckets, time.time() - start))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,119 @@
+# encoding: utf-8
+import asyncio
+import logging
+from collections import OrderedDict
+
+import pymongo
+
+from ktqueue import settings
+
+
+class JobStatusWriter:
+    """Write-behind buffer for job status updates.
+
+    Updates of the same job within `max_latency` seconds are merged into one
+    `$set` and all buffered jobs are written by a single `bulk_write`.
+    Flushes never overlap, so updates of one job reach MongoDB in order.
+    An update can be skipped when the job is in one of the `unless` statuses
+    by the time it is written, e.g. stopped by a handler meanwhile.
+    """
+
+    def __init__(self, collection, max_latency=None, max_batch=None, on_flush=None):
+        """on_flush: called with {job name: fields} after a successful write"""
+        self.collection = collection
+        self.on_flush = on_flush
+        self.max_latency = settings.status_flush_interval if max_latency is None else max_latency
+        self.max_batch = max_batch or settings.status_flush_batch
+        self.pending = OrderedDict()
+        self.guards = {}  # job name -> `unless` statuses of its latest update
+        self.lock = asyncio.Lock()
+        self.timer = None
+        self.counters = {
+            'updates': 0,
+            'coalesced': 0,
+            'flushes': 0,
+            'writes': 0,
+            'skipped': 0,
+        }
+
+    def set(self, name, fields, unless=None):
+        """Buffer a `$set` of `fields` for job `name`, not written if the job's status is in `unless` then."""
+        self.counters['updates'] += 1
+        if name in self.pending:
+            self.counters['coalesced'] += 1
+            self.pending[name].update(fields)
+        else:
+            self.pending[name] = dict(fields)
+        if unless:
+            self.guards[name] = list(unless)
+        else:
+            self.guards.pop(name, None)
+
+        if len(self.pending) >= self.max_batch:
+            self.schedule(0)
+        elif self.timer is None:
+            self.schedule(self.max_latency)
+
+    def schedule(self, delay):
+        if self.timer is not None:
+            self.timer.cancel()
+        loop = asyncio.get_event_loop()
+        self.timer = loop.call_later(delay, lambda: loop.create_task(self.flush()))
+
+    async def flush(self):
+        async with self.lock:
+            self.timer = None
+            if not self.pending:
+                return
+            batch, self.pending = self.pending, OrderedDict()
+            guards, self.guards = self.guards, {}
+            requests = [pymongo.UpdateOne(self.filter(name, guards.get(name, None)), {'$set': fields})
+                        for name, fields in batch.items()]
+            try:
+                ret = await self.collection.bulk_write(requests, ordered=False)
+                if guards and ret.matched_count < len(requests):
+                    batch = await self.written(batch, guards)
+            except Exception as e:
+                logging.exception(e)
+                # put them back, newer updates buffered meanwhile win
+                for name, fields in batch.items():
+                    if name in self.pending:
+                        fields.update(self.pending[name])
+                    elif name in guards:
+                        self.guards[name] = guards[name]
+                    self.pending[name] = fields
+                if self.timer is None:
+                    self.schedule(self.max_latency)
+            else:
+                self.counters['flushes'] += 1
+                self.counters['writes'] += len(requests)
+                if self.on_flush is not None:
+                    self.on_flush(batch)
+
+    @staticmethod
+    def filter(name, unless):
+        if unless:
+            return {'name': name, 'status': {'$nin': unless}}
+        return {'name': name}
+
+    async def written(self, batch, guards):
+        """`batch` without the guarded updates skipped by bulk_write, they must not be published."""
+        docs = await self.collection.find({'name': {'$in': list(guards)}}, projection={'name': True, 'status': True})
+        status = {doc['name']: doc.get('status', None) for doc in docs}
+        written = OrderedDict(
+            (name, fields) for name, fields in batch.items()
+            if name not in guards or 'status' not in fields or status.get(name, None) == fields['status'])
+        self.counters['skipped'] += len(batch) - len(written)
+        return written
+
+
+_status_writer = None
+
+
+def get_status_writer():
+    """Return the JobStatusWriter of watch_pod, kept by the process so /api/metrics can report it."""
+    global _status_writer
+    if _status_writer is None:
+        from .db import get_db
+        _status_writer = JobStatusWriter(get_db().jobs)
+    return _status_writer
@@ -0,0 +1,286 @@
+# encoding: utf-8
+import asyncio
+import datetime
+import logging
+import os
+import time
+from collections import defaultdict
+
+import pymongo
+
+from ktqueue import settings
+from ktqueue.change_feed import get_change_feed
+from ktqueue.cloner import Cloner
+from ktqueue.cluster import process_identity
+from ktqueue.fs import fs
+from ktqueue.utils import KTQueueDefaultCredentialProvider
+
+
+def generate_job_from_record(record):
+    """Kubernetes Job description of a job document."""
+    from .api.job import generate_job
+    job = defaultdict(lambda: None)
+    job.update(record)
+    return generate_job(
+        name=job['name'], command=job['command'], gpu_num=int(job['gpuNum']), image=job['image'],
+        node=job['scheduledHostname'] or job['node'] or job['scheduledNode'],  # nodeSelector is the hostname label
+        repo=job['repo'], branch=job['branch'], commit_id=job['commit'], comments=job['comments'],
+        mounts=job['volumeMounts'] or [], cpu_limit=job['cpuLimit'], memory_limit=job['memoryLimit'],
+        auto_restart=job['autoRestart'] or False, wall_time=job['wallTime'],
+    )
+
+
+class SubmissionQueue:
+    """Durable job submission pipeline.
+
+    A submission is a document in `submissions` going through stages:
+        clone: clone repo & copy code to job directory
+        schedule: wait until the Scheduler releases it (skipped if the scheduler is disabled)
+        create: create the Kubernetes Job
+    Workers of every process claim submissions with a lease, a submission
+    whose worker died is claimed again when its lease expires, so nothing is
+    stuck in `fetching` after a restart. Each stage has its own concurrency
+    limit per process. Time spent queued and in each stage is recorded in
+    `timings` of the job document.
+    """
+
+    stages = ('clone', 'schedule', 'create')
+    worker_stages = ('clone', 'create')  # `schedule` is handled by the Scheduler
+    failed_status = {'clone': 'FetchError', 'create': 'CreateError'}  # job status when a stage gives up
+
+    def __init__(self, db, k8s_client=None):
+        self.db = db
+        self.collection = db.submissions
+        self.jobs_collection = db.jobs
+        self.k8s_client = k8s_client
+        self.identity = process_identity()
+        self.lease_ttl = settings.submit_lease_ttl
+        self.concurrency = {
+            'clone': settings.submit_clone_concurrency,
+            'create': settings.submit_create_concurrency,
+        }
+        self.wakeup = {stage: asyncio.Event() for stage in self.stages}
+        self.counters = defaultdict(int)
+
+    def submission(self, job_name, user, stage, archive):
+        now = datetime.datetime.utcnow()
+        return {
+            'job': job_name,
+            'user': user,
+            'stage': stage,
+            'state': 'queued',
+            'owner': None,
+            'leaseExpireAt': now,
+            'submittedAt': now,
+            'stageQueuedAt': now,
+            'attempts': 0,
+            'error': None,
+            'archive': archive,
+        }
+
+    async def enqueue(self, job_name, user, stage='clone', archive=None):
+        """Submit a job, `archive` is a code archive to extract instead of cloning the repo."""
+        await self.collection.update_one(
+            {'job': job_name}, {'$set': self.submission(job_name, user, stage, archive)}, upsert=True)
+        self.counters['enqueued'] += 1
+        self.wakeup[stage].set()
+
+    async def enqueue_many(self, job_names, user, stage='clone', archive=None):
+        """Submit jobs with one bulk write."""
+        if not job_names:
+            return
+        await self.collection.bulk_write([
+            pymongo.UpdateOne({'job': name}, {'$set': self.submission(name, user, stage, archive)}, upsert=True)
+            for name in job_names
+        ], ordered=False)
+        self.counters['enqueued'] += len(job_names)
+        self.wakeup[stage].set()
+
+    async def claim(self, stage):
+        now = datetime.datetime.utcnow()
+        return await self.collection.find_one_and_update(
+            {'stage': stage, 'state': {'$in': ['queued', 'running']}, 'leaseExpireAt': {'$lt': now}},
+            {'$set': {
+                'state': 'running',
+                'owner': self.identity,
+                'leaseExpireAt': now + datetime.timedelta(seconds=self.lease_ttl),
+            }},
+            sort=[('leaseExpireAt', pymongo.ASCENDING)],
+            return_document=pymongo.ReturnDocument.AFTER,
+        )
+
+    async def renew(self, submission):
+        while True:
+            await asyncio.sleep(self.lease_ttl / 3)
+            await self.collection.update_one(
+                {'_id': submission['_id'], 'owner': self.identity},
+                {'$set': {'leaseExpireAt': datetime.datetime.utcnow() + datetime.timedelta(seconds=self.lease_ttl)}})
+
+    async def advance(self, submission, stage):
+        """Move submission to `stage`, or finish it if stage is None."""
+        update = {'owner': None, 'stageQueuedAt': datetime.datetime.utcnow(), 'attempts': 0}
+        if stage is None:
+            update['state'] = 'done'
+        else:
+            update.update({'stage': stage, 'state': 'queued', 'leaseExpireAt': datetime.datetime.utcnow()})
+        await self.collection.update_one({'_id': submission['_id'], 'owner': self.identity}, {'$set': update})
+        if stage is not None:
+            self.wakeup[stage].set()
+
+    async def release(self, job_names):
+        """Move scheduled submissions to `create`."""
+        now = datetime.datetime.utcnow()
+        await self.collection.update_many(
+            {'job': {'$in': job_names}, 'stage': 'schedule', 'state': 'queued'},
+            {'$set': {'stage': 'create', 'leaseExpireAt': now, 'stageQueuedAt': now}})
+        self.wakeup['create'].set()
+
+    async def cancel(self, job_name):
+        """Stop a submission, a worker running it will not advance it."""
+        await self.collection.update_one(
+            {'job': job_name, 'state': {'$in': ['queued', 'running']}},
+            {'$set': {'state': 'cancelled', 'owner': None}})
+
+    @property
+    def after_clone(self):
+        return 'schedule' if settings.scheduler_enabled else 'create'
+
+    async def fail(self, submission, error, retry=False):
+        """Retry the stage later, or give up: the submission is `failed` and the job gets a terminal status."""
+        attempts = submission.get('attempts', 0) + 1
+        update = {'owner': None, 'error': str(error), 'attempts': attempts}
+        failed = not retry or attempts >= settings.submit_max_attempts
+        if failed:
+            update['state'] = 'failed'
+            self.counters['failed'] += 1
+        else:
+            update.update({
+                'state': 'queued',
+                'leaseExpireAt': datetime.datetime.utcnow() + datetime.timedelta(seconds=2 ** attempts),
+            })
+        ret = await self.collection.update_one({'_id': submission['_id'], 'owner': self.identity}, {'$set': update})
+        if failed and ret.matched_count:  # not cancelled meanwhile
+            job_update = {'status': self.failed_status[submission['stage']], 'error': str(error)}
+            ret = await self.jobs_collection.update_one({'name': submission['job']}, {'$set': job_update})
+            if ret.matched_count:
+                get_change_feed().publish_job(submission['job'], job_update)
+
+    async def run_clone(self, submission, job):
+        from .api.job import clone_code
+        job_dir = os.path.join('/cephfs/ktqueue/jobs/', job['name'])
+        await self.jobs_collection.update_one({'name': job['name']}, {'$set': {'status': 'fetching', 'error': None}})
+        get_change_feed().publish_job(job['name'], {'status': 'fetching', 'error': None})
+        if submission.get('archive', None):  # archived once for a batch
+            try:
+                await Cloner.extract(submission['archive'], os.path.join(job_dir, 'code'))
+            except Exception:
+                await self.jobs_collection.update_one({'name': job['name']}, {'$set': {'status': 'FetchError'}})
+                get_change_feed().publish_job(job['name'], {'status': 'FetchError'})
+                raise
+        else:
+            await clone_code(
+                name=job['name'], repo=job.get('repo', None), branch=job.get('branch', None),
+                commit_id=job.get('commit', None), jobs_collection=self.jobs_collection, job_dir=job_dir,
+                crediential=KTQueueDefaultCredentialProvider(
+                    repo=job.get('repo', None), user=submission['user'], db=self.db))
+        if self.after_clone == 'schedule':
+            ret = await self.jobs_collection.update_one(
+                {'name': job['name'], 'status': 'fetching'}, {'$set': {'status': 'queued'}})
+            if ret.modified_count:
+                get_change_feed().publish_job(job['name'], {'status': 'queued'})
+        return self.after_clone
+
+    async def run_create(self, submission, job):
+        from .api.job import make_job_dirs
+        await make_job_dirs(job['name'])
+        # before the pod exists: watch_pod doesn't overwrite `queued` with status of a pod
+        ret = await self.jobs_collection.update_one(
+            {'name': job['name'], 'status': 'queued'}, {'$set': {'status': 'pending'}})
+        if ret.modified_count:
+            get_change_feed().publish_job(job['name'], {'status': 'pending'})
+        ret = await self.k8s_client.call_api(
+            api='/apis/batch/v1/namespaces/{namespace}/jobs'.format(namespace=settings.job_namespace),
+            method='POST',
+            data=generate_job_from_record(job),
+        )
+        if ret.get('reason', None) == 'AlreadyExists':  # created before a crash
+            return None
+        if 'metadata' not in ret or 'creationTimestamp' not in ret['metadata']:
+            raise Exception('create job failed: {}'.format(ret.get('message', ret)))
+        update = {'status': 'pending', 'creationTimestamp': ret['metadata']['creationTimestamp'], 'error': None}
+        await self.jobs_collection.update_one({'name': job['name']}, {'$set': update})
+        get_change_feed().publish_job(job['name'], update)
+        return None
+
+    async def remove_archive(self, archive):
+        """Remove a batch archive once no submission needs it."""
+        if await self.collection.count({'archive': archive, 'stage': 'clone', 'state': {'$in': ['queued', 'running']}}):
+            return
+        try:
+            await fs.remove(archive)
+        except FileNotFoundError:
+            pass
+
+    async def process(self, stage, submission):
+        start = time.time()
+        queued = (datetime.datetime.utcnow() - submission['stageQueuedAt']).total_seconds()
+        renew_task = asyncio.ensure_future(self.renew(submission))
+        try:
+            job = await self.jobs_collection.find_one({'name': submission['job']})
+            if job is None:
+                await self.fail(submission, 'job {} not found'.format(submission['job']))
+                return
+            try:
+                next_stage = await getattr(self, 'run_' + stage)(submission, job)
+            except Exception as e:
+                logging.exception(e)
+                # clone failures are not retried, the user has to restart the job
+                await self.fail(submission, e, retry=stage != 'clone')
+                return
+            await self.jobs_collection.update_one({'name': job['name']}, {'$set': {
+                'timings.{}Queued'.format(stage): queued,
+                'timings.{}'.format(stage): time.time() - start,
+            }})
+            await self.advance(submission, next_stage)
+            self.counters[stage] += 1
+            if stage == 'clone' and submission.get('archive', None):
+                await self.remove_archive(submission['archive'])
+        finally:
+            renew_task.cancel()
+
+    async def worker(self, stage):
+        while True:
+            try:
+                submission = await self.claim(stage)
+            except Exception as e:
+                logging.exception(e)
+                submission = None
+            if submission is None:
+                self.wakeup[stage].clear()
+                try:
+                    await asyncio.wait_for(self.wakeup[stage].wait(), settings.submit_poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self.process(stage, submission)
+            except Exception as e:
+                logging.exception(e)
+
+    async def run(self):
+        """Run workers, submissions left by a crashed process are resumed once their lease expires."""
+        await asyncio.wait([
+            asyncio.ensure_future(self.worker(stage))
+            for stage in self.worker_stages for _ in range(self.concurrency[stage])
+        ])
+
+
+_submission_queue = None
+
+
+def get_submission_queue(k8s_client=None):
+    global _submission_queue
+    if _submission_queue is None:
+        from .db import get_db
+        _submission_queue = SubmissionQueue(get_db(), k8s_client=k8s_client)
+    return _submission_queue
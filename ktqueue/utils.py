@@ -1,51 +1,33 @@
 # encoding: utf-8
-import os
-import re
+import asyncio
 import logging
 
 from ktqueue import settings
+from ktqueue import log_store
 from .cloner import GitCredentialProvider
+from .pod_cache import pod_cache
+from .fs import fs
+from .log_shipper import get_log_shipper
+from .kubernetes_client import PRIORITY_LOW
 
 
-def get_log_versions(job_name):
-    log_dir = os.path.join('/cephfs/ktqueue/logs', job_name)
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    versions = []
-    for filename in os.listdir(log_dir):
-        group = re.match(r'log\.(?P<id>\d+)\.txt', filename)
-        if group:
-            versions.append(int(group.group('id')))
-    return sorted(versions)
-
-
-async def save_job_log(job_name, pod_name, k8s_client):
-    log_dir = os.path.join('/cephfs/ktqueue/logs', job_name)
-    if not os.path.exists(log_dir):
-        os.makedirs(log_dir)
-    resp = await k8s_client.call_api_raw(
-        method='GET',
-        api='/api/v1/namespaces/{namespace}/pods/{pod_name}/log'.format(namespace=settings.job_namespace, pod_name=pod_name)
-    )
-    logging.info('save log for {}, resp.status = {}'.format(job_name, resp.status))
-    if resp.status > 300:
-        resp.close()
-        return
+async def get_log_versions(job_name):
+    log_dir = log_store.log_dir(job_name)
+    await fs.makedirs(log_dir)
+    return log_store.log_versions(await fs.listdir(log_dir))
 
-    max_version = 0
-    for version in get_log_versions(job_name=job_name):
-        max_version = max(max_version, int(version))
-    log_path = os.path.join(log_dir, 'log.{}.txt'.format(max_version + 1))
 
-    with open(log_path, 'wb') as f:
-        async for chunk in resp.content.iter_any():
-            f.write(chunk)
-    resp.close()
+async def save_job_log(job_name, pod_name, k8s_client, follow=False):
+    """Save the rest of the log of a pod since its last checkpoint, with `follow` until its container exits.
+        Most of it was already shipped while the pod ran, see LogShipper.
+    """
+    await get_log_shipper().finish(job_name, pod_name, k8s_client, follow=follow)
 
 
 async def k8s_delete_job(k8s_client, job, pod_name=None, save_log=True):
     await k8s_client.call_api(
         method='DELETE',
+        priority=PRIORITY_LOW,
         params={'gracePeriodSeconds': 0},
         api='/apis/batch/v1/namespaces/{namespace}/jobs/{name}'.format(namespace=settings.job_namespace, name=job)
     )
@@ -53,23 +35,21 @@ async def k8s_delete_job(k8s_client, job, pod_name=None, save_log=True):
     await k8s_client.call_api(
         api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
         method='PATCH',
+        priority=PRIORITY_LOW,
         params={'labelSelector': 'job-name={job}'.format(job=job)},
         headers={'Content-Type': 'application/json-patch+json'},
         data=[{"op": "add", "path": "/metadata/labels/ktqueue-terminating", "value": "true"}]
     )
 
     if pod_name is None:
-        pods = await k8s_client.call_api(
-            method='GET',
-            api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
-            params={'labelSelector': 'job-name={job}'.format(job=job)}
-        )
-        if save_log and pods.get('items', None):
-            for pod in pods["items"]:
+        pods = await pod_cache.get_job_pods(k8s_client, job)
+        if save_log and pods:
+            for pod in pods:
                 name = pod['metadata']['name']
                 await save_job_log(job_name=job, pod_name=name, k8s_client=k8s_client)
         await k8s_client.call_api(
             method='DELETE',
+            priority=PRIORITY_LOW,
             params={
                 'labelSelector': 'job-name={job}'.format(job=job),
                 'gracePeriodSeconds': 0,
@@ -81,10 +61,57 @@ async def k8s_delete_job(k8s_client, job, pod_name=None, save_log=True):
             await save_job_log(job_name=job, pod_name=pod_name, k8s_client=k8s_client)
         await k8s_client.call_api(
             method='DELETE',
+            priority=PRIORITY_LOW,
             params={'gracePeriodSeconds': 0},
             api='/api/v1/namespaces/{namespace}/pods/{name}'.format(namespace=settings.job_namespace, name=pod_name)
         )
 
+
+async def k8s_evict_job(k8s_client, job, grace_period=None):
+    """Stop a job gracefully: its containers get SIGTERM and `grace_period` seconds to exit
+    (e.g. to save a checkpoint to OUTPUT_DIR) before SIGKILL. Logs are saved until they exit.
+    """
+    grace_period = settings.preemption_grace_period if grace_period is None else grace_period
+
+    # orphan the pods, so they are not killed at once nor recreated
+    await k8s_client.call_api(
+        method='DELETE',
+        priority=PRIORITY_LOW,
+        params={'propagationPolicy': 'Orphan'},
+        api='/apis/batch/v1/namespaces/{namespace}/jobs/{name}'.format(namespace=settings.job_namespace, name=job)
+    )
+    await k8s_client.call_api(
+        api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace),
+        method='PATCH',
+        priority=PRIORITY_LOW,
+        params={'labelSelector': 'job-name={job}'.format(job=job)},
+        headers={'Content-Type': 'application/json-patch+json'},
+        data=[{"op": "add", "path": "/metadata/labels/ktqueue-terminating", "value": "true"}]
+    )
+
+    pods = await pod_cache.get_job_pods(k8s_client, job)
+    save_logs = [
+        asyncio.ensure_future(save_job_log(job_name=job, pod_name=pod['metadata']['name'], k8s_client=k8s_client, follow=True))
+        for pod in pods
+    ]
+    await k8s_client.call_api(
+        method='DELETE',
+        priority=PRIORITY_LOW,
+        params={
+            'labelSelector': 'job-name={job}'.format(job=job),
+            'gracePeriodSeconds': grace_period,
+        },
+        api='/api/v1/namespaces/{namespace}/pods'.format(namespace=settings.job_namespace)
+    )
+    if save_logs:
+        done, pending = await asyncio.wait(save_logs, timeout=grace_period + 60)
+        for task in pending:
+            task.cancel()
+        for task in done:
+            if task.exception():
+                logging.exception(task.exception())
+
+
 class KTQueueDefaultCredentialProvider(GitCredentialProvider):
     """Give the authorization method for a (user, repo) combination
 
@@ -93,13 +120,13 @@ class KTQueueDefaultCredentialProvider(GitCredentialProvider):
     """
     allowed_method = ['none', 'github_oauth', 'ssh_key', 'https_password']
 
-    def __init__(self, repo, user, mongo_client):
+    def __init__(self, repo, user, db):
         self.repo = repo
         self.user = user
-        self.mongo_client = mongo_client
+        self.db = db
 
-        self.repos_collection = self.mongo_client.ktqueue.repos
-        self.oauth_collection = self.mongo_client.ktqueue.oauth
+        self.repos_collection = self.db.repos
+        self.oauth_collection = self.db.oauth
 
         self._auth_type = 'none'
         if settings.auth_required:
@@ -109,16 +136,17 @@ class KTQueueDefaultCredentialProvider(GitCredentialProvider):
         self._https_password = None
         self.repo_type = None
 
-    def prepare_credential(self):
+    async def prepare_credential(self):
+        """Load credential from database, must be awaited before the properties are used."""
         self.repo_type = self.get_repo_type(self.repo)
-        repo = self.repos_collection.find_one({'repo': self.repo})
+        repo = await self.repos_collection.find_one({'repo': self.repo})
         if repo:
             self._auth_type = repo['authType']
 
         if self._auth_type == 'none':  # username = password = None
             pass
         elif self._auth_type == 'github_oauth':
-            crediential = self.oauth_collection.find_one({'provider': 'github', 'id': self.user})
+            crediential = await self.oauth_collection.find_one({'provider': 'github', 'id': self.user})
             if crediential:
                 self._https_username = crediential['access_token']
         elif self._auth_type == 'ssh_key':
@@ -129,18 +157,12 @@ class KTQueueDefaultCredentialProvider(GitCredentialProvider):
 
     @property
     def ssh_key(self):
-        if not self._ssh_key:
-            self.prepare_credential()
         return self._ssh_key
 
     @property
     def https_username(self):
-        if not self._https_username:
-            self.prepare_credential()
         return self._https_username
 
     @property
     def https_password(self):
-        if not self._https_password:
-            self.prepare_credential()
         return self._https_password
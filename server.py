@@ -8,19 +8,33 @@ import pymongo
 import tornado
 import tornado.web
 import tornado.autoreload
+import tornado.process
+import tornado.netutil
+import tornado.httpserver
 
 from tornado.simple_httpclient import SimpleAsyncHTTPClient
 from tornado.platform.asyncio import AsyncIOMainLoop
 
 import ktqueue.settings
 from ktqueue.kubernetes_client import kubernetes_client
+from ktqueue.db import get_db
 from ktqueue.api import JobsHandler
+from ktqueue.api import BatchJobsHandler
+from ktqueue.api import JobSearchHandler
+from ktqueue.api import SchedulerHandler
+from ktqueue.api import MetricsHandler
+from ktqueue.api import ReadyHandler
+from ktqueue.api import StatsHandler
 from ktqueue.api import JobLogHandler
 from ktqueue.api import JobLogWSHandler
+from ktqueue.api import JobLogSearchHandler
 from ktqueue.api import JobLogVersionHandler
 from ktqueue.api import ReposHandler
 from ktqueue.api import RepoHandler
+from ktqueue.api import JobEventsHandler
+from ktqueue.api import JobEventsWSHandler
 from ktqueue.api import NodesHandler
+from ktqueue.api import NodesDeltaHandler
 from ktqueue.api import StopJobHandler
 from ktqueue.api import RestartJobHandler
 from ktqueue.api import TensorBoardProxyHandler
@@ -31,6 +45,16 @@ from ktqueue.api import AuthRequestHandler
 
 
 from ktqueue.event_watcher import watch_pod
+from ktqueue.event_watcher import watch_node
+from ktqueue.event_watcher import reconcile_pods
+from ktqueue.event_watcher import watch_pod_cache
+from ktqueue.cluster import LeaderElector
+from ktqueue.cluster import SharedClusterState
+from ktqueue.change_feed import get_change_feed
+from ktqueue.submission import get_submission_queue
+from ktqueue.scheduler import Scheduler
+from ktqueue.migrations import get_migration_runner
+from ktqueue.log_shipper import get_log_shipper
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 
@@ -38,26 +62,18 @@ __frontend_path = os.path.join(BASE_DIR, 'frontend')
 __dist_path = os.path.join(__frontend_path, 'dist')
 
 
-def create_db_index():
+def create_collections():
+    """Create collections which must exist before use, indexes and migrations are run by MigrationRunner."""
     client = pymongo.MongoClient(ktqueue.settings.mongodb_server)
-    client.ktqueue.jobs.create_index([("name", pymongo.ASCENDING)], unique=True)
-    client.ktqueue.jobs.create_index([("hide", pymongo.ASCENDING)])
-    client.ktqueue.jobs.create_index([("status", pymongo.ASCENDING)])
-    client.ktqueue.credentials.create_index([("repo", pymongo.ASCENDING)], unique=True)
-    client.ktqueue.oauth.create_index([("provider", pymongo.ASCENDING), ("id", pymongo.ASCENDING)], unique=True)
-
-    # compatibility
-    client.ktqueue.jobs.update_many({'hide': {'$exists': False}}, {'$set': {'hide': False}})
-    client.ktqueue.jobs.update_many({'fav': {'$exists': False}}, {'$set': {'fav': False}})
-    client.ktqueue.jobs.update_many({'memoryLimit': {'$exists': False}}, {'$set': {'memoryLimit': None}})
-    client.ktqueue.jobs.update_many({'cpuLimit': {'$exists': False}}, {'$set': {'cpuLimit': None}})
-    client.ktqueue.jobs.update_many({'commit_id': {'$exists': True}}, {'$rename': {'commit_id': 'commit'}})
-    client.ktqueue.jobs.update_many({'gpu_num': {'$exists': True}}, {'$rename': {'gpu_num': 'gpuNum'}})
-
-
-def get_app():
-    k8s_client = kubernetes_client()
-    mongo_client = pymongo.MongoClient(ktqueue.settings.mongodb_server)
+    try:
+        if 'job_events' not in client.ktqueue.list_collection_names():
+            client.ktqueue.create_collection('job_events', capped=True, size=ktqueue.settings.change_feed_size)
+    finally:
+        client.close()  # runs before fork_processes, MongoClient is not fork-safe
+
+
+def get_app(k8s_client):
+    db = get_db()
 
     # other args to app
     app_kwargs = {}
@@ -73,42 +89,110 @@ def get_app():
         (r'/dist/(.*)', tornado.web.StaticFileHandler, {'path': __dist_path}),
         (r'/tensorboard/(?P<job>[\.\w_-]+)/(?P<url>.*)', TensorBoardProxyHandler, {'client': SimpleAsyncHTTPClient(max_clients=64)}),
         (r'/data/(?P<url>.*)', TensorBoardProxyHandler, {'client': SimpleAsyncHTTPClient(max_clients=64)}),  # This is a hack for TensorBoard
-        (r'/auth/oauth2/start', OAuth2Handler, {'mongo_client': mongo_client}),
-        (r'/auth/oauth2/callback', OAuth2Handler, {'mongo_client': mongo_client}),
+        (r'/auth/oauth2/start', OAuth2Handler, {'db': db}),
+        (r'/auth/oauth2/callback', OAuth2Handler, {'db': db}),
         (r'/auth/auth', AuthRequestHandler),
         # APIS
-        (r'/api/nodes', NodesHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
-        (r'/api/jobs', JobsHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
-        (r'/api/jobs/(?P<job>[\.\w_-]+)/log', JobLogHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
-        (r'/api/jobs/(?P<job>[\.\w_-]+)/log/(?P<version>\d+|current)', JobLogHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
+        (r'/api/nodes', NodesHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/nodes/delta', NodesDeltaHandler),
+        (r'/api/jobs', JobsHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/jobs/events', JobEventsHandler),
+        (r'/api/jobs/search', JobSearchHandler, {'db': db}),
+        (r'/api/jobs/batch', BatchJobsHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/scheduler', SchedulerHandler, {'db': db}),
+        (r'/api/metrics', MetricsHandler, {'k8s_client': k8s_client}),
+        (r'/api/ready', ReadyHandler),
+        (r'/api/stats', StatsHandler, {'db': db}),
+        (r'/api/logs/search', JobLogSearchHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/jobs/(?P<job>[\.\w_-]+)/log/search', JobLogSearchHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/jobs/(?P<job>[\.\w_-]+)/log', JobLogHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/jobs/(?P<job>[\.\w_-]+)/log/(?P<version>\d+|current)', JobLogHandler, {'k8s_client': k8s_client, 'db': db}),
         (r'/api/jobs/(?P<job>[\.\w_-]+)/log/version', JobLogVersionHandler, {'k8s_client': k8s_client}),
-        (r'/api/job/stop/(?P<job>[\.\w_\-]+)', StopJobHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
-        (r'/api/job/restart/(?P<job>[\.\w_-]+)', RestartJobHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
-        (r'/api/job/tensorboard/(?P<job>[\.\w_-]+)', TensorBoardHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
-        (r'/api/repos', ReposHandler, {'mongo_client': mongo_client}),
-        (r'/api/repos/(?P<id>[0-9a-f]+)', RepoHandler, {'mongo_client': mongo_client}),
+        (r'/api/job/stop/(?P<job>[\.\w_\-]+)', StopJobHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/job/restart/(?P<job>[\.\w_-]+)', RestartJobHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/job/tensorboard/(?P<job>[\.\w_-]+)', TensorBoardHandler, {'k8s_client': k8s_client, 'db': db}),
+        (r'/api/repos', ReposHandler, {'db': db}),
+        (r'/api/repos/(?P<id>[0-9a-f]+)', RepoHandler, {'db': db}),
         (r'/api/current_user', CurrentUserHandler),
-        (r'/wsapi/jobs/(?P<job>[\.\w_-]+)/log', JobLogWSHandler, {'k8s_client': k8s_client, 'mongo_client': mongo_client}),
+        (r'/wsapi/jobs', JobEventsWSHandler),
+        (r'/wsapi/jobs/(?P<job>[\.\w_-]+)/log', JobLogWSHandler, {'k8s_client': k8s_client, 'db': db}),
     ], **app_kwargs)
     return application
 
 
-async def async_init():
+async def reconcile(k8s_client):
+    """Rebuild in-memory state before serving, return (resource_version, terminated_pods) for watch_pod."""
+    try:
+        return await asyncio.wait_for(reconcile_pods(k8s_client, db=get_db()), ktqueue.settings.reconcile_timeout)
+    except Exception as e:  # watch_pod will LIST by itself
+        logging.exception(e)
+        return None, []
+
+
+async def async_init(k8s_client, elector, reconciled=None):
+    """Run watchers. Only the elected leader runs watch_pod, the others follow its shared state."""
+    cluster_state = SharedClusterState(get_db().cluster_state, elector)
+    change_feed = get_change_feed()
+    change_feed.elector = elector
+
+    def on_leader():
+        nonlocal reconciled
+        resource_version, terminated_pods = reconciled or (None, [])
+        reconciled = None  # reconcile again if elected later
+        tasks = [
+            run_watch_pod(k8s_client, resource_version, terminated_pods),
+        ]
+        if ktqueue.settings.scheduler_enabled:
+            tasks.append(Scheduler(get_db(), get_submission_queue(), k8s_client=k8s_client).run())
+        if ktqueue.settings.log_shipper_enabled:
+            tasks.append(get_log_shipper().run(k8s_client))
+        return tasks
+
+    def on_follower():
+        return [
+            watch_pod_cache(k8s_client),
+        ]
+
     tasks = [
-        watch_pod(kubernetes_client()),
+        get_migration_runner().run(),
+        elector.run(on_leader=on_leader, on_follower=on_follower),
+        cluster_state.run(),
+        change_feed.run(),
+        get_submission_queue(k8s_client).run(),
+        watch_node(k8s_client),
     ]
     await asyncio.wait(tasks)
 
 
+async def run_watch_pod(k8s_client, resource_version=None, terminated_pods=None):
+    if resource_version is None:
+        resource_version, terminated_pods = await reconcile(k8s_client)
+    await watch_pod(k8s_client, db=get_db(), resource_version=resource_version, terminated_pods=terminated_pods,
+                    change_feed=get_change_feed())
+
+
 def start_server():
-    create_db_index()
+    create_collections()
+    workers = ktqueue.settings.workers
+    if workers != 1:
+        # every process listens with SO_REUSEPORT, kernel balances connections between them
+        tornado.process.fork_processes(workers)
     AsyncIOMainLoop().install()
-    app = get_app()
-    app.listen(8080)
+    k8s_client = kubernetes_client()
     loop = asyncio.get_event_loop()
+
+    # the process holding the lease at startup reconciles before serving
+    elector = LeaderElector(get_db().leases, 'watcher')
+    reconciled = None
+    if loop.run_until_complete(elector.try_acquire()):
+        reconciled = loop.run_until_complete(reconcile(k8s_client))
+
+    app = get_app(k8s_client)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(tornado.netutil.bind_sockets(8080, reuse_port=workers != 1))
     if os.environ.get('KTQUEUE_DEBUG', '0') == '1':
         print('Reload.')
-    loop.run_until_complete(async_init())
+    loop.run_until_complete(async_init(k8s_client, elector, reconciled))
     loop.run_forever()
 
 